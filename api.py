@@ -19,6 +19,15 @@ import requests
 
 import settings
 import email_tools
+import http_cache
+import redis_scripts
+import sensor_history
+import rate_limit
+import live_stream
+import log_pipeline
+import relay_commands
+import relay_events
+import tank_level
 
 
 LAST_RELAY_FW_VERSION = 19
@@ -46,25 +55,22 @@ RELAY_EVENTS_CODE = {
 
 
 def setup_logger():
-    # Configure the logging system
     """Configure root logger output for API service diagnostics.
 
+    Records go through a queue to a background writer (`log_pipeline`) so
+    formatting and stderr writes stay off the request path.
+
     Returns:
         None.
     """
     logging.basicConfig(level=logging.WARNING, handlers=[])  # Do not add the implicit handler
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
-    # Create a handler and set the formatter
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
-
-    # Add the handler to the root logger
-    logging.getLogger().addHandler(handler)
+    logging.getLogger().addHandler(log_pipeline.build_handler())
 
 
 setup_logger()
 import db
+import migrations
+import write_behind
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = settings.APP_SEC_KEY
@@ -86,7 +92,24 @@ DOMAIN = settings.API_DOMAIN
 WEB_APP_DOMAIN = settings.APP_DOMAIN
 
 # Configure CORS for a specific domain
-CORS(app, origins=[WEB_APP_DOMAIN])
+CORS(app, origins=[WEB_APP_DOMAIN], expose_headers=['ETag'])
+
+# Keep recent sensor history only (3 days) and mark uptime once per hour.
+HISTORY_RETENTION_SECONDS = sensor_history.RETENTION_SECONDS
+UPTIME_MARKER_TTL_SECONDS = 7200
+
+# Store-and-forward batch limits (720 readings = 6 hours at 30 s cadence).
+BATCH_MAX_READINGS = 720
+BATCH_CLOCK_SKEW_SECONDS = 300
+
+# Sensor level pushed to linked relays; relays recompute from `tin-keys` once it lapses.
+RELAY_SENSOR_STATE_TTL_SECONDS = 60 * 60 * 24 * 7
+# Previous-heartbeat state used for relay runtime accounting.
+RELAY_RUNTIME_STATE_TTL_SECONDS = 60 * 60 * 24 * 30
+
+sensor_ingest_script = redis_client.register_script(redis_scripts.SENSOR_INGEST)
+sensor_rollup_script = redis_client.register_script(redis_scripts.SENSOR_ROLLUP_REBUILD)
+relay_runtime_script = redis_client.register_script(redis_scripts.RELAY_RUNTIME_ACCOUNT)
 
 
 def generate_secure_random_string(length=16):
@@ -190,33 +213,12 @@ def relay_view_api():
 
         cache_key = f'relay-keys/{key}'
         relay_status = redis_client.get(cache_key)
-        status, rtime, rssi = 0, 0, 0
-        if relay_status:
-            status, rtime, rssi = map(int, relay_status.split('|'))
-
-        events_list = []
-        try:
-            cache_key_event = f'relay-events/{key}'
-            LIVE_EVENTS = redis_client.get(cache_key_event)
-            redis_client.delete(cache_key_event)
-            if LIVE_EVENTS:
-                LIVE_EVENTS = LIVE_EVENTS.strip().split(",")
-                for item in LIVE_EVENTS:
-                    if int(item) != 0:
-                        events_list.append(RELAY_EVENTS_CODE[int(item)][1])
-        except Exception as ex:
-            logging.exception(ex)
-            LIVE_EVENTS = None
-
-        diff_time = int(time.time()) - int(rtime)
-        data = {
-            "status": status,
-            "rtime": rtime,
-            "diff_time": diff_time,
-            "rssi": rssi,
-            "events": events_list
-        }
-        return jsonify(data)
+        # Each viewer passes back its own `events_cursor` as `since`; reads never consume events.
+        since = request.args.get('since') or None
+        # Heartbeats rewrite `relay-keys` and append events together, so an unchanged
+        # state with the same cursor has no new events either.
+        return http_cache.conditional_json((key, relay_status, since),
+                                           lambda: relay_view_data(key, relay_status, since))
     elif request.method == "POST":
         public_key = request.form.get("public_key")
 
@@ -242,6 +244,56 @@ def sensor_view_api():
 
     cache_key = f'tin-keys/{key}'
     result = redis_client.get(cache_key)
+    return http_cache.conditional_json((key, result), lambda: sensor_view_data(key, result))
+
+
+def relay_view_data(key, relay_status, since=None):
+    """Build the relay dashboard payload.
+
+    Args:
+        key: Relay public key.
+        relay_status: `relay-keys/<public_key>` value ("status|epoch|rssi") or None.
+        since: Viewer events cursor; without one the recent events are returned.
+
+    Returns:
+        dict: `status`, `rtime`, `diff_time`, `rssi`, `events` and `events_cursor`.
+    """
+    status, rtime, rssi = 0, 0, 0
+    if relay_status:
+        status, rtime, rssi = map(int, relay_status.split('|'))
+
+    events_list = []
+    events_cursor = since
+    try:
+        entries, events_cursor = relay_events.read(key, since=since)
+        for _, fields in entries:
+            for item in fields.get('events', '').strip().split(","):
+                if item and int(item) != 0:
+                    events_list.append(RELAY_EVENTS_CODE[int(item)][1])
+    except Exception as ex:
+        logging.exception(ex)
+
+    diff_time = int(time.time()) - int(rtime)
+    return {
+        "status": status,
+        "rtime": rtime,
+        "diff_time": diff_time,
+        "rssi": rssi,
+        "events": events_list,
+        "events_cursor": events_cursor
+    }
+
+
+def sensor_view_data(key, result):
+    """Build the sensor dashboard payload.
+
+    Args:
+        key: Sensor public key.
+        result: `tin-keys/<public_key>` value ("distance|epoch|centivolts|rssi") or None.
+
+    Returns:
+        dict: `distance`, `rtime`, `skey`, `diff_time`, `voltage` and `rssi`.
+    """
     distance = 0
     rtime = 0
     rssi = 0
@@ -252,7 +304,7 @@ def sensor_view_api():
         voltage = float(voltage) / 100.0
         diff_time = int(time.time()) - int(rtime)
 
-    data = {
+    return {
         "distance": distance,
         "rtime": rtime,
         "skey": key,
@@ -261,10 +313,137 @@ def sensor_view_api():
         "rssi": rssi
     }
 
-    return jsonify(data)
+
+@app.route('/device_stream', methods=["GET"])
+def device_stream():
+    """Stream a device's live dashboard payload as Server-Sent Events.
+
+    Query params:
+    - public_key: device public key (`demo`/`demorelay` aliases)
+    - type: `sensor` (default) or `relay`
+
+    Sends the same payload as `/sensor_view_api` / `/relay_view_api` each
+    time the device reports, heartbeat comments in between, and resumes
+    from `Last-Event-ID` on reconnect. Needs the async (gevent) API worker.
+
+    Returns:
+        flask.Response: `text/event-stream` response.
+    """
+    key = request.args.get('public_key')
+    if not key:
+        return jsonify({'error': 'missing public_key'}), 400
+    is_relay = request.args.get('type') == 'relay'
+    if key == "demo":
+        key = settings.DEMO_S1_PUB_KEY
+    elif key == "demorelay":
+        key = settings.DEMO_RELAY_PUB_KEY
+    last_id = request.headers.get('Last-Event-ID') or None
+
+    if is_relay:
+        def render(state, previous_id):
+            # Event ids are "<rtime>/<events cursor>" so a reconnect resumes the event log.
+            since = previous_id.split('/', 1)[1] if previous_id and '/' in previous_id else None
+            data = relay_view_data(key, state, since or None)
+            return f"{data['rtime']}/{data['events_cursor'] or ''}", data
+        state_key = f'relay-keys/{key}'
+    else:
+        def render(state, previous_id):
+            data = sensor_view_data(key, state)
+            return str(data['rtime']), data
+        state_key = f'tin-keys/{key}'
+
+    frames = live_stream.events(key, lambda: redis_client.get(state_key), render, last_id=last_id)
+    response = app.response_class(frames, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Nginx must not buffer the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def history_percent(sensor_settings, distance):
+    """Compute the fill percent stored in sensor history for a distance.
+
+    Args:
+        sensor_settings: Sensor settings with `EMPTY_LEVEL` and `TOP_MARGIN`.
+        distance: Raw distance reported by the device.
+
+    Returns:
+        int: Fill percent clamped to 0-100 (0 when settings are unusable).
+    """
+    try:
+        return tank_level.level_percent(distance, sensor_settings.EMPTY_LEVEL, sensor_settings.TOP_MARGIN)
+    except Exception:
+        return 0
+
+
+def history_voltage(voltage):
+    """Normalize device voltage (integer-scaled centivolts) to volts.
+
+    Args:
+        voltage: Raw voltage reported by the device.
+
+    Returns:
+        float: Voltage in volts (0.0 when unparsable).
+    """
+    try:
+        return float(voltage) / 100.0
+    except Exception:
+        return 0.0
+
+
+def ingest_sensor_reading(key, device_id, distance, voltage, rssi, percent, voltage_val, min_updates=30,
+                          relay_keys=(), liters=None):
+    """Apply a sensor reading to Redis atomically in a single round trip.
+
+    Runs the frequency check, live-state write, packed history append, hourly
+    aggregate update, the hourly uptime marker and the level push to linked
+    relays inside one Lua script, so concurrent workers handling the same
+    device cannot both pass the frequency check.
+
+    Args:
+        key: Sensor public key.
+        device_id: Sensor device id (uptime marker scope).
+        distance: Raw distance reported by the device.
+        voltage: Raw voltage reported by the device (centivolts).
+        rssi: Reported WiFi RSSI in dBm.
+        percent: Fill percent computed from sensor settings.
+        voltage_val: Normalized voltage in volts.
+        min_updates: Minimum seconds between accepted readings.
+        relay_keys: Public keys of relays linked to this sensor.
+        liters: Stored liters derived from `distance` (pushed to relays).
+
+    Returns:
+        tuple[bool, bool]: `(accepted, new_uptime_hour)`.
+    """
+    now_ts = int(time.time())
+    hour_ts = sensor_history.hour_start(now_ts)
+    percent_int, centivolts = sensor_history.record_values(percent, voltage_val)
+    accepted, new_uptime_hour = sensor_ingest_script(
+        keys=[
+            f'tin-keys/{key}',
+            sensor_history.hour_key(key, hour_ts),
+            f'key-uptime/{device_id}/{datetime.now().hour}',
+            sensor_history.rollup_key(key, hour_ts),
+        ] + [f'relay-sensor/{relay_key}' for relay_key in relay_keys],
+        args=[
+            now_ts, min_updates, 5,
+            f"{distance}|{now_ts}|{voltage}|{rssi}",
+            sensor_history.pack_record(now_ts, percent, voltage_val),
+            sensor_history.expire_at(hour_ts, HISTORY_RETENTION_SECONDS),
+            UPTIME_MARKER_TTL_SECONDS,
+            percent_int,
+            centivolts,
+            f"{key}|{percent_int}|{distance}|{now_ts}|{liters}",
+            RELAY_SENSOR_STATE_TTL_SECONDS,
+            live_stream.channel(key),
+        ],
+        client=redis_client,
+    )
+    return bool(int(accepted)), bool(int(new_uptime_hour))
 
 
 @app.route('/update')
+@rate_limit.limit_device_requests
 def update():
     # Get the 'key' parameter from the query string
     """Ingest sensor device updates and return runtime configuration headers.
@@ -277,93 +456,38 @@ def update():
     if not public_key:
         return jsonify({'error': 'invalid private key'}), 404
     key = public_key
-    logging.warning(f"public_key: {public_key}")
     distance = request.args.get('distance')
     voltage = request.args.get('voltage')
-    logging.warning(f"update params: >>> {distance}|{int(time.time())}|{voltage}")
-    if not distance:
-        return 'ERROR'
-    if not voltage:
+    if not distance or not voltage:
+        log_pipeline.log_event('sensor_update_invalid', public_key=public_key, distance=distance, voltage=voltage)
         return 'ERROR'
 
     rssi = int(request.headers.get('RSSI', 0))
     device_id = db.DevicesDB.load_device_id_by_public_key(public_key)
-
-    cache_key_uptime = f'key-uptime/{device_id}/{datetime.now().hour}'
-    uptime_result = redis_client.get(cache_key_uptime)
-    if not uptime_result:
-        # 2 hours expire time
-        redis_client.set(cache_key_uptime, "true", ex=7200)
-        db.DevicesDB.record_uptime(device_id)
+    db_device_settings = db.DevicesDB.load_device_settings(device_id=device_id, device_type=1)
 
     min_updates = 30
-    can_update = False
-
-    cache_key = f'tin-keys/{key}'
-    result = redis_client.get(cache_key)
-    distance_old = 0
-    rtime_old = 0
-    rssi_old = 0
-    voltage_old = 0
-    diff_time_old = 0
-    if result:
-        distance_old, rtime_old, voltage_old, rssi_old = result.split("|")
-        diff_time_old = int(time.time()) - int(rtime_old)
-
-        if diff_time_old + 5 < min_updates:
-            logging.warning(f"frequency violation at device: {device_id}")
-            can_update = False
-        else:
-            can_update = True
-    else:
-        can_update = True
-
-    if can_update:
-        cache_key = f'tin-keys/{key}'
-        redis_client.set(cache_key, f"{distance}|{int(time.time())}|{voltage}|{rssi}")
-
-        # Persist history point for hourly aggregation (percent, voltage)
-        try:
-            db_device_settings = db.DevicesDB.load_device_settings(device_id=device_id, device_type=1)
-            # Compute percent fill using same logic as frontend
-            try:
-                EMPTY_LEVEL = float(db_device_settings.EMPTY_LEVEL)
-                TOP_MARGIN = float(db_device_settings.TOP_MARGIN)
-                dval = float(distance)
-                if EMPTY_LEVEL > 0 and EMPTY_LEVEL <= dval:
-                    percent = 0
-                else:
-                    if EMPTY_LEVEL == 0:
-                        EMPTY_LEVEL = 1.0
-                    usable = (EMPTY_LEVEL - TOP_MARGIN) if (EMPTY_LEVEL - TOP_MARGIN) != 0 else 1.0
-                    pct = 100.0 - ((dval - TOP_MARGIN) * 100.0 / usable)
-                    percent = int(max(0, min(100, pct)))
-            except Exception:
-                percent = 0
-
-            # voltage reported by device is integer-scaled (centi-volts), normalize
-            try:
-                voltage_val = float(voltage) / 100.0
-            except Exception:
-                voltage_val = 0.0
-
-            history_key = f'tin-history/{key}'
-            score = int(time.time())
-            # Store unique member to avoid zset member overwrite when
-            # percent/voltage values repeat across consecutive updates.
-            unique_suffix = time.time_ns()
-            redis_client.zadd(history_key, {f"{percent}|{voltage_val}|{unique_suffix}": score})
-            # Keep recent history only (trim older than 3 days)
-            redis_client.zremrangebyscore(history_key, 0, score - 60 * 60 * 24 * 3)
-            # Optional TTL for the zset key (3 days)
-            redis_client.expire(history_key, 60 * 60 * 24 * 3)
-        except Exception:
-            logging.exception("failed to persist history point")
-    else:
-        logging.warning(f"This device can't update, id: {device_id}")
 
-    logging.warning(f"FW Version: {request.headers.get('FW-Version', 'unknow')}")
-    logging.warning(f"RSSI: {request.headers.get('RSSI', 'unknow')} dBm")
+    percent = history_percent(db_device_settings, distance)
+    voltage_val = history_voltage(voltage)
+    relay_keys = db.DevicesDB.load_sensor_relays(public_key)
+    liters = None
+    if relay_keys:
+        _, _, liters = tank_level.settings_levels(db_device_settings, distance)
+        liters = round(liters, 4)
+
+    can_update, new_uptime_hour = ingest_sensor_reading(
+        key, device_id, distance, voltage, rssi, percent, voltage_val, min_updates,
+        relay_keys=relay_keys, liters=liters)
+    if new_uptime_hour:
+        write_behind.record_uptime(device_id)
+    if not can_update:
+        log_pipeline.log_event('frequency_violation', device_id=device_id, public_key=public_key)
+
+    log_pipeline.log_event(
+        'sensor_update', public_key=public_key, distance=distance, voltage=voltage,
+        rssi=request.headers.get('RSSI', 'unknow'), fw=request.headers.get('FW-Version', 'unknow'),
+        accepted=int(bool(can_update)))
 
     response = app.response_class(
         response='OK',
@@ -372,33 +496,136 @@ def update():
     )
     response.headers['fw-version'] = f"{LAST_SENSOR_FW_VERSION}"
 
-    db_device_settings = db.DevicesDB.load_device_settings(device_id=device_id, device_type=1)
     if db_device_settings.WIFI_POOL_TIME < 120 and min_updates == 120:
-        db.DevicesDB.update_sensor_pool_time(device_id, 120)
-        logging.warning(f"Updating sensor_pool_time for Device: {device_id}, pool_time: {min_updates}")
+        write_behind.update_sensor_pool_time(device_id, 120)
+        log_pipeline.log_event('sensor_pool_time', device_id=device_id, pool_time=min_updates)
     if db_device_settings.WIFI_POOL_TIME < 30 and min_updates == 30:
-        db.DevicesDB.update_sensor_pool_time(device_id, 30)
-        logging.warning(f"Updating sensor_pool_time for Device: {device_id}, pool_time: {min_updates}")
+        write_behind.update_sensor_pool_time(device_id, 30)
+        log_pipeline.log_event('sensor_pool_time', device_id=device_id, pool_time=min_updates)
     # WiFi-Pool-Time >> wpl
     response.headers['wpl'] = f"{db_device_settings.WIFI_POOL_TIME}"
 
     return response
 
 
+def parse_batch_readings(body, now_ts, max_readings=BATCH_MAX_READINGS):
+    """Parse a store-and-forward batch body into validated readings.
+
+    Each non-empty line is `epoch|distance|voltage|rssi` (`rssi` optional).
+    Malformed lines, readings from the future and readings older than the
+    history retention window are skipped.
+
+    Args:
+        body: Raw request body text.
+        now_ts: Current epoch seconds used for range validation.
+        max_readings: Maximum number of lines accepted per request.
+
+    Returns:
+        list[tuple[int, int, int, int]] | None: `(ts, distance, voltage, rssi)`
+        sorted by timestamp, or None when the batch exceeds `max_readings`.
+    """
+    lines = [line.strip() for line in (body or '').splitlines() if line.strip()]
+    if len(lines) > max_readings:
+        return None
+
+    readings = []
+    for line in lines:
+        parts = line.split('|')
+        if len(parts) not in (3, 4):
+            continue
+        try:
+            ts = int(parts[0])
+            distance = int(parts[1])
+            voltage = int(parts[2])
+            rssi = int(parts[3]) if len(parts) == 4 else 0
+        except ValueError:
+            continue
+        if ts > now_ts + BATCH_CLOCK_SKEW_SECONDS or ts <= now_ts - HISTORY_RETENTION_SECONDS:
+            continue
+        readings.append((ts, distance, voltage, rssi))
+
+    readings.sort(key=lambda item: item[0])
+    return readings
+
+
+@app.route('/update-batch', methods=["POST"])
+@rate_limit.limit_device_requests
+def update_batch():
+    """Ingest a backlog of timestamped sensor readings in one request.
+
+    Devices that buffered readings while offline (for example after
+    `DATA_POST_FAIL`) post them here. The private key is validated once and
+    all points are appended to the packed hourly history keys in one
+    pipeline. Retried batches append identical records, which history
+    readers report once. Live state (`tin-keys`) is left to `/update`.
+
+    Returns:
+        flask.Response | tuple: Plain-text OK response or JSON error tuple.
+    """
+    private_key = request.args.get('key')
+    public_key = db.DevicesDB.valid_private_key(private_key)
+    if not public_key:
+        return jsonify({'error': 'invalid private key'}), 404
+
+    now_ts = int(time.time())
+    readings = parse_batch_readings(request.get_data(as_text=True), now_ts)
+    if readings is None:
+        return jsonify({'error': f'too many readings (max {BATCH_MAX_READINGS})'}), 413
+
+    device_id = db.DevicesDB.load_device_id_by_public_key(public_key)
+    db_device_settings = db.DevicesDB.load_device_settings(device_id=device_id, device_type=1)
+
+    if readings:
+        pipe = redis_client.pipeline(transaction=False)
+        hour_starts = sensor_history.append_samples(pipe, public_key, [
+            (ts, history_percent(db_device_settings, distance), history_voltage(voltage))
+            for ts, distance, voltage, _ in readings
+        ], HISTORY_RETENTION_SECONDS)
+        # Backfilled hours arrive out of order: rebuild their aggregates from the raw records.
+        for hour_ts in hour_starts:
+            sensor_rollup_script(
+                keys=[sensor_history.hour_key(public_key, hour_ts), sensor_history.rollup_key(public_key, hour_ts)],
+                args=[hour_ts, sensor_history.expire_at(hour_ts, HISTORY_RETENTION_SECONDS)],
+                client=pipe,
+            )
+        pipe.execute()
+
+    log_pipeline.log_event('sensor_update_batch', public_key=public_key, accepted=len(readings))
+
+    response = app.response_class(
+        response='OK',
+        status=200,
+        mimetype='text/plain'
+    )
+    response.headers['fw-version'] = f"{LAST_SENSOR_FW_VERSION}"
+    response.headers['accepted'] = f"{len(readings)}"
+    if db_device_settings:
+        response.headers['wpl'] = f"{db_device_settings.WIFI_POOL_TIME}"
+    return response
+
+
 @app.route('/relay-update', methods=["GET"])
+@rate_limit.limit_device_requests
 def relay_update():
     # Get the 'key' parameter from the query string
     """Ingest relay heartbeat/events and return current control/settings headers.
 
+    Commands are handed out one at a time from the relay's queue and are
+    acknowledged by the first heartbeat reporting the requested status. With
+    `wait=<seconds>` (capped by `RELAY_LONG_POLL_MAX_SECONDS`) and no command
+    pending, the response is held until one is issued through
+    `set_relay_action` or the wait expires.
+
     Returns:
         flask.Response | tuple: Plain-text OK response or JSON error tuple.
     """
     private_key = request.args.get('key')
-    public_key = db.DevicesDB.valid_private_key(private_key)
+    # Settings-derived state is one cached read; Redis only supplies live state.
+    snapshot = db.DevicesDB.load_relay_snapshot(private_key)
+    public_key = snapshot.public_key if snapshot else db.DevicesDB.valid_private_key(private_key)
     if not public_key:
         return jsonify({'error': 'invalid private key'}), 404
     key = public_key
-    logging.warning(f"public_key: {public_key}")
 
     rssi = int(request.headers.get('RSSI', 0))
 
@@ -409,108 +636,72 @@ def relay_update():
         status = 0
     if status not in (0, 1):
         status = 0
-    logging.warning(f"relay params: >>> {key}|{status}|{rssi}")
+
+    # Long-poll: with `wait=<seconds>` the response is held until an action is posted.
+    try:
+        wait_seconds = int(request.args.get('wait', 0))
+    except ValueError:
+        wait_seconds = 0
+    wait_seconds = max(0, min(wait_seconds, settings.RELAY_LONG_POLL_MAX_SECONDS))
 
     now_ts = int(time.time())
     cache_key = f'relay-keys/{key}'
-    prev_live_state = redis_client.get(cache_key)
-    redis_client.set(cache_key, f"{status}|{now_ts}|{rssi}")
+    runtime_key = f'relay-runtime-stats/{key}'
+    sensor_key = snapshot.sensor_key if snapshot else None
+    pushed_level, sensor_data = None, None
+    if sensor_key:
+        pushed_level, sensor_data = redis_client.mget([f'relay-sensor/{key}', f'tin-keys/{sensor_key}'])
+    live_state = f"{status}|{now_ts}|{rssi}"
 
-    logging.warning(f"Relay-FW Version: {request.headers.get('FW-Version', 'unknow')}")
-    logging.warning(f"Relay-RSSI: {request.headers.get('RSSI', 'unknow')} dBm")
-    logging.warning(f"Relay-EVENTS: {request.headers.get('EVENTS', '')}")
     RELAY_EVENTS = request.headers.get('EVENTS', '')
     if RELAY_EVENTS and RELAY_EVENTS == "0,0,0,0,0":
         RELAY_EVENTS = ''
-
-    sensor_key = 'none'
-    relay_device_id = db.DevicesDB.load_device_id_by_public_key(public_key)
-    relay_settings = db.DevicesDB.load_device_settings(device_id=relay_device_id, device_type=3)
-    if not relay_settings:
-        logging.error(f"relay don't have settings, public_key: {public_key}")
+    log_pipeline.log_event(
+        'relay_update', public_key=public_key, status=status, rssi=rssi,
+        fw=request.headers.get('FW-Version', 'unknow'))
+    if RELAY_EVENTS:
+        # Reported events are rare and diagnostic: never sampled.
+        log_pipeline.log_event('relay_events', public_key=public_key, events=RELAY_EVENTS)
+
+    if not snapshot:
+        redis_client.set(cache_key, live_state)
+        log_pipeline.log_event('relay_settings_missing', level=logging.ERROR, public_key=public_key)
         return jsonify({'error': 'relay settings missing'}), 500
+    relay_device_id = snapshot.relay_device_id
+    sensor_settings = snapshot.sensor_settings
 
     if DEVELOPER_MODE and RELAY_EVENTS:
-        db.DevicesDB.add_relay_events(relay_device_id, RELAY_EVENTS)
-        cache_key_event = f'relay-events/{key}'
-        redis_client.set(cache_key_event, RELAY_EVENTS)
+        # Live log for dashboards; bulk-persisted to `relay_events` by write_behind.py (or inline without it).
+        relay_events.append(key, relay_device_id, RELAY_EVENTS, now_ts)
         RELAY_EVENTS = RELAY_EVENTS.split(",")
 
     if RELAY_EVENTS and ('2' in RELAY_EVENTS or '14' in RELAY_EVENTS):
-        logging.warning(f"Detected sensor fail or danger blind distance, for device: {relay_device_id}")
+        log_pipeline.log_event('relay_sensor_fault', device_id=relay_device_id)
         db.DevicesDB.turn_off_relay_smart_mode(relay_device_id)
 
-    sensor_key = relay_settings.SENSOR_KEY
-
-    # Persist relay usage stats in DB (daily ON minutes + estimated liters added).
-    try:
-        current_sensor_liters = None
-        if sensor_key and sensor_key != 'none':
-            sensor_cache_key = f'tin-keys/{sensor_key}'
-            sensor_data_for_stats = redis_client.get(sensor_cache_key)
-            if sensor_data_for_stats:
-                distance_now, _, _, _ = sensor_data_for_stats.split("|")
-                sensor_device_id = db.DevicesDB.load_device_id_by_public_key(sensor_key)
-                sensor_settings = db.DevicesDB.load_device_settings(device_id=sensor_device_id, device_type=1)
-                if sensor_settings:
-                    empty_level = float(sensor_settings.EMPTY_LEVEL)
-                    top_margin = float(sensor_settings.TOP_MARGIN)
-                    liters_per_cm = float(sensor_settings.get('liters_per_cm', 10.0))
-                    dist_val = float(distance_now)
-                    if dist_val > empty_level:
-                        dist_val = empty_level
-                    if dist_val < top_margin:
-                        dist_val = top_margin
-                    water_height_cm = max(0.0, empty_level - dist_val)
-                    current_sensor_liters = round(water_height_cm * liters_per_cm, 4)
-
-        runtime_key = f'relay-runtime-stats/{key}'
-        runtime_state = redis_client.get(runtime_key)
-
-        prev_status = None
-        prev_ts = None
-        prev_liters = None
-
-        if runtime_state:
-            parts = runtime_state.split('|')
-            if len(parts) >= 3:
-                try:
-                    prev_ts = int(parts[0])
-                    prev_status = int(parts[1])
-                    prev_liters = None if parts[2] == 'none' else float(parts[2])
-                except Exception:
-                    prev_ts = None
-                    prev_status = None
-                    prev_liters = None
-
-        # Fallback to the previous live relay cache state when runtime state is unavailable.
-        if prev_ts is None and prev_live_state:
-            try:
-                prev_status_str, prev_ts_str, _ = prev_live_state.split('|')
-                prev_status = int(prev_status_str)
-                prev_ts = int(prev_ts_str)
-            except Exception:
-                prev_status = None
-                prev_ts = None
-
-        # Accumulate ON runtime for the elapsed interval.
-        if prev_status == 1 and prev_ts is not None and now_ts > prev_ts:
-            db.DevicesDB.add_relay_on_runtime(relay_device_id, prev_ts, now_ts)
-
-            # Estimate added liters while relay was ON (negative deltas are ignored).
-            if prev_liters is not None and current_sensor_liters is not None:
-                liters_added = round(max(0.0, current_sensor_liters - prev_liters), 4)
-                if liters_added > 0:
-                    db.DevicesDB.add_relay_liters_for_day(relay_device_id, now_ts, liters_added)
-
-        next_liters_value = 'none' if current_sensor_liters is None else str(current_sensor_liters)
-        redis_client.set(runtime_key, f"{now_ts}|{status}|{next_liters_value}", ex=60 * 60 * 24 * 30)
-    except Exception:
-        logging.exception("failed to persist relay daily usage stats")
+    sensor_level = None
+    if sensor_key and sensor_settings:
+        sensor_level = relay_sensor_level(sensor_key, sensor_settings, pushed_level, sensor_data)
+
+    # Daily ON seconds and liters added are counted in Redis and flushed to SQLite by write_behind.py
+    # (or inline, below, when it does not run).
+    current_sensor_liters = sensor_level[3] if sensor_level else None
+    relay_runtime_script(
+        keys=[runtime_key, cache_key, write_behind.RELAY_DAILY_KEY],
+        args=[now_ts, status, 'none' if current_sensor_liters is None else current_sensor_liters,
+              live_state, relay_device_id, RELAY_RUNTIME_STATE_TTL_SECONDS, live_stream.channel(key)],
+        client=redis_client,
+    )
+    # Without the write_behind.py flusher (WRITE_BEHIND_ENABLED off) heartbeats persist relay state themselves.
+    write_behind.persist_relay_inline()
 
-    raction = get_relay_action(public_key)
-    # relay action read by device, pass to neutral
-    set_relay_action(public_key, action=0)
+    # Acknowledge the outstanding command if this status carries it out, then hand out the next.
+    raction, ack_latency_ms = relay_commands.take(key, status)
+    if ack_latency_ms >= 0:
+        log_pipeline.log_event('relay_command_ack', public_key=public_key, status=status,
+                               latency_ms=ack_latency_ms)
+    if not raction and wait_seconds:
+        raction = relay_commands.wait_for_action(key, wait_seconds, lambda: relay_commands.take(key, status)[0])
 
     response = app.response_class(
         response='OK',
@@ -523,81 +714,87 @@ def relay_update():
     response.headers['fw-version'] = LAST_RELAY_FW_VERSION
     response.headers['pool-time'] = 0
 
-    response.headers['ALGO'] = relay_settings.ALGO
-    response.headers['SAFE_MODE'] = relay_settings.SAFE_MODE
-    response.headers['START_LEVEL'] = relay_settings.START_LEVEL
-    response.headers['END_LEVEL'] = relay_settings.END_LEVEL
-    response.headers['AUTO_OFF'] = relay_settings.AUTO_OFF
-    response.headers['AUTO_ON'] = relay_settings.AUTO_ON
-    response.headers['MIN_FLOW_MM_X_MIN'] = relay_settings.MIN_FLOW_MM_X_MIN
+    for name, value in snapshot.headers.items():
+        response.headers[name] = value
     response.headers['ACTION'] = raction
-    response.headers['BLIND_DISTANCE'] = relay_settings.BLIND_DISTANCE
-    response.headers['HOURS_OFF'] = relay_settings.HOURS_OFF or '-'
-
-    if sensor_key != 'none' and sensor_key:
-        cache_key = f'tin-keys/{sensor_key}'
-        sensor_data = redis_client.get(cache_key)
-
-        distance = 0
-        rtime = 0
-        if sensor_data:
-            distance, rtime, voltage, rssi = sensor_data.split("|")
-
-        sensor_device_id = db.DevicesDB.load_device_id_by_public_key(sensor_key)
-        sensor_settings = db.DevicesDB.load_device_settings(device_id=sensor_device_id, device_type=1)
-        percent = 0
-        if sensor_settings:
-            EMPTY_LEVEL = sensor_settings.EMPTY_LEVEL
-            TOP_MARGIN = sensor_settings.TOP_MARGIN
-            WIFI_POOL_TIME = sensor_settings.WIFI_POOL_TIME
-            distance = int(distance)
-
-            if EMPTY_LEVEL == 0:
-                EMPTY_LEVEL = 1
-            percent = min(100, 100 - min(100, int(((distance - TOP_MARGIN) * 100.0) / ((EMPTY_LEVEL - TOP_MARGIN)))))
-
-            response.headers['percent'] = int(percent)
-            response.headers['event-time'] = int(rtime)
-            response.headers['current-time'] = int(time.time())
-            response.headers['distance'] = int(distance)
-            response.headers['pool-time'] = int(WIFI_POOL_TIME)
+
+    if sensor_level:
+        percent, distance, rtime, _ = sensor_level
+        response.headers['percent'] = percent
+        response.headers['event-time'] = rtime
+        response.headers['current-time'] = int(time.time())
+        response.headers['distance'] = distance
+        response.headers['pool-time'] = int(sensor_settings.WIFI_POOL_TIME)
 
     return response
 
 
+def relay_sensor_level(sensor_key, sensor_settings, pushed_level, sensor_data):
+    """Return the linked sensor level reported to a relay.
+
+    Uses the level pushed by `/update` when it belongs to the linked sensor,
+    otherwise derives it from the sensor live state (first heartbeat after a
+    relink or a settings change, or after the pushed value expired).
+
+    Args:
+        sensor_key: Linked sensor public key.
+        sensor_settings: Linked sensor settings.
+        pushed_level: `relay-sensor/<relay>` value or None.
+        sensor_data: `tin-keys/<sensor>` value or None.
+
+    Returns:
+        tuple[int, int, int, float | None]: `(percent, distance, event_time,
+        liters)`; liters is None until the sensor has reported.
+    """
+    if pushed_level:
+        parts = pushed_level.split('|')
+        if len(parts) == 5 and parts[0] == sensor_key:
+            try:
+                return int(parts[1]), int(parts[2]), int(parts[3]), float(parts[4])
+            except ValueError:
+                pass
+
+    distance = 0
+    rtime = 0
+    liters = None
+    if sensor_data:
+        distance, rtime, _, _ = sensor_data.split("|")
+        _, _, liters = tank_level.settings_levels(sensor_settings, distance)
+        liters = round(liters, 4)
+    distance = int(distance)
+    percent = tank_level.level_percent(distance, sensor_settings.EMPTY_LEVEL, sensor_settings.TOP_MARGIN)
+    return int(percent), distance, int(rtime), liters
+
+
 def get_relay_action(public_key):
     # 0-neutral, 1-on, -1-off
-    """Read pending relay action command from Redis for a device.
+    """Read the relay command a heartbeat would receive next, without taking it.
 
     Args:
-        public_key: Relay public key used to build the Redis action key.
+        public_key: Relay public key.
 
     Returns:
         int: Action value (`0` neutral, `1` on, `-1` off).
     """
-    rkey = f'relay_action/{public_key}'
-    raction = redis_client.get(rkey)
-    if raction:
-        return int(raction)
-    return 0
+    return relay_commands.peek(public_key)
 
 
 def set_relay_action(public_key, action=1):
     # 0-neutral, 1-on, -1-off
-    """Persist relay action command in Redis for device pickup.
+    """Queue a relay on/off command for device pickup.
 
     Args:
-        public_key: Relay public key used to build the Redis action key.
-        action: Desired action (`0` neutral, `1` on, `-1` off).
+        public_key: Relay public key.
+        action: Desired action (`1` on, `-1` off).
 
     Returns:
         None.
     """
-    rkey = f'relay_action/{public_key}'
-    redis_client.set(rkey, action)
+    relay_commands.issue(public_key, action)
 
 
 if __name__ == '__main__':
+    migrations.ensure_current()
     #app.run(ssl_context=('cert.pem', 'key.pem'), host='0.0.0.0', port=443, debug=True)
     app.run(debug=True, port=88)
 
@@ -24,7 +24,15 @@ from flask_babel import lazy_gettext as _l
 import requests
 import settings
 import email_tools
+import http_cache
 import twilio_sms
+import device_cache
+import sensor_history
+import rate_limit
+import relay_commands
+import relay_reports
+import relay_scheduler
+import tank_level
 
 import bleach
 from email_validator import validate_email, EmailNotValidError
@@ -51,6 +59,7 @@ def setup_logger():
 setup_logger()
 
 import db
+import migrations
 app = Flask(__name__)
 app.config['SECRET_KEY'] = settings.APP_SEC_KEY
 app.config['REMEMBER_COOKIE_DURATION'] = timedelta(days=30)  # Example: 30 days
@@ -202,9 +211,25 @@ redis_client = redis.StrictRedis(
     decode_responses=True
 )
 
+# Packed sensor history is binary: read it with a client that keeps bytes.
+history_redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.WEB_REDIS_DB,
+    decode_responses=False
+)
+
 DOMAIN = settings.APP_DOMAIN
 API_URL = settings.API_DOMAIN
 RELEASE_VERSION = "1.0.8"
+# Longest window accepted by the admin `relay-events-query` action.
+RELAY_EVENTS_QUERY_MAX_HOURS = 24 * 90
+# Most buckets returned by one `/sensor_stats_buckets` request (5-minute buckets over 3 days = 864).
+SENSOR_STATS_MAX_BUCKETS = 1000
+# Relays accepted by one `/relay_bulk_action` request.
+RELAY_BULK_MAX = 200
+# Devices accepted by one `/devices_status` request.
+DEVICES_STATUS_MAX = 500
 
 
 @app.context_processor
@@ -311,7 +336,9 @@ def sensor_stats():
     - public_key: sensor public key or 'demo'
 
     Returns JSON with 24 hourly buckets (oldest first) containing either
-    `percent` and `voltage` (averages) or `offline: true` when no data.
+    `percent` and `voltage` (averages, plus `samples` count and
+    `*_min`/`*_max`/`*_last`) or `offline: true` when no data. Values come
+    from the per-hour rollups maintained at ingest time.
     """
     key = request.args.get('public_key')
     if not key:
@@ -320,54 +347,42 @@ def sensor_stats():
     if key == 'demo':
         key = settings.DEMO_S1_PUB_KEY
 
-    history_key = f'tin-history/{key}'
     now = int(time.time())
     # Align buckets to hour boundaries and include the current hour
     # Use the next hour boundary as the end so the 24 buckets cover the
     # last 24 one-hour windows including the current hour.
     end = (now - (now % 3600)) + 3600
     start = end - 24 * 3600
+    hour_starts = [start + i * 3600 for i in range(24)]
 
-    buckets = []
-    for i in range(24):
-        bucket_start = start + i * 3600
-        bucket_end = bucket_start + 3599
-        try:
-            items = redis_client.zrangebyscore(history_key, bucket_start, bucket_end)
-        except Exception:
-            items = []
+    try:
+        summaries = sensor_history.read_summaries(history_redis_client, key, hour_starts, legacy_client=redis_client)
+    except Exception:
+        summaries = {}
 
-        if not items:
+    buckets = []
+    for bucket_start in hour_starts:
+        summary = summaries.get(bucket_start)
+        if not summary:
             buckets.append({
                 'hour_start': bucket_start,
                 'offline': True
             })
             continue
 
-        # parse items "percent|voltage" (legacy) or
-        # "percent|voltage|unique_suffix" (current)
-        percents = []
-        volts = []
-        for it in items:
-            try:
-                parts = it.split('|')
-                if len(parts) < 2:
-                    continue
-                p, v = parts[0], parts[1]
-                percents.append(float(p))
-                volts.append(float(v))
-            except Exception:
-                continue
-
         # Return integer percent values (no decimals) for frontend charts
-        avg_percent = int(round(sum(percents) / len(percents))) if percents else None
-        avg_voltage = round(sum(volts) / len(volts), 2) if volts else None
-
         buckets.append({
             'hour_start': bucket_start,
             'offline': False,
-            'percent': avg_percent,
-            'voltage': avg_voltage
+            'percent': int(round(summary['percent_avg'])),
+            'voltage': round(summary['voltage_avg'], 2),
+            'samples': summary['count'],
+            'percent_min': int(round(summary['percent_min'])),
+            'percent_max': int(round(summary['percent_max'])),
+            'percent_last': int(round(summary['percent_last'])),
+            'voltage_min': round(summary['voltage_min'], 2),
+            'voltage_max': round(summary['voltage_max'], 2),
+            'voltage_last': round(summary['voltage_last'], 2),
         })
 
     return jsonify({'buckets': buckets})
@@ -396,35 +411,133 @@ def sensor_stats_hour():
     if key == 'demo':
         key = settings.DEMO_S1_PUB_KEY
 
-    history_key = f'tin-history/{key}'
-    bucket_start = hour_start
-    bucket_end = bucket_start + 3599
+    bucket_start = sensor_history.hour_start(hour_start)
 
     try:
-        items = redis_client.zrangebyscore(history_key, bucket_start, bucket_end, withscores=True)
+        history = sensor_history.read_hours(history_redis_client, key, [bucket_start], legacy_client=redis_client)
     except Exception:
-        items = []
+        history = {}
 
-    samples = []
-    for member, score in items:
-        try:
-            parts = member.split('|')
-            if len(parts) < 2:
-                continue
-            p, v = parts[0], parts[1]
-            samples.append({
-                'ts': int(score),
-                'percent': float(p),
-                'voltage': float(v)
-            })
-        except Exception:
-            continue
+    samples = [{
+        'ts': ts,
+        'percent': float(percent),
+        'voltage': float(voltage)
+    } for ts, percent, voltage in history.get(bucket_start, [])]
 
     # sort by timestamp ascending
     samples.sort(key=lambda x: x['ts'])
     return jsonify({'samples': samples})
 
 
+@app.route('/sensor_stats_buckets', methods=['GET'])
+def sensor_stats_buckets():
+    """Return sensor stats for a range at the requested bucket width.
+
+    Query params:
+    - public_key: sensor public key or 'demo'
+    - start/end: epoch seconds (default the last 24 hours); limited to the
+      raw history retention (`sensor_history.RETENTION_SECONDS`)
+    - bucket: `5m`, `15m`, `1h` or `1d` (default `1h`); buckets are aligned
+      to multiples of the width
+    - agg: comma separated subset of avg,min,max,last,count (default all)
+
+    Response: JSON with `buckets` (oldest first), each with `start` and
+    either `offline: true` or the requested `percent_*`/`voltage_*`/`count`.
+    """
+    key = request.args.get('public_key')
+    if not key:
+        return jsonify({'error': 'missing public_key'}), 400
+
+    if key == 'demo':
+        key = settings.DEMO_S1_PUB_KEY
+
+    bucket = request.args.get('bucket', '1h')
+    width = sensor_history.BUCKET_WIDTHS.get(bucket)
+    aggregations = [name.strip() for name in request.args.get('agg', ','.join(sensor_history.AGGREGATIONS)).split(',')
+                    if name.strip()]
+    if not width or not aggregations or any(name not in sensor_history.AGGREGATIONS for name in aggregations):
+        return jsonify({'error': 'invalid bucket or agg'}), 400
+
+    now = int(time.time())
+    try:
+        end = int(request.args.get('end', now))
+        start = int(request.args.get('start', end - 24 * 3600))
+    except Exception:
+        return jsonify({'error': 'invalid range'}), 400
+    start = max(start, now - sensor_history.RETENTION_SECONDS)
+    start -= start % width
+    end = min(end, now)
+    end += -end % width
+    bucket_count = (end - start) // width
+    if bucket_count <= 0 or bucket_count > SENSOR_STATS_MAX_BUCKETS:
+        return jsonify({'error': 'invalid range'}), 400
+
+    # One pipelined read of every history hour in the range.
+    hour_starts = range(sensor_history.hour_start(start), end, sensor_history.HOUR_SECONDS)
+    try:
+        history = sensor_history.read_hours(history_redis_client, key, hour_starts, legacy_client=redis_client)
+    except Exception:
+        history = {}
+    samples = [sample for hour_ts in sorted(history) for sample in history[hour_ts]]
+
+    buckets = []
+    stats = sensor_history.bucket_stats(samples, start, width, bucket_count, aggregations)
+    for index, values in enumerate(stats):
+        bucket_start = start + index * width
+        if values is None:
+            buckets.append({'start': bucket_start, 'offline': True})
+            continue
+        buckets.append({'start': bucket_start, 'offline': False,
+                        **{name: round(value, 2) for name, value in values.items()}})
+
+    return jsonify({'start': start, 'end': end, 'bucket': bucket, 'aggregations': aggregations, 'buckets': buckets})
+
+
+@app.route('/sensor_history_range', methods=['GET'])
+def sensor_history_range():
+    """Return long-term sensor history from the SQLite hourly/daily tier.
+
+    Query params:
+    - public_key: sensor public key or 'demo'
+    - start/end: optional epoch seconds window
+    - days: trailing window in days when start/end are not given (default 30)
+
+    Response: JSON with `resolution` (`hour` or `day`, the coarsest that
+    keeps the window within `SENSOR_HISTORY_MAX_POINTS`) and `points`.
+    """
+    key = request.args.get('public_key')
+    if not key:
+        return jsonify({'error': 'missing public_key'}), 400
+
+    if key == 'demo':
+        key = settings.DEMO_S1_PUB_KEY
+
+    now = int(time.time())
+    try:
+        if request.args.get('start') is not None or request.args.get('end') is not None:
+            start = int(request.args.get('start', 0))
+            end = int(request.args.get('end', now))
+        else:
+            days = max(1, min(3660, int(request.args.get('days', 30))))
+            end = now
+            start = now - days * 86400
+    except Exception:
+        return jsonify({'error': 'invalid range'}), 400
+    if end <= start:
+        return jsonify({'error': 'invalid range'}), 400
+
+    sensor_id = db.DevicesDB.load_device_id_by_public_key(key)
+    if not sensor_id:
+        return jsonify({'error': 'invalid public_key'}), 404
+
+    resolution = sensor_history.pick_resolution(
+        start, end, settings.SENSOR_HISTORY_MAX_POINTS,
+        now - settings.SENSOR_HOURLY_RETENTION_DAYS * 86400
+    )
+    points = db.DevicesDB.get_sensor_history_range(sensor_id, start, end, resolution)
+    return jsonify({'resolution': resolution, 'start': start, 'end': end, 'points': points})
+
+
 @app.route('/relay_consumption_stats', methods=['GET'])
 def relay_consumption_stats():
     """Return relay daily stats with estimated costs/energy for a selected period.
@@ -433,6 +546,10 @@ def relay_consumption_stats():
     - public_key: relay public key or 'demorelay'
     - month: optional YYYY-MM (defaults to current month)
     - start_date/end_date: optional YYYY-MM-DD custom range (both required)
+    - year: optional YYYY; returns one summary row per month (`months`) instead of days
+
+    Settled days come from cached month reports (`relay_reports`); only the
+    days still being counted are read from SQLite and Redis.
     """
     key = request.args.get('public_key')
     if not key:
@@ -452,11 +569,23 @@ def relay_consumption_stats():
     start_date_param = (request.args.get('start_date') or '').strip()
     end_date_param = (request.args.get('end_date') or '').strip()
 
+    year_param = (request.args.get('year') or '').strip()
+
     range_mode = 'month'
     period_start = None
     period_end = None
 
-    if start_date_param or end_date_param:
+    if year_param:
+        try:
+            year = int(year_param)
+            period_start = datetime(year, 1, 1).date()
+        except ValueError:
+            return jsonify({'error': 'invalid year, expected YYYY'}), 400
+        if period_start > today:
+            return jsonify({'error': 'year is in the future'}), 400
+        period_end = min(datetime(year, 12, 31).date(), today)
+        range_mode = 'year'
+    elif start_date_param or end_date_param:
         if not start_date_param or not end_date_param:
             return jsonify({'error': 'start_date and end_date are both required'}), 400
         try:
@@ -489,71 +618,34 @@ def relay_consumption_stats():
         period_start = month_start
         period_end = today if (month_start.year == today.year and month_start.month == today.month) else month_end
 
-    supported_currency_codes = {
-        'USD', 'DOP', 'EUR', 'MXN', 'COP', 'ARS', 'CLP', 'PEN', 'INR', 'CNY'
+    relay_settings = db.DevicesDB.load_device_settings(relay_info.id, 3)
+    rates = relay_reports.resolve_rates(relay_settings)
+    water_cost_per_m3, relay_power_watts, energy_cost_per_kwh, currency_code = rates
+    settings_payload = {
+        'water_cost_per_m3': round(water_cost_per_m3, 4),
+        'relay_power_watts': round(relay_power_watts, 2),
+        'energy_cost_per_kwh': round(energy_cost_per_kwh, 4),
+        'currency_code': currency_code
     }
 
-    relay_settings = db.DevicesDB.load_device_settings(relay_info.id, 3)
-    water_cost_per_m3 = float(settings.DEFAULT_WATER_COST_PER_M3)
-    relay_power_watts = float(settings.DEFAULT_RELAY_POWER_WATTS)
-    energy_cost_per_kwh = float(settings.DEFAULT_ENERGY_COST_PER_KWH)
-    currency_code = str(settings.DEFAULT_RELAY_CURRENCY).upper()
-    if relay_settings:
-        try:
-            water_cost_per_m3 = float(relay_settings.get('WATER_COST_PER_M3', water_cost_per_m3) or water_cost_per_m3)
-        except Exception:
-            water_cost_per_m3 = float(settings.DEFAULT_WATER_COST_PER_M3)
-        try:
-            relay_power_watts = float(relay_settings.get('RELAY_POWER_WATTS', relay_power_watts) or relay_power_watts)
-        except Exception:
-            relay_power_watts = float(settings.DEFAULT_RELAY_POWER_WATTS)
-        try:
-            energy_cost_per_kwh = float(relay_settings.get('ENERGY_COST_PER_KWH', energy_cost_per_kwh) or energy_cost_per_kwh)
-        except Exception:
-            energy_cost_per_kwh = float(settings.DEFAULT_ENERGY_COST_PER_KWH)
-        try:
-            currency_candidate = str(relay_settings.get('CURRENCY_CODE', currency_code) or currency_code).strip().upper()
-            if currency_candidate in supported_currency_codes:
-                currency_code = currency_candidate
-        except Exception:
-            currency_code = str(settings.DEFAULT_RELAY_CURRENCY).upper()
-
-    if water_cost_per_m3 <= 0:
-        water_cost_per_m3 = float(settings.DEFAULT_WATER_COST_PER_M3)
-    if relay_power_watts <= 0:
-        relay_power_watts = float(settings.DEFAULT_RELAY_POWER_WATTS)
-    if energy_cost_per_kwh <= 0:
-        energy_cost_per_kwh = float(settings.DEFAULT_ENERGY_COST_PER_KWH)
-
-    days = db.DevicesDB.get_relay_daily_stats(
-        relay_info.id,
-        start_date=period_start,
-        end_date=period_end
-    )
-    enriched_days = []
-    for item in days:
-        liters = float(item.get('liters', 0.0) or 0.0)
-        on_minutes = int(item.get('on_minutes', 0) or 0)
-
-        water_m3 = liters / 1000.0
-        water_cost = water_m3 * water_cost_per_m3
-
-        on_hours = on_minutes / 60.0
-        energy_kwh = (relay_power_watts * on_hours) / 1000.0
-        energy_cost = energy_kwh * energy_cost_per_kwh
-        energy_wh = relay_power_watts * on_hours
-
-        enriched_days.append({
-            'day': item.get('day'),
-            'on_minutes': on_minutes,
-            'liters': round(liters, 2),
-            'water_cost': round(water_cost, 4),
-            'energy_cost': round(energy_cost, 4),
-            'energy_wh': round(energy_wh, 2)
+    if range_mode == 'year':
+        year_data = relay_reports.year_report(relay_info.id, period_start.year, period_end, rates)
+        return jsonify({
+            'months': year_data['months'],
+            'totals': year_data['totals'],
+            'period': {
+                'mode': range_mode,
+                'start_date': period_start.strftime('%Y-%m-%d'),
+                'end_date': period_end.strftime('%Y-%m-%d'),
+                'year': period_start.year
+            },
+            'settings': settings_payload
         })
 
+    report = relay_reports.report(relay_info.id, period_start, period_end, rates)
     return jsonify({
-        'days': enriched_days,
+        'days': report['days'],
+        'totals': report['totals'],
         'period': {
             'mode': range_mode,
             'start_date': period_start.strftime('%Y-%m-%d'),
@@ -565,12 +657,7 @@ def relay_consumption_stats():
                 period_start.month == today.month
             )
         },
-        'settings': {
-            'water_cost_per_m3': round(water_cost_per_m3, 4),
-            'relay_power_watts': round(relay_power_watts, 2),
-            'energy_cost_per_kwh': round(energy_cost_per_kwh, 4),
-            'currency_code': currency_code
-        }
+        'settings': settings_payload
     })
 
 
@@ -841,6 +928,27 @@ def admin_dashboard():
             return jsonify(db.User.get_all_users())
         if action == 'list-users-support' and is_admin:
             return jsonify(db.Support.get_all_users_support())
+        if action == 'device-cache-stats' and is_admin:
+            return jsonify(device_cache.load_published_stats())
+        if action == 'rate-limit-stats' and is_admin:
+            return jsonify(rate_limit.stats())
+        if action == 'relay-command-stats' and is_admin:
+            return jsonify(relay_commands.stats())
+        if action == 'relay-events-query' and is_admin:
+            # Relays that reported any of `events` (codes or names, comma separated) in the last `hours`.
+            mask = db.relay_events_mask(request.form.get('events', ''))
+            if not mask:
+                return jsonify({'error': 'unknown events'}), 400
+            try:
+                hours = max(1, min(int(request.form.get('hours', 24)), RELAY_EVENTS_QUERY_MAX_HOURS))
+            except ValueError:
+                hours = 24
+            since = datetime.now() - timedelta(hours=hours)
+            return jsonify({
+                'events': [db.RELAY_EVENT_NAMES[code] for code in db.relay_events_codes(mask)],
+                'hours': hours,
+                'relays': db.DevicesDB.find_relays_with_events(mask, since),
+            })
         if action in ['add-sensor', 'add-relay']:
             private_key = request.form.get("private_key")
             public_key = request.form.get("public_key")
@@ -1118,10 +1226,8 @@ def device_info(lang='en'):
         if PAST_EVENTS:
             for event in PAST_EVENTS:
                 current_event = f"<b>{event['created_at']} GMT-4</b>: "
-                for event_code in event['events'].split(","):
-                    event_code = int(event_code)
-                    if event_code != 0:
-                        current_event = current_event + f"<span class='badge text-bg-info fw-bold mx-2 my-2'>{get_relay_event_text(event_code)}</span>"
+                for event_code in db.relay_events_codes(event['mask']):
+                    current_event = current_event + f"<span class='badge text-bg-info fw-bold mx-2 my-2'>{get_relay_event_text(event_code)}</span>"
                 DISPLAY_EVENTS.append(current_event)
 
     if is_demo:
@@ -1182,6 +1288,7 @@ def device_admin():
     if is_admin and action == 'cache-clear':
         redis_client.flushall()
         cache.clear()
+        device_cache.invalidate_all()
         flash("REDIS CACHE FLUSH SENT", category='danger')
         return redirect(url_for('admin_dashboard'))
 
@@ -1337,6 +1444,10 @@ def device_admin():
                         return redirect(url_for('device_info') + '?public_key=' + public_key)
 
                 if db.DevicesDB.update_sensor_settings(device_id, EMPTY_LEVEL, TOP_MARGIN, WIFI_POOL_TIME, LITERS_PER_CM):
+                    # Levels pushed to linked relays used the old tank geometry.
+                    relay_keys = db.DevicesDB.load_sensor_relays(public_key)
+                    if relay_keys:
+                        redis_client.delete(*[f'relay-sensor/{relay_key}' for relay_key in relay_keys])
                     flash("Setting update success", category='success')
                     return redirect(url_for('device_info')+'?public_key='+public_key)
                 else:
@@ -1348,6 +1459,85 @@ def device_admin():
 
 
 
+@app.route('/relay_bulk_action', methods=['POST'])
+@login_required
+def relay_bulk_action():
+    """Send one on/off action to a set of relays.
+
+    The relays are given as `public_keys` (repeated or comma separated) or
+    as a `group` of the user's relays named `<group>/...`. The user must be
+    able to administer every relay; nothing is sent otherwise.
+
+    Returns:
+        flask.Response: JSON with the relays commanded, or the error.
+    """
+    action = request.form.get("action")
+    if action not in ["on", "off"]:
+        return jsonify({'status': "fail unknown action"}), 400
+
+    group = request.form.get("group", '').strip()
+    if group:
+        permissions = db.DevicesDB.user_relay_permissions(current_user.id, group=group)
+        public_keys = sorted(permissions)
+    else:
+        public_keys = []
+        for value in request.form.getlist("public_keys"):
+            public_keys.extend(key.strip() for key in value.split(',') if key.strip())
+        public_keys = sorted(set(public_keys))
+        permissions = db.DevicesDB.user_relay_permissions(current_user.id, public_keys=public_keys)
+
+    if not public_keys:
+        return jsonify({'status': "fail no relays"}), 400
+    if len(public_keys) > RELAY_BULK_MAX:
+        return jsonify({'status': f"fail more than {RELAY_BULK_MAX} relays"}), 400
+    unknown = [key for key in public_keys if key not in permissions]
+    if unknown:
+        return jsonify({'status': "fail unknown relays", 'public_keys': unknown}), 404
+    denied = [key for key in public_keys if not (current_user.is_admin or permissions[key])]
+    if denied:
+        return jsonify({'status': "fail not allowed", 'public_keys': denied}), 403
+
+    relay_commands.issue_many({key: 1 if action == "on" else -1 for key in public_keys})
+    return jsonify({'status': "success", 'action': action, 'public_keys': public_keys})
+
+
+
+@app.route('/relay_schedule', methods=['GET', 'POST'])
+@login_required
+def relay_schedule():
+    """List, add or delete server-side scheduled actions of a relay.
+
+    POST `action=add` takes `at` (`HH:MM`), `timezone` (IANA name the time
+    is in, e.g. `America/Santo_Domingo`; UTC when omitted), `duration`
+    (minutes, optional) and `relay_action` (`on`/`off`); `action=delete`
+    takes `schedule_id`. Listed schedules carry their `timezone`.
+
+    Returns:
+        flask.Response: JSON with the relay schedules, or the error.
+    """
+    public_key = request.values.get("public_key", '')
+    if not public_key or not (current_user.is_admin or current_user.can_admin_device(public_key)):
+        return jsonify({'status': "fail not allowed"}), 403
+
+    if request.method == 'POST':
+        action = request.form.get("action")
+        if action == 'add':
+            try:
+                relay_scheduler.add(public_key, request.form.get("at", ''),
+                                    duration_minutes=int(request.form.get("duration") or 0),
+                                    action=-1 if request.form.get("relay_action") == "off" else 1,
+                                    tz=request.form.get("timezone") or relay_scheduler.DEFAULT_TIMEZONE)
+            except ValueError as ex:
+                return jsonify({'status': f"fail {ex}"}), 400
+        elif action == 'delete':
+            if not relay_scheduler.remove(public_key, request.form.get("schedule_id", '')):
+                return jsonify({'status': "fail unknown schedule"}), 404
+        else:
+            return jsonify({'status': "fail unknown action"}), 400
+    return jsonify({'status': "success", 'schedules': relay_scheduler.list_schedules(public_key),
+                    'default_timezone': relay_scheduler.DEFAULT_TIMEZONE})
+
+
 @app.route('/data-api', methods=['GET'])
 def get_device_data():
     """Return device chart and status data as JSON for dashboard polling.
@@ -1406,39 +1596,96 @@ def get_device_data():
         except Exception:
             pass
 
-    # Compute current liters if we have the necessary values
-    current_liters = None
-    water_height_cm = None
-    try:
-        dist_val = float(distance)
-        if empty_level is not None and top_margin is not None:
-            if dist_val > empty_level:
-                dist_val = empty_level
-            if dist_val < top_margin:
-                dist_val = top_margin
-            water_height_cm = empty_level - dist_val
-            if water_height_cm < 0:
-                water_height_cm = 0
-            current_liters = round(water_height_cm * liters_per_cm, 2)
-    except Exception:
-        # keep current_liters as None if parsing fails
-        pass
+    def build():
+        # Compute current liters if we have the necessary values
+        current_liters = None
+        water_height_cm = None
+        try:
+            if empty_level is not None and top_margin is not None:
+                water_height_cm = tank_level.water_height_cm(distance, empty_level, top_margin)
+                current_liters = round(water_height_cm * liters_per_cm, 2)
+        except Exception:
+            # keep current_liters as None if parsing fails
+            pass
 
-    data = {
-        'distance': distance,
-        'rtime': rtime,
-        'skey': key,
-        'device_setting': srv_sett,
-        'diff_time': diff_time,
-        'voltage': round(voltage, 2),
-        'rssi': rssi,
-        'liters_per_cm': liters_per_cm,
-        'empty_level': empty_level,
-        'top_margin': top_margin,
-        'water_height_cm': water_height_cm,
-        'current_liters': current_liters
-    }
-    return jsonify(data)
+        return {
+            'distance': distance,
+            'rtime': rtime,
+            'skey': key,
+            'device_setting': srv_sett,
+            'diff_time': diff_time,
+            'voltage': round(voltage, 2),
+            'rssi': rssi,
+            'liters_per_cm': liters_per_cm,
+            'empty_level': empty_level,
+            'top_margin': top_margin,
+            'water_height_cm': water_height_cm,
+            'current_liters': current_liters
+        }
+
+    # The settings in effect act as the settings version: editing them changes the validator.
+    return http_cache.conditional_json((key, result, srv_sett, liters_per_cm, empty_level, top_margin), build)
+
+
+def device_status(sensor_state, relay_state, now):
+    """Build the compact live status of one device.
+
+    Args:
+        sensor_state: `tin-keys/<public_key>` value ("distance|epoch|centivolts|rssi") or None.
+        relay_state: `relay-keys/<public_key>` value ("status|epoch|rssi") or None.
+        now: Current epoch seconds.
+
+    Returns:
+        dict | None: `type` (`sensor`/`relay`), the live values and
+        `diff_time`; None when the device has not reported.
+    """
+    if sensor_state:
+        distance, rtime, voltage, rssi = sensor_state.split('|')
+        return {'type': 'sensor', 'distance': int(distance), 'rtime': int(rtime), 'diff_time': now - int(rtime),
+                'voltage': round(float(voltage) / 100.0, 2), 'rssi': int(rssi)}
+    if relay_state:
+        status, rtime, rssi = map(int, relay_state.split('|'))
+        return {'type': 'relay', 'status': status, 'rtime': rtime, 'diff_time': now - rtime, 'rssi': rssi}
+    return None
+
+
+@app.route('/devices_status', methods=['GET'])
+def devices_status():
+    """Return the live status of many devices in one response.
+
+    The devices are given as `public_keys` (repeated or comma separated);
+    without them the logged-in user's devices are used. Every live state
+    (`tin-keys` and `relay-keys`) is read with a single MGET.
+
+    Returns:
+        flask.Response: JSON `{"now": ..., "devices": {public_key: status | null}}`.
+    """
+    public_keys = []
+    for value in request.args.getlist('public_keys'):
+        public_keys.extend(key.strip() for key in value.split(',') if key.strip())
+    if not public_keys:
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'missing public_keys'}), 401
+        public_keys = [row.public_key for row in current_user.get_devices() if row.public_key]
+    public_keys = sorted(set(public_keys))
+    if len(public_keys) > DEVICES_STATUS_MAX:
+        return jsonify({'error': f'more than {DEVICES_STATUS_MAX} devices'}), 400
+
+    states = redis_client.mget([f'{prefix}/{key}' for key in public_keys for prefix in ('tin-keys', 'relay-keys')]) \
+        if public_keys else []
+
+    def build():
+        now = int(time.time())
+        devices = {}
+        for index, key in enumerate(public_keys):
+            try:
+                devices[key] = device_status(states[2 * index], states[2 * index + 1], now)
+            except ValueError:
+                logging.warning(f"devices-status: bad live state for {key}")
+                devices[key] = None
+        return {'now': now, 'devices': devices}
+
+    return http_cache.conditional_json((*public_keys, *states), build)
 
 
 @app.route('/ping')
@@ -1733,5 +1980,6 @@ def short(short_code):
 
 
 if __name__ == '__main__':
+    migrations.ensure_current()
     #app.run(ssl_context=('./ext_conf/cloudflare/cert.pem', './ext_conf/cloudflare/key.pem'), host='0.0.0.0', port=443, debug=True)
     app.run(debug=True, port=80)
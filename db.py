@@ -2,10 +2,11 @@ import time
 import re
 import datetime
 
-from sqlalchemy import create_engine, Column, Integer, String, text, inspect
+from sqlalchemy import create_engine, Column, Integer, String, text, inspect, bindparam
 from flask_login import UserMixin
 from flask_caching import Cache
 import settings
+import device_cache
 import logging
 class AttrDict(dict):
     """Dictionary that supports attribute access and `.get()` like a normal dict.
@@ -26,6 +27,49 @@ class AttrDict(dict):
 engine = create_engine(settings.DATABASE_URL, echo=False)
 cache = Cache(config=settings.API_CACHE_SETT)
 
+# Relay settings sent verbatim as `/relay-update` response headers.
+RELAY_SETTINGS_HEADERS = ('ALGO', 'SAFE_MODE', 'START_LEVEL', 'END_LEVEL', 'AUTO_OFF', 'AUTO_ON',
+                          'MIN_FLOW_MM_X_MIN', 'BLIND_DISTANCE')
+
+# Applied write-behind batch tokens are kept this long (a retried batch is at most minutes old).
+WRITE_BATCH_TOKEN_DAYS = 7
+
+# Relay event codes reported in the `EVENTS` header (bit `1 << code` in `relay_events.mask`).
+RELAY_EVENT_NAMES = {
+    1: "BLIND_AREA", 2: "BLIND_AREA_DANGER", 3: "NOT_FLOW", 4: "OFFLINE", 5: "IDDLE_SENSOR",
+    6: "END_LEVEL_EVENT", 7: "START_LEVEL_EVENT", 8: "SETUP_WIFI", 9: "BOOT", 10: "PUMP_ON",
+    11: "PUMP_OFF", 12: "DATA_POST_FAIL", 13: "BTN_PRESS", 14: "SENSOR_FAULT",
+}
+
+
+def relay_events_mask(events):
+    """Encode a relay events CSV (or iterable of codes/names) as a bitmask.
+
+    Code 0 (no event) and unknown codes or names are ignored.
+
+    Args:
+        events: CSV such as `"2,14,0,0,0"`, or codes/names like `["SENSOR_FAULT", 2]`.
+
+    Returns:
+        int: OR of `1 << code` over the known reported codes.
+    """
+    if isinstance(events, str):
+        events = events.split(',')
+    codes_by_name = {name: code for code, name in RELAY_EVENT_NAMES.items()}
+    mask = 0
+    for item in events:
+        item = str(item).strip()
+        code = int(item) if item.isdigit() else codes_by_name.get(item.upper())
+        if code in RELAY_EVENT_NAMES:
+            mask |= 1 << code
+    return mask
+
+
+def relay_events_codes(mask):
+    """Decode a relay events bitmask into ascending event codes."""
+    mask = int(mask or 0)
+    return [code for code in RELAY_EVENT_NAMES if mask & (1 << code)]
+
 
 @cache.memoize(300)
 def get_user_by_id(id):
@@ -346,7 +390,7 @@ class DevicesDB:
         return True
 
     @staticmethod
-    @cache.memoize(600)
+    @device_cache.tiered(cache, 600)
     def valid_private_key(private_key):
         connection = engine.connect()
 
@@ -375,7 +419,7 @@ class DevicesDB:
             return row
 
     @staticmethod
-    @cache.memoize(3000)
+    @device_cache.tiered(cache, 3000)
     def load_device_id_by_public_key(public_key):
         connection = engine.connect()
 
@@ -403,7 +447,7 @@ class DevicesDB:
             return row
 
     @staticmethod
-    @cache.memoize(300)
+    @device_cache.tiered(cache, 300)
     def load_device_settings(device_id, device_type=1):
         if device_type == 3:
             return DevicesDB.load_relay_settings(device_id)
@@ -448,9 +492,6 @@ class DevicesDB:
     @staticmethod
     @cache.memoize(300)
     def load_relay_settings(device_id):
-        table_exists = DevicesDB.ensure_relay_settings_extra_fields()
-        if not table_exists:
-            return None
         connection = engine.connect()
 
         query = "SELECT * FROM relay_settings WHERE device = :device_id"
@@ -476,42 +517,6 @@ class DevicesDB:
                         return row
             return AttrDict(row_dict)
 
-    @staticmethod
-    def ensure_relay_settings_extra_fields():
-        """Ensure relay_settings has optional cost/energy columns.
-
-        Adds backward-compatible columns when running on existing databases.
-        """
-        sql_columns = "PRAGMA table_info(relay_settings)"
-        expected_columns = {
-            "WATER_COST_PER_M3": f"REAL NOT NULL DEFAULT {float(settings.DEFAULT_WATER_COST_PER_M3)}",
-            "RELAY_POWER_WATTS": f"REAL NOT NULL DEFAULT {float(settings.DEFAULT_RELAY_POWER_WATTS)}",
-            "ENERGY_COST_PER_KWH": f"REAL NOT NULL DEFAULT {float(settings.DEFAULT_ENERGY_COST_PER_KWH)}",
-            "CURRENCY_CODE": f"TEXT NOT NULL DEFAULT '{settings.DEFAULT_RELAY_CURRENCY}'"
-        }
-
-        with engine.connect() as connection:
-            table_row = connection.execute(
-                text("SELECT name FROM sqlite_master WHERE type='table' AND name='relay_settings'")
-            ).fetchone()
-            if not table_row:
-                return False
-
-            result = connection.execute(text(sql_columns))
-            existing = {row[1] for row in result.fetchall()}
-            result.close()
-
-            changed = False
-            for col_name, col_sql in expected_columns.items():
-                if col_name not in existing:
-                    connection.execute(text(f"ALTER TABLE relay_settings ADD COLUMN {col_name} {col_sql}"))
-                    changed = True
-
-            if changed:
-                connection.commit()
-
-        return True
-
     @staticmethod
     def update_sensor_settings(device_id, EMPTY_LEVEL=None, TOP_MARGIN=None, WIFI_POOL_TIME=None, LITERS_PER_CM=None):
         # Build dynamic query based on present fields
@@ -539,6 +544,9 @@ class DevicesDB:
             if result:
                 cache.delete_memoized(DevicesDB.load_device_settings, device_id, 1)
                 cache.delete_memoized(DevicesDB.load_device_settings, device_id, 2)
+                device_cache.invalidate('load_device_settings', device_id, 1)
+                device_cache.invalidate('load_device_settings', device_id, 2)
+                DevicesDB.invalidate_relay_snapshots(device_id)
                 return True
         return False
 
@@ -555,6 +563,8 @@ class DevicesDB:
             connection.commit()
             if result:
                 cache.delete_memoized(DevicesDB.load_device_settings, device_id, 1)
+                device_cache.invalidate('load_device_settings', device_id, 1)
+                DevicesDB.invalidate_relay_snapshots(device_id)
                 return True
         return False
 
@@ -565,9 +575,6 @@ class DevicesDB:
                               RELAY_POWER_WATTS=settings.DEFAULT_RELAY_POWER_WATTS,
                               ENERGY_COST_PER_KWH=settings.DEFAULT_ENERGY_COST_PER_KWH,
                               CURRENCY_CODE=settings.DEFAULT_RELAY_CURRENCY):
-        table_exists = DevicesDB.ensure_relay_settings_extra_fields()
-        if not table_exists:
-            return False
         sql_query = """
                 INSERT OR REPLACE INTO relay_settings 
                     (device, ALGO, START_LEVEL, END_LEVEL, AUTO_OFF, AUTO_ON, MIN_FLOW_MM_X_MIN, 
@@ -579,6 +586,9 @@ class DevicesDB:
                     :WATER_COST_PER_M3, :RELAY_POWER_WATTS, :ENERGY_COST_PER_KWH, :CURRENCY_CODE)
             """
         with engine.connect() as connection:
+            previous = connection.execute(
+                text("SELECT SENSOR_KEY FROM relay_settings WHERE device = :device"), {"device": device_id}
+            ).fetchone()
             result = connection.execute(text(sql_query), {
                 "device": device_id, "ALGO": ALGO, "START_LEVEL": START_LEVEL,
                 "END_LEVEL": END_LEVEL, "AUTO_OFF": AUTO_OFF, "AUTO_ON": AUTO_ON,
@@ -593,7 +603,13 @@ class DevicesDB:
             if result:
                 cache.delete_memoized(DevicesDB.load_device_settings, device_id, 3)
                 cache.delete_memoized(DevicesDB.load_relay_settings, device_id)
-
+                device_cache.invalidate('load_device_settings', device_id, 3)
+                DevicesDB.invalidate_relay_snapshots(device_id)
+                # Re-index both the newly linked and the previously linked sensor.
+                linked = {SENSOR_KEY, previous.SENSOR_KEY if previous else None}
+                for sensor_key in linked - {None, '', 'none'}:
+                    cache.delete_memoized(DevicesDB.load_sensor_relays, sensor_key)
+                    device_cache.invalidate('load_sensor_relays', sensor_key)
                 return True
         return False
 
@@ -612,10 +628,108 @@ class DevicesDB:
             if result:
                 cache.delete_memoized(DevicesDB.load_device_settings, device_id, 3)
                 cache.delete_memoized(DevicesDB.load_relay_settings, device_id)
-
+                device_cache.invalidate('load_device_settings', device_id, 3)
+                DevicesDB.invalidate_relay_snapshots(device_id)
                 return True
         return False
 
+    @staticmethod
+    @device_cache.tiered(cache, 300)
+    def load_relay_snapshot(private_key):
+        """Build the control snapshot served to a relay on every heartbeat.
+
+        Bundles what `/relay-update` needs besides live Redis state: relay id
+        and settings, linked sensor id and settings, and the settings header
+        block. Dropped by `invalidate_relay_snapshots` whenever the relay or
+        its linked sensor settings change.
+
+        Args:
+            private_key: Relay private key sent by the firmware.
+
+        Returns:
+            AttrDict | None: Snapshot, or None when the key is unknown or the
+            relay has no settings row.
+        """
+        public_key = DevicesDB.valid_private_key(private_key)
+        if not public_key:
+            return None
+        relay_device_id = DevicesDB.load_device_id_by_public_key(public_key)
+        relay_settings = DevicesDB.load_device_settings(device_id=relay_device_id, device_type=3)
+        if not relay_settings:
+            return None
+
+        headers = {name: str(getattr(relay_settings, name)) for name in RELAY_SETTINGS_HEADERS}
+        headers['HOURS_OFF'] = relay_settings.HOURS_OFF or '-'
+        snapshot = AttrDict({
+            'public_key': public_key,
+            'relay_device_id': relay_device_id,
+            'relay_settings': relay_settings,
+            'headers': headers,
+            'sensor_key': None,
+            'sensor_device_id': None,
+            'sensor_settings': None,
+        })
+        sensor_key = relay_settings.SENSOR_KEY
+        if sensor_key and sensor_key != 'none':
+            sensor_device_id = DevicesDB.load_device_id_by_public_key(sensor_key)
+            snapshot.sensor_key = sensor_key
+            snapshot.sensor_device_id = sensor_device_id
+            snapshot.sensor_settings = DevicesDB.load_device_settings(device_id=sensor_device_id, device_type=1)
+        return snapshot
+
+    @staticmethod
+    @device_cache.tiered(cache, 3000)
+    def load_sensor_relays(sensor_key):
+        """Return the public keys of relays linked to a sensor.
+
+        Reverse of `relay_settings.SENSOR_KEY`, used by `/update` to push the
+        derived level to every relay fed by the sensor. Kept current by
+        `update_relay_settings`.
+
+        Args:
+            sensor_key: Sensor public key.
+
+        Returns:
+            tuple[str, ...]: Linked relay public keys (empty when none).
+        """
+        query = """
+            SELECT d.public_key FROM relay_settings rs
+                JOIN devices d ON d.id = rs.device
+            WHERE rs.SENSOR_KEY = :sensor_key
+        """
+        with engine.connect() as connection:
+            rows = connection.execute(text(query), {"sensor_key": sensor_key}).fetchall()
+        return tuple(sorted(row.public_key for row in rows))
+
+    @staticmethod
+    def invalidate_relay_snapshots(device_id):
+        """Drop cached relay snapshots affected by a settings change.
+
+        Args:
+            device_id: Relay id, or sensor id (drops every relay linked to it).
+
+        Returns:
+            None.
+        """
+        query = """
+            SELECT private_key FROM devices
+            WHERE id = :device_id
+                OR id IN (
+                    SELECT rs.device FROM relay_settings rs
+                        JOIN devices sd ON sd.public_key = rs.SENSOR_KEY
+                    WHERE sd.id = :device_id
+                )
+        """
+        try:
+            with engine.connect() as connection:
+                rows = connection.execute(text(query), {"device_id": device_id}).fetchall()
+        except Exception:
+            logging.exception(f"failed to resolve relay snapshots for device {device_id}")
+            return
+        for row in rows:
+            cache.delete_memoized(DevicesDB.load_relay_snapshot, row.private_key)
+            device_cache.invalidate('load_relay_snapshot', row.private_key)
+
     @staticmethod
     @cache.memoize(300)
     def get_user_device_name(user_id, public_key):
@@ -652,6 +766,44 @@ class DevicesDB:
             return True
         return False
 
+    @staticmethod
+    def user_relay_permissions(user_id, public_keys=None, group=None):
+        """Resolve a set of relays and the user's admin right on each, in one query.
+
+        Args:
+            user_id: User id.
+            public_keys: Relay public keys to check.
+            group: Alternatively, a group name; selects the user's relays whose
+                `user_devices.name` starts with `<group>/` (e.g. `Tower A/Pump 3`).
+
+        Returns:
+            dict: `public_key -> can_admin` for every existing relay matched;
+            unknown keys and non-relay devices are left out.
+        """
+        if group is not None:
+            prefix = group.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            query = text("""
+                SELECT dv.public_key AS public_key, ud.can_admin AS can_admin
+                FROM user_devices ud
+                JOIN devices dv ON dv.id = ud.device_id
+                WHERE ud.user_id = :user_id AND dv.type = 3
+                  AND ud.name LIKE :prefix ESCAPE '\\'
+            """)
+            params = {"user_id": user_id, "prefix": f"{prefix}/%"}
+        else:
+            if not public_keys:
+                return {}
+            query = text("""
+                SELECT dv.public_key AS public_key, ud.can_admin AS can_admin
+                FROM devices dv
+                LEFT JOIN user_devices ud ON ud.device_id = dv.id AND ud.user_id = :user_id
+                WHERE dv.type = 3 AND dv.public_key IN :public_keys
+            """).bindparams(bindparam("public_keys", expanding=True))
+            params = {"user_id": user_id, "public_keys": list(public_keys)}
+        with engine.connect() as connection:
+            rows = connection.execute(query, params).fetchall()
+        return {row.public_key: bool(row.can_admin and int(row.can_admin) == 1) for row in rows}
+
     @staticmethod
     def get_all_devices_by_type(device_type):
         connection = engine.connect()
@@ -688,6 +840,11 @@ class DevicesDB:
                 if not result:
                     return False
                 inserted_id = result.lastrowid
+            # Drop negative lookups cached before the device existed.
+            cache.delete_memoized(DevicesDB.valid_private_key, private_key)
+            cache.delete_memoized(DevicesDB.load_device_id_by_public_key, public_key)
+            device_cache.invalidate('valid_private_key', private_key)
+            device_cache.invalidate('load_device_id_by_public_key', public_key)
             if device_type == 1:
                 DevicesDB.update_sensor_settings(inserted_id)
             elif device_type == 3:
@@ -697,43 +854,12 @@ class DevicesDB:
             logging.exception(ex)
         return False
 
-    @staticmethod
-    @cache.memoize(30)
-    def add_relay_events(relay_id, events):
-        try:
-            past_event = DevicesDB.get_relay_events(relay_id, 1)
-            if past_event and events and past_event[0].get("events", "") == events:
-                events_int = events.split(',')
-                if '1' in events_int or '2' in events_int:
-                    return True
-            sql_query = """
-                        INSERT INTO relay_events (relay_id, events, created_at) 
-                        VALUES (:relay_id, :events, :created_at)
-                    """
-            inserted_id = None
-            with engine.connect() as connection:
-                result = connection.execute(
-                    text(sql_query), {
-                        "relay_id": relay_id, "events": events,
-                        "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    })
-                connection.commit()
-                if not result:
-                    return False
-                else:
-                    cache.delete_memoized(DevicesDB.get_relay_events, relay_id, 20)
-                    cache.delete_memoized(DevicesDB.get_relay_events, relay_id, 1)
-            return True
-        except Exception as ex:
-            logging.exception(ex)
-        return False
-
     @staticmethod
     @cache.memoize(300)
     def get_relay_events(relay_id, total_limit=20):
         connection = engine.connect()
 
-        query = ("SELECT id, events, created_at "
+        query = ("SELECT id, events, mask, created_at "
                  "FROM  relay_events "
                  "WHERE relay_id = :relay_id "
                  "ORDER BY id DESC"
@@ -750,108 +876,150 @@ class DevicesDB:
         result.close()
         connection.close()
         return [{
-            "id": r.id, "events": r.events, "created_at": r.created_at
+            "id": r.id, "events": r.events, "mask": r.mask, "created_at": r.created_at
         } for r in rows]
 
     @staticmethod
-    def ensure_relay_daily_stats_table():
-        """Ensure the relay daily stats table exists.
-
-        Table stores per-relay daily aggregates for ON runtime and estimated
-        liters added while pump is ON.
-        """
-        sql_create = """
-            CREATE TABLE IF NOT EXISTS relay_daily_stats (
-                relay_id INTEGER NOT NULL,
-                day_date TEXT NOT NULL,
-                on_seconds INTEGER NOT NULL DEFAULT 0,
-                liters_added REAL NOT NULL DEFAULT 0,
-                updated_at TEXT,
-                PRIMARY KEY (relay_id, day_date)
-            )
-        """
-        sql_index = """
-            CREATE INDEX IF NOT EXISTS idx_relay_daily_stats_day
-            ON relay_daily_stats(day_date)
-        """
-        with engine.connect() as connection:
-            connection.execute(text(sql_create))
-            connection.execute(text(sql_index))
-            connection.commit()
+    def find_relays_with_events(mask, since, until=None):
+        """Return relays that reported any of the `mask` events in a window.
 
-    @staticmethod
-    def _upsert_relay_daily_stats(relay_id, day_date, on_seconds_inc=0, liters_added_inc=0.0):
-        """Increment per-day aggregate counters for a relay.
+        Answered from the `(created_at, mask)` index of `relay_events`
+        (`created_at` is local server time, like the stored rows).
 
         Args:
-            relay_id: Relay device id.
-            day_date: UTC day key in YYYY-MM-DD format.
-            on_seconds_inc: Seconds to add to ON runtime.
-            liters_added_inc: Liters to add to estimated daily added water.
+            mask: Event bitmask (see `relay_events_mask`).
+            since: Window start (`datetime` or `YYYY-MM-DD HH:MM:SS`).
+            until: Optional window end (exclusive).
+
+        Returns:
+            list[dict]: One row per relay (`relay_id`, `public_key`, `note`,
+            `reports`, `first_at`, `last_at`), most recent first.
         """
-        DevicesDB.ensure_relay_daily_stats_table()
-        sql_query = """
-            INSERT INTO relay_daily_stats (relay_id, day_date, on_seconds, liters_added, updated_at)
-            VALUES (:relay_id, :day_date, :on_seconds_inc, :liters_added_inc, :updated_at)
-            ON CONFLICT(relay_id, day_date)
-            DO UPDATE SET
-                on_seconds = on_seconds + excluded.on_seconds,
-                liters_added = liters_added + excluded.liters_added,
-                updated_at = excluded.updated_at
+        if isinstance(since, datetime.datetime):
+            since = since.strftime("%Y-%m-%d %H:%M:%S")
+        if isinstance(until, datetime.datetime):
+            until = until.strftime("%Y-%m-%d %H:%M:%S")
+        query = """
+            SELECT re.relay_id, dv.public_key, dv.note, COUNT(*) AS reports,
+                MIN(re.created_at) AS first_at, MAX(re.created_at) AS last_at
+            FROM relay_events re
+            LEFT JOIN devices dv ON dv.id = re.relay_id
+            WHERE re.created_at >= :since
+              AND (:until IS NULL OR re.created_at < :until)
+              AND (re.mask & :mask) != 0
+            GROUP BY re.relay_id
+            ORDER BY last_at DESC
         """
         with engine.connect() as connection:
-            connection.execute(text(sql_query), {
-                "relay_id": relay_id,
-                "day_date": day_date,
-                "on_seconds_inc": int(max(0, on_seconds_inc)),
-                "liters_added_inc": float(max(0.0, liters_added_inc)),
-                "updated_at": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            })
-            connection.commit()
+            rows = connection.execute(text(query), {"since": since, "until": until, "mask": int(mask)}).fetchall()
+        return [{
+            "relay_id": r.relay_id, "public_key": r.public_key, "note": r.note or '-',
+            "reports": r.reports, "first_at": r.first_at, "last_at": r.last_at
+        } for r in rows]
 
     @staticmethod
-    def add_relay_on_runtime(relay_id, start_ts, end_ts):
-        """Add relay ON runtime splitting seconds across UTC day boundaries.
+    def split_runtime_by_day(start_ts, end_ts):
+        """Split an epoch interval into per-UTC-day second counts.
 
         Args:
-            relay_id: Relay device id.
             start_ts: Interval start epoch seconds (inclusive).
             end_ts: Interval end epoch seconds (exclusive).
-        """
-        try:
-            start_ts = int(start_ts)
-            end_ts = int(end_ts)
-        except Exception:
-            return
-
-        if end_ts <= start_ts:
-            return
 
+        Returns:
+            list[tuple[str, int]]: `(YYYY-MM-DD, seconds)` chunks in order.
+        """
+        chunks = []
         cursor = start_ts
         while cursor < end_ts:
             day_start_dt = datetime.datetime.fromtimestamp(cursor, datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
             next_day_dt = day_start_dt + datetime.timedelta(days=1)
             next_day_ts = int(next_day_dt.timestamp())
             chunk_end = min(end_ts, next_day_ts)
-            chunk_seconds = max(0, chunk_end - cursor)
-            day_key = day_start_dt.strftime("%Y-%m-%d")
-            DevicesDB._upsert_relay_daily_stats(relay_id, day_key, on_seconds_inc=chunk_seconds, liters_added_inc=0.0)
+            chunks.append((day_start_dt.strftime("%Y-%m-%d"), max(0, chunk_end - cursor)))
             cursor = chunk_end
+        return chunks
 
     @staticmethod
-    def add_relay_liters_for_day(relay_id, at_ts, liters_added):
-        """Add estimated liters to the UTC day bucket containing `at_ts`."""
-        try:
-            at_ts = int(at_ts)
-            liters_added = float(liters_added)
-        except Exception:
-            return
+    def apply_write_batch(uptime_hours=None, pool_times=None, relay_events=None, relay_daily=None,
+                          batch_token=None):
+        """Apply coalesced write-behind intents in a single transaction.
 
-        if liters_added <= 0:
-            return
+        Args:
+            uptime_hours: Mapping `device_id -> hours` to add to `device_uptime`.
+            pool_times: Mapping `device_id -> WIFI_POOL_TIME` (last value wins).
+            relay_events: List of `(relay_id, events_csv, created_at)` rows.
+            relay_daily: Mapping `(relay_id, day_date) -> (on_seconds, liters)` increments.
+            batch_token: Optional batch id recorded in `write_behind_batches` in
+                the same transaction; a batch whose token is already there is
+                skipped, so retrying it after a crash does not count twice.
+
+        Returns:
+            bool: True when the transaction commits; False when the batch
+            was already applied.
+        """
+        uptime_hours = uptime_hours or {}
+        pool_times = pool_times or {}
+        relay_events = relay_events or []
+        relay_daily = relay_daily or {}
 
-        day_key = datetime.datetime.fromtimestamp(at_ts, datetime.timezone.utc).strftime("%Y-%m-%d")
-        DevicesDB._upsert_relay_daily_stats(relay_id, day_key, on_seconds_inc=0, liters_added_inc=liters_added)
+        updated_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        with engine.connect() as connection:
+            if batch_token is not None:
+                recorded = connection.execute(text("""
+                    INSERT OR IGNORE INTO write_behind_batches (token, applied_at) VALUES (:token, :applied_at)
+                """), {"token": batch_token, "applied_at": updated_at})
+                if not recorded.rowcount:
+                    connection.rollback()
+                    return False
+                cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=WRITE_BATCH_TOKEN_DAYS))
+                connection.execute(text("DELETE FROM write_behind_batches WHERE applied_at < :cutoff"),
+                                   {"cutoff": cutoff.strftime("%Y-%m-%d %H:%M:%S")})
+            if uptime_hours:
+                connection.execute(text("""
+                    INSERT INTO device_uptime (device_id, up_hours)
+                    VALUES (:device_id, :hours)
+                    ON CONFLICT(device_id) DO UPDATE SET up_hours = up_hours + excluded.up_hours
+                """), [{"device_id": device_id, "hours": hours} for device_id, hours in uptime_hours.items()])
+            if pool_times:
+                connection.execute(text("""
+                    UPDATE sensor_settings
+                        SET WIFI_POOL_TIME= :WIFI_POOL_TIME
+                    WHERE device= :device
+                """), [{"device": device_id, "WIFI_POOL_TIME": value} for device_id, value in pool_times.items()])
+            if relay_events:
+                connection.execute(text("""
+                    INSERT INTO relay_events (relay_id, events, mask, created_at)
+                    VALUES (:relay_id, :events, :mask, :created_at)
+                """), [{"relay_id": relay_id, "events": events, "mask": relay_events_mask(events),
+                        "created_at": created_at}
+                       for relay_id, events, created_at in relay_events])
+            if relay_daily:
+                connection.execute(text("""
+                    INSERT INTO relay_daily_stats (relay_id, day_date, on_seconds, liters_added, updated_at)
+                    VALUES (:relay_id, :day_date, :on_seconds_inc, :liters_added_inc, :updated_at)
+                    ON CONFLICT(relay_id, day_date)
+                    DO UPDATE SET
+                        on_seconds = on_seconds + excluded.on_seconds,
+                        liters_added = liters_added + excluded.liters_added,
+                        updated_at = excluded.updated_at
+                """), [{
+                    "relay_id": relay_id, "day_date": day_date,
+                    "on_seconds_inc": int(max(0, on_seconds)),
+                    "liters_added_inc": float(max(0.0, liters)),
+                    "updated_at": updated_at
+                } for (relay_id, day_date), (on_seconds, liters) in relay_daily.items()])
+            connection.commit()
+
+        for device_id in uptime_hours:
+            cache.delete_memoized(DevicesDB.get_device_uptime, device_id)
+        for device_id in pool_times:
+            cache.delete_memoized(DevicesDB.load_device_settings, device_id, 1)
+            device_cache.invalidate('load_device_settings', device_id, 1)
+            DevicesDB.invalidate_relay_snapshots(device_id)
+        for relay_id in {row[0] for row in relay_events}:
+            cache.delete_memoized(DevicesDB.get_relay_events, relay_id, 20)
+            cache.delete_memoized(DevicesDB.get_relay_events, relay_id, 1)
+        return True
 
     @staticmethod
     def get_relay_daily_stats(relay_id, days=15, start_date=None, end_date=None):
@@ -859,8 +1027,6 @@ class DevicesDB:
 
         Missing days are zero-filled to simplify chart rendering.
         """
-        DevicesDB.ensure_relay_daily_stats_table()
-
         if start_date is not None and end_date is not None:
             if isinstance(start_date, str):
                 start_date = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
@@ -918,6 +1084,149 @@ class DevicesDB:
 
         return output
 
+    @staticmethod
+    def store_sensor_hourly_stats(rows, prune_before=None):
+        """Replace compacted hourly rows and refresh the affected daily rows.
+
+        Hourly rows are full aggregates of their hour, so re-compacting an hour
+        (late `/update-batch` uploads) overwrites it instead of double counting.
+
+        Args:
+            rows: Iterable of `(sensor_id, hour_start, summary)` where summary
+                has `sensor_history.summarize` keys.
+            prune_before: Optional epoch; hourly rows older than this are
+                deleted (daily rows are kept).
+
+        Returns:
+            int: Number of hourly rows written.
+        """
+        params = [{
+            "sensor_id": sensor_id,
+            "hour_start": int(hour_ts),
+            "samples": int(summary['count']),
+            "percent_sum": float(summary['percent_avg']) * int(summary['count']),
+            "percent_min": float(summary['percent_min']),
+            "percent_max": float(summary['percent_max']),
+            "voltage_sum": float(summary['voltage_avg']) * int(summary['count']),
+            "voltage_min": float(summary['voltage_min']),
+            "voltage_max": float(summary['voltage_max']),
+        } for sensor_id, hour_ts, summary in rows if summary]
+        if not params and prune_before is None:
+            return 0
+
+        updated_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        days = sorted({
+            (item["sensor_id"], datetime.datetime.fromtimestamp(
+                item["hour_start"], datetime.timezone.utc).strftime("%Y-%m-%d"))
+            for item in params
+        })
+        with engine.connect() as connection:
+            if params:
+                connection.execute(text("""
+                    INSERT INTO sensor_hourly_stats (sensor_id, hour_start, samples, percent_sum, percent_min,
+                        percent_max, voltage_sum, voltage_min, voltage_max, updated_at)
+                    VALUES (:sensor_id, :hour_start, :samples, :percent_sum, :percent_min,
+                        :percent_max, :voltage_sum, :voltage_min, :voltage_max, :updated_at)
+                    ON CONFLICT(sensor_id, hour_start)
+                    DO UPDATE SET
+                        samples = excluded.samples,
+                        percent_sum = excluded.percent_sum,
+                        percent_min = excluded.percent_min,
+                        percent_max = excluded.percent_max,
+                        voltage_sum = excluded.voltage_sum,
+                        voltage_min = excluded.voltage_min,
+                        voltage_max = excluded.voltage_max,
+                        updated_at = excluded.updated_at
+                """), [dict(item, updated_at=updated_at) for item in params])
+            if days:
+                connection.execute(text("""
+                    INSERT INTO sensor_daily_stats (sensor_id, day_date, samples, percent_sum, percent_min,
+                        percent_max, voltage_sum, voltage_min, voltage_max, updated_at)
+                    SELECT sensor_id, :day_date, SUM(samples), SUM(percent_sum), MIN(percent_min),
+                        MAX(percent_max), SUM(voltage_sum), MIN(voltage_min), MAX(voltage_max), :updated_at
+                    FROM sensor_hourly_stats
+                    WHERE sensor_id = :sensor_id
+                      AND hour_start >= strftime('%s', :day_date)
+                      AND hour_start < strftime('%s', :day_date, '+1 day')
+                    GROUP BY sensor_id
+                    ON CONFLICT(sensor_id, day_date)
+                    DO UPDATE SET
+                        samples = excluded.samples,
+                        percent_sum = excluded.percent_sum,
+                        percent_min = excluded.percent_min,
+                        percent_max = excluded.percent_max,
+                        voltage_sum = excluded.voltage_sum,
+                        voltage_min = excluded.voltage_min,
+                        voltage_max = excluded.voltage_max,
+                        updated_at = excluded.updated_at
+                """), [{"sensor_id": sensor_id, "day_date": day_date, "updated_at": updated_at}
+                       for sensor_id, day_date in days])
+            if prune_before is not None:
+                connection.execute(text("DELETE FROM sensor_hourly_stats WHERE hour_start < :prune_before"),
+                                   {"prune_before": int(prune_before)})
+            connection.commit()
+        return len(params)
+
+    @staticmethod
+    def get_sensor_history_range(sensor_id, start_ts, end_ts, resolution):
+        """Return long-term sensor history points for a time window.
+
+        Args:
+            sensor_id: Sensor device id.
+            start_ts: Window start epoch seconds (inclusive).
+            end_ts: Window end epoch seconds (exclusive).
+            resolution: `hour` or `day` (see `sensor_history.pick_resolution`).
+
+        Returns:
+            list[dict]: Points ordered by `ts` with `samples`,
+            `percent`/`voltage` averages and their min/max.
+        """
+        if resolution == 'day':
+            query = """
+                SELECT CAST(strftime('%s', day_date) AS INTEGER) AS ts, samples, percent_sum, percent_min,
+                    percent_max, voltage_sum, voltage_min, voltage_max
+                FROM sensor_daily_stats
+                WHERE sensor_id = :sensor_id
+                  AND day_date >= :start_day
+                  AND day_date < :end_day
+                ORDER BY day_date ASC
+            """
+        else:
+            query = """
+                SELECT hour_start AS ts, samples, percent_sum, percent_min,
+                    percent_max, voltage_sum, voltage_min, voltage_max
+                FROM sensor_hourly_stats
+                WHERE sensor_id = :sensor_id
+                  AND hour_start >= :start_ts
+                  AND hour_start < :end_ts
+                ORDER BY hour_start ASC
+            """
+
+        def _day(ts):
+            return datetime.datetime.fromtimestamp(int(ts), datetime.timezone.utc).strftime("%Y-%m-%d")
+
+        with engine.connect() as connection:
+            result = connection.execute(text(query), {
+                "sensor_id": sensor_id,
+                "start_ts": int(start_ts),
+                "end_ts": int(end_ts),
+                "start_day": _day(start_ts),
+                "end_day": _day(int(end_ts) + 86399),
+            })
+            rows = result.fetchall()
+            result.close()
+
+        return [{
+            "ts": int(row.ts),
+            "samples": int(row.samples),
+            "percent": round(row.percent_sum / row.samples, 1),
+            "percent_min": row.percent_min,
+            "percent_max": row.percent_max,
+            "voltage": round(row.voltage_sum / row.samples, 2),
+            "voltage_min": row.voltage_min,
+            "voltage_max": row.voltage_max,
+        } for row in rows if row.samples]
+
 
 class User(UserMixin):
     """Flask-Login compatible user model backed by SQL helper methods."""
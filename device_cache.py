@@ -0,0 +1,274 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+import settings
+
+
+INVALIDATION_CHANNEL = 'device-cache/invalidate'
+STATS_KEY = 'device-cache/stats'
+STATS_PUBLISH_SECONDS = 60
+# Wildcard invalidation message: drop every local entry of every tier.
+FLUSH_ALL = '*'
+
+
+class LocalLRU:
+    """Thread-safe in-process LRU with a size bound and per-entry TTL."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return `(found, value)` and refresh recency on hit."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_tiers = {}
+_redis_client = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+_stats_published_at = 0.0
+
+
+def _get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.StrictRedis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            decode_responses=True,
+            socket_connect_timeout=2,
+            # Invalidation runs inside settings writes: fail fast instead of stalling them.
+            retry=Retry(NoBackoff(), 0),
+        )
+    return _redis_client
+
+
+def _apply_invalidation(message):
+    if message == FLUSH_ALL:
+        for tier in _tiers.values():
+            tier['local'].clear()
+        return
+    try:
+        name, args = json.loads(message)
+    except (TypeError, ValueError):
+        logging.warning(f"device-cache: bad invalidation message: {message}")
+        return
+    tier = _tiers.get(name)
+    if tier:
+        tier['local'].delete((name,) + tuple(args))
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = _get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Entries cached while disconnected may have missed invalidations.
+            _apply_invalidation(FLUSH_ALL)
+            for message in pubsub.listen():
+                if message.get('type') == 'message':
+                    _apply_invalidation(message.get('data'))
+        except redis.RedisError:
+            logging.warning("device-cache: invalidation listener disconnected, retrying")
+        except Exception:
+            logging.exception("device-cache: invalidation listener failed")
+        time.sleep(5)
+
+
+def _ensure_listener():
+    """Start the pub/sub listener once per process (re-started after fork)."""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        threading.Thread(target=_listen, name='device-cache-invalidation', daemon=True).start()
+
+
+def invalidate(name, *args):
+    """Drop a cached entry from every worker's local tier.
+
+    The local entry is removed immediately and the key is broadcast so other
+    workers drop theirs. Callers still clear the Redis tier with
+    `cache.delete_memoized`.
+
+    Args:
+        name: Tiered function name (e.g. `load_device_settings`).
+        *args: Positional arguments identifying the entry; no args clears all
+            entries of that function.
+
+    Returns:
+        None.
+    """
+    tier = _tiers.get(name)
+    if tier:
+        if args:
+            tier['local'].delete((name,) + args)
+        else:
+            tier['local'].clear()
+    message = json.dumps([name, list(args)]) if args else FLUSH_ALL
+    try:
+        _get_redis().publish(INVALIDATION_CHANNEL, message)
+    except redis.RedisError:
+        logging.warning(f"device-cache: failed to publish invalidation for {name}{args}")
+
+
+def invalidate_all():
+    """Clear every local tier in every worker.
+
+    Returns:
+        None.
+    """
+    for tier in _tiers.values():
+        tier['local'].clear()
+    try:
+        _get_redis().publish(INVALIDATION_CHANNEL, FLUSH_ALL)
+    except redis.RedisError:
+        logging.warning("device-cache: failed to publish flush")
+
+
+def stats():
+    """Return hit/miss counters per tiered function and tier for this process.
+
+    Returns:
+        dict: `{name: {"local": {...}, "redis": {...}}}`.
+    """
+    output = {}
+    for name, tier in _tiers.items():
+        local = tier['local']
+        output[name] = {
+            "local": {"hits": local.hits, "misses": local.misses,
+                      "evictions": local.evictions, "size": len(local)},
+            "redis": {"hits": tier['redis_hits'], "misses": tier['redis_misses']},
+        }
+    return output
+
+
+def _publish_stats():
+    global _stats_published_at
+    now = time.monotonic()
+    if now - _stats_published_at < STATS_PUBLISH_SECONDS:
+        return
+    _stats_published_at = now
+    try:
+        _get_redis().hset(STATS_KEY, f"{socket.gethostname()}:{os.getpid()}", json.dumps(stats()))
+    except redis.RedisError:
+        pass
+
+
+def load_published_stats():
+    """Return the latest stats snapshot published by each worker process.
+
+    Returns:
+        dict: `{"<host>:<pid>": stats}`.
+    """
+    raw = _get_redis().hgetall(STATS_KEY) or {}
+    return {worker: json.loads(snapshot) for worker, snapshot in raw.items()}
+
+
+def tiered(redis_cache, timeout):
+    """Memoize in a process-local LRU in front of Flask-Caching's Redis memoize.
+
+    Drop-in replacement for `@cache.memoize(timeout)`: `cache.delete_memoized`
+    and `.uncached` keep working on the decorated function. Local entries
+    live at most `DEVICE_LOCAL_CACHE_TTL` seconds and are dropped across
+    workers by `invalidate()`.
+
+    Args:
+        redis_cache: Flask-Caching `Cache` used for the Redis tier.
+        timeout: Redis tier timeout in seconds.
+
+    Returns:
+        callable: Decorator.
+    """
+    def decorator(f):
+        name = f.__name__
+        signature = inspect.signature(f)
+        tier = {
+            'local': LocalLRU(settings.DEVICE_LOCAL_CACHE_SIZE, settings.DEVICE_LOCAL_CACHE_TTL),
+            'redis_hits': 0,
+            'redis_misses': 0,
+        }
+        _tiers[name] = tier
+        loaded = threading.local()
+
+        @functools.wraps(f)
+        def load(*args, **kwargs):
+            loaded.flag = True
+            return f(*args, **kwargs)
+
+        memoized = redis_cache.memoize(timeout)(load)
+
+        @functools.wraps(memoized)
+        def wrapper(*args, **kwargs):
+            if not settings.DEVICE_LOCAL_CACHE_ENABLED:
+                return memoized(*args, **kwargs)
+            _ensure_listener()
+            _publish_stats()
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (name,) + tuple(bound.arguments.values())
+            found, value = tier['local'].get(key)
+            if found:
+                return value
+
+            loaded.flag = False
+            value = memoized(*args, **kwargs)
+            if loaded.flag:
+                tier['redis_misses'] += 1
+            else:
+                tier['redis_hits'] += 1
+            if value is not None:
+                tier['local'].set(key, value)
+            return value
+
+        return wrapper
+    return decorator
@@ -20,4 +20,7 @@ if [ ! -f "$DB_TARGET" ] && [ -f database.opensource.db ]; then
   python3.14 scripts/reset_demo_db.py --target "$DB_TARGET" --source database.opensource.db
 fi
 
+# Schema migrations run once here, before any web/api/worker process starts.
+python3.14 migrations.py
+
 exec "$@"
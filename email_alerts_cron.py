@@ -3,6 +3,7 @@ from flask_caching import Cache
 
 import settings
 import email_tools
+import tank_level
 
 import redis
 import time
@@ -45,10 +46,59 @@ redis_client = redis.StrictRedis(
 )
 
 
+def load_device_levels(device_ids):
+    """Load S1 info and live state for alerted devices and compute all levels at once.
+
+    Live states are read with one `MGET` and fill percents for the whole
+    fleet are computed in a single vectorized pass (`tank_level.batch_levels`).
+
+    Args:
+        device_ids: S1 device ids referenced by the alerts.
+
+    Returns:
+        dict: `device_id -> (s1_info, sensor_data, rtime, percent)`; devices
+        without S1 info are omitted.
+    """
+    infos = {}
+    for device_id in device_ids:
+        s1_info = db.DevicesDB.load_s1_info(device_id)
+        if s1_info:
+            infos[device_id] = s1_info
+    if not infos:
+        return {}
+
+    ids = list(infos)
+    states = redis_client.mget([f'tin-keys/{infos[device_id].public_key}' for device_id in ids])
+    distances = []
+    rtimes = []
+    for index, sensor_data in enumerate(states):
+        distance, rtime = 0, 0
+        if sensor_data:
+            try:
+                distance, rtime, _, _ = sensor_data.split("|")
+                distance = int(distance)
+            except ValueError:
+                logging.error(f"Invalid sensor data for device_id: {ids[index]}")
+                distance, rtime, states[index] = 0, 0, None
+        distances.append(distance)
+        rtimes.append(rtime)
+
+    percents = tank_level.batch_levels(
+        distances,
+        [infos[device_id].EMPTY_LEVEL for device_id in ids],
+        [infos[device_id].TOP_MARGIN for device_id in ids],
+    )['percent']
+    return {
+        device_id: (infos[device_id], sensor_data, rtime, int(percent))
+        for device_id, sensor_data, rtime, percent in zip(ids, states, rtimes, percents)
+    }
+
+
 if __name__ == "__main__":
 
     email_alerts_data = db.CronsDB.get_email_alerts_info()
     local_cache = {}
+    device_levels = load_device_levels({data.device_id for data in email_alerts_data})
     logging.warning(f"Total alerts to check: {len(email_alerts_data)}")
     for data in email_alerts_data:
         try:
@@ -71,31 +121,14 @@ if __name__ == "__main__":
             # =============================================================
             #     Section to load Device Info (level %, online-time)
             if not local_cache.get(device_id):
-                s1_info = db.DevicesDB.load_s1_info(device_id)
-                if not s1_info:
+                if device_id not in device_levels:
                     logging.error(f"Invalid S1 device_id: {device_id}")
                     continue
+                s1_info, sensor_data, rtime, percent = device_levels[device_id]
                 sensor_key = s1_info.public_key
 
-                cache_key = f'tin-keys/{sensor_key}'
-                sensor_data = redis_client.get(cache_key)
-
-                distance = 0
-                rtime = 0
-                percent = 0
-
-                local_cache[device_id] = [s1_info.WIFI_POOL_TIME, rtime, percent, sensor_key]
+                local_cache[device_id] = [s1_info.WIFI_POOL_TIME, 0, 0, sensor_key]
                 if sensor_data and s1_info.WIFI_POOL_TIME:
-                    distance, rtime, voltage, rssi = sensor_data.split("|")
-
-                    EMPTY_LEVEL = s1_info.EMPTY_LEVEL
-                    TOP_MARGIN = s1_info.TOP_MARGIN
-                    WIFI_POOL_TIME = s1_info.WIFI_POOL_TIME
-
-                    distance = int(distance)
-                    if EMPTY_LEVEL == 0:
-                        EMPTY_LEVEL = 1
-                    percent = min(100, 100 - min(100, int(((distance - TOP_MARGIN) * 100.0) / ((EMPTY_LEVEL - TOP_MARGIN)))))
                     local_cache[device_id] = [s1_info.WIFI_POOL_TIME, rtime, percent, sensor_key]
                 else:
                     logging.debug("Missing sensor data!")
@@ -0,0 +1,6 @@
+import migrations
+
+
+def on_starting(server):
+    # Runs once in the master before workers fork: migrate, or refuse to boot on a schema that is behind.
+    migrations.ensure_current()
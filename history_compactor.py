@@ -0,0 +1,167 @@
+import argparse
+import logging
+import signal
+import time
+
+import redis
+
+import settings
+import redis_scripts
+import sensor_history
+import db
+import migrations
+
+
+SCAN_BATCH = 500
+
+redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.API_REDIS_DB,
+    decode_responses=True
+)
+
+mark_compacted_script = redis_client.register_script(redis_scripts.SENSOR_ROLLUP_MARK_COMPACTED)
+
+
+def parse_rollup_key(key):
+    """Split a `tin-rollup/<public_key>/<hour_start>` key.
+
+    Returns:
+        tuple[str, int] | None: `(public_key, hour_start)` or None when malformed.
+    """
+    try:
+        _, public_key, hour_ts = key.split('/', 2)
+        return public_key, int(hour_ts)
+    except ValueError:
+        return None
+
+
+def _compact_keys(keys, now_ts, prune_before):
+    """Compact one batch of rollup keys into SQLite.
+
+    Returns:
+        int: Hourly rows written.
+    """
+    closed = []
+    for key in keys:
+        parsed = parse_rollup_key(key)
+        if parsed and parsed[1] + sensor_history.HOUR_SECONDS <= now_ts:
+            closed.append((key, parsed[0], parsed[1]))
+    if not closed:
+        return 0
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key, _, _ in closed:
+        pipe.hgetall(key)
+
+    rows = []
+    compacted = []
+    for (key, public_key, hour_ts), raw in zip(closed, pipe.execute()):
+        if not raw or raw.get('compacted') == raw.get('n'):
+            continue
+        sensor_id = db.DevicesDB.load_device_id_by_public_key(public_key)
+        if not sensor_id:
+            continue
+        rows.append((sensor_id, hour_ts, sensor_history.decode_rollup(raw)))
+        compacted.append((key, raw.get('n')))
+
+    if not rows:
+        return 0
+    written = db.DevicesDB.store_sensor_hourly_stats(rows, prune_before=prune_before)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key, count in compacted:
+        mark_compacted_script(keys=[key], args=[count], client=pipe)
+    pipe.execute()
+    return written
+
+
+def compact_once(now_ts=None):
+    """Fold every closed, not yet compacted hourly rollup into SQLite.
+
+    Runs well inside the 3-day Redis retention, so each hour is compacted
+    before its raw samples expire. Hours that receive late `/update-batch`
+    samples change their count and are compacted again (rows are replaced).
+
+    Args:
+        now_ts: Current epoch seconds (defaults to now).
+
+    Returns:
+        int: Hourly rows written.
+    """
+    now_ts = int(now_ts or time.time())
+    prune_before = now_ts - settings.SENSOR_HOURLY_RETENTION_DAYS * 86400
+    total = 0
+    batch = []
+    for key in redis_client.scan_iter(match='tin-rollup/*', count=SCAN_BATCH):
+        batch.append(key)
+        if len(batch) >= SCAN_BATCH:
+            total += _compact_keys(batch, now_ts, prune_before)
+            batch = []
+    total += _compact_keys(batch, now_ts, prune_before)
+    return total
+
+
+class HistoryCompactor:
+    """Periodically compact closed sensor history hours into SQLite."""
+    def __init__(self, interval):
+        self.interval = max(1, int(interval))
+        self.running = True
+
+    def run(self, once=False):
+        """Run the compaction loop until stopped.
+
+        Args:
+            once: When True, compact once and exit.
+
+        Returns:
+            None.
+        """
+        while self.running:
+            try:
+                written = compact_once()
+                if written:
+                    logging.warning(f"history-compactor: compacted {written} sensor hours")
+            except Exception:
+                logging.exception("history-compactor: compaction failed")
+            if once:
+                return
+            deadline = time.time() + self.interval
+            while self.running and time.time() < deadline:
+                time.sleep(min(1.0, self.interval))
+
+
+def main():
+    """Entrypoint for the sensor history compaction service.
+
+    Returns:
+        None.
+    """
+    parser = argparse.ArgumentParser(description="Compact Redis sensor history into SQLite hourly/daily stats")
+    parser.add_argument("--interval", type=int, default=settings.SENSOR_COMPACT_INTERVAL_SECONDS,
+                        help="Seconds between compaction runs")
+    parser.add_argument("--once", action="store_true", help="Compact once and exit")
+    args = parser.parse_args()
+    migrations.ensure_current()
+
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.config.update(settings.API_CACHE_SETT)
+    db.cache.init_app(app)
+
+    compactor = HistoryCompactor(args.interval)
+
+    def _stop(*_):
+        compactor.running = False
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    with app.app_context():
+        compactor.run(once=args.once)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import hashlib
+
+from flask import request, jsonify, make_response
+
+
+def etag(*parts):
+    """Return a validator for the values a response is built from.
+
+    Args:
+        *parts: Values the response depends on (live state, settings, ...).
+
+    Returns:
+        str: Hex digest.
+    """
+    return hashlib.blake2b('|'.join(str(part) for part in parts).encode(), digest_size=12).hexdigest()
+
+
+def conditional_json(parts, build):
+    """Answer a polling request with `304 Not Modified` while its state is unchanged.
+
+    The body is only built when the client's `If-None-Match` does not match.
+    Validators are weak: bodies also carry values derived from the request
+    time (`diff_time`), which clients advance themselves on a 304.
+
+    Args:
+        parts: Values the response depends on (see `etag`).
+        build: Callable returning the JSON-serializable body.
+
+    Returns:
+        flask.Response: `304` without body, or `200` JSON, both with `ETag`.
+    """
+    tag = etag(*parts)
+    if request.if_none_match.contains_weak(tag):
+        response = make_response('', 304)
+    else:
+        response = jsonify(build())
+    response.set_etag(tag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
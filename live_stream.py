@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import redis
+
+import settings
+
+
+CHANNEL_PREFIX = 'device-live/'
+# Browsers wait this long before reconnecting a dropped stream.
+RETRY_MS = 3000
+
+_viewers = {}
+_viewers_lock = threading.Lock()
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.API_REDIS_DB,
+    decode_responses=True,
+    socket_connect_timeout=2,
+)
+
+
+def channel(public_key):
+    """Return the pub/sub channel carrying a device's accepted live state."""
+    return f'{CHANNEL_PREFIX}{public_key}'
+
+
+class _Viewer:
+    """One open stream: woken with the latest published state."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.state = None
+
+
+def _deliver(public_key, state):
+    with _viewers_lock:
+        viewers = list(_viewers.get(public_key, ()))
+    for viewer in viewers:
+        viewer.state = state
+        viewer.event.set()
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(f'{CHANNEL_PREFIX}*')
+            for message in pubsub.listen():
+                if message.get('type') == 'pmessage':
+                    _deliver(message['channel'][len(CHANNEL_PREFIX):], message['data'])
+        except redis.RedisError:
+            logging.warning("live-stream: listener disconnected, retrying")
+        except Exception:
+            logging.exception("live-stream: listener failed")
+        time.sleep(1)
+
+
+def _ensure_listener():
+    """Start the pub/sub listener once per process (re-started after fork)."""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        threading.Thread(target=_listen, name='live-stream-listener', daemon=True).start()
+
+
+def format_event(event_id, data, event='state'):
+    """Return one Server-Sent Events frame."""
+    return f'id: {event_id}\nevent: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def events(public_key, load_state, render, last_id=None, heartbeat=None, max_seconds=None):
+    """Yield the SSE frames of one viewer's device stream.
+
+    The current state is sent first unless the viewer already has it
+    (`Last-Event-ID` on reconnect); then every state published by the
+    device endpoints, with a comment line every `heartbeat` seconds so
+    proxies keep the connection open. The stream ends after `max_seconds`
+    and the browser reconnects with its last event id. One listener per
+    worker process serves all viewers; meant for async (gevent) workers.
+
+    Args:
+        public_key: Device public key.
+        load_state: Callable returning the current live state (or None).
+        render: Callable `(state, last_id) -> (event_id, data) | None`;
+            None skips the state.
+        last_id: Last event id the viewer received.
+        heartbeat: Seconds between keep-alive comments (defaults to settings).
+        max_seconds: Stream lifetime in seconds (defaults to settings).
+
+    Yields:
+        str: SSE frames.
+    """
+    heartbeat = heartbeat or settings.LIVE_STREAM_HEARTBEAT_SECONDS
+    max_seconds = max_seconds or settings.LIVE_STREAM_MAX_SECONDS
+    _ensure_listener()
+    viewer = _Viewer()
+    # Registered before the first read, so a state published meanwhile is not missed.
+    with _viewers_lock:
+        _viewers.setdefault(public_key, set()).add(viewer)
+    try:
+        yield f'retry: {RETRY_MS}\n\n'
+        state = load_state()
+        deadline = time.monotonic() + max_seconds
+        while True:
+            if state is not None:
+                frame = render(state, last_id)
+                state = None
+                if frame and frame[0] != last_id:
+                    last_id = frame[0]
+                    yield format_event(*frame)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if viewer.event.wait(min(heartbeat, remaining)):
+                viewer.event.clear()
+                state = viewer.state
+            elif time.monotonic() < deadline:
+                yield ': keepalive\n\n'
+    finally:
+        with _viewers_lock:
+            viewers = _viewers.get(public_key)
+            if viewers is not None:
+                viewers.discard(viewer)
+                if not viewers:
+                    del _viewers[public_key]
@@ -0,0 +1,170 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+import settings
+
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_listener = None
+_sample_counters = {}
+_sample_lock = threading.Lock()
+
+
+def _kv_value(value):
+    text = str(value)
+    if not text or any(char in text for char in ' "=\n'):
+        return json.dumps(text)
+    return text
+
+
+def _record_fields(formatter, record):
+    """Build the ordered field dict shared by the structured formatters."""
+    fields = {
+        'ts': formatter.formatTime(record, DATE_FORMAT),
+        'level': record.levelname,
+    }
+    event = getattr(record, 'event', None)
+    message = record.getMessage()
+    if event:
+        fields['event'] = event
+    if message and message != event:
+        fields['msg'] = message
+    fields.update(getattr(record, 'fields', None) or {})
+    if record.exc_info:
+        fields['exc'] = formatter.formatException(record.exc_info)
+    return fields
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Render records as `key=value` pairs (values with spaces are quoted)."""
+    def format(self, record):
+        return ' '.join(f'{name}={_kv_value(value)}' for name, value in _record_fields(self, record).items())
+
+
+class JsonFormatter(logging.Formatter):
+    """Render records as one JSON object per line."""
+    def format(self, record):
+        return json.dumps(_record_fields(self, record), default=str, separators=(',', ':'))
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    Records stay in-process, so the stock `prepare()` step (formatting and
+    stripping args for pickling) is skipped to keep it off the request path.
+    """
+    def prepare(self, record):
+        return record
+
+
+def build_formatter(fmt=None):
+    """Return the formatter for `LOG_FORMAT` (`kv`, `json` or `text`)."""
+    fmt = (fmt or settings.LOG_FORMAT).lower()
+    if fmt == 'json':
+        return JsonFormatter()
+    if fmt == 'text':
+        return logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT)
+    return KeyValueFormatter()
+
+
+def build_handler(fmt=None, use_queue=None):
+    """Build the root handler: a queue feeding a background stderr writer.
+
+    The listener thread is started per process (gunicorn workers import the
+    app after forking) and flushed at exit. Calling this again replaces the
+    previous listener.
+
+    Args:
+        fmt: Record format (defaults to `settings.LOG_FORMAT`).
+        use_queue: Write from a listener thread (defaults to `settings.LOG_ASYNC`).
+
+    Returns:
+        logging.Handler: Handler to attach to the root logger.
+    """
+    global _listener
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(build_formatter(fmt))
+    if use_queue is None:
+        use_queue = settings.LOG_ASYNC
+    if not use_queue:
+        return stream_handler
+
+    stop_listener()
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    return DeferredQueueHandler(log_queue)
+
+
+def stop_listener():
+    """Flush queued records and stop the background writer, if running."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_listener)
+
+
+def parse_sample_rates(value):
+    """Parse `event=N` pairs (log one in N) into a dict."""
+    rates = {}
+    for entry in str(value or '').split(','):
+        event, sep, every = entry.strip().partition('=')
+        try:
+            if sep and event:
+                rates[event] = max(1, int(every))
+        except ValueError:
+            continue
+    return rates
+
+
+SAMPLE_RATES = parse_sample_rates(settings.LOG_SAMPLE_RATES)
+
+
+def should_sample(event):
+    """Return `(log, every)`: whether this occurrence of `event` is logged.
+
+    The first occurrence and then every Nth are kept per process.
+    """
+    every = SAMPLE_RATES.get(event, 1)
+    if every <= 1:
+        return True, 1
+    with _sample_lock:
+        seen = _sample_counters.get(event, 0)
+        _sample_counters[event] = seen + 1
+    return seen % every == 0, every
+
+
+def log_event(event, level=logging.WARNING, **fields):
+    """Log a structured event, applying per-event sampling.
+
+    Errors (`level >= ERROR`) and events without a configured rate are
+    always logged; sampled records carry `sample=N` so counts can be scaled.
+
+    Args:
+        event: Event name (also the sampling key).
+        level: Logging level.
+        **fields: Structured fields rendered by the formatter.
+
+    Returns:
+        bool: True when the record was emitted.
+    """
+    logger = logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return False
+    if level < logging.ERROR:
+        keep, every = should_sample(event)
+        if not keep:
+            return False
+        if every > 1:
+            fields['sample'] = every
+    logger.log(level, event, extra={'event': event, 'fields': fields})
+    return True
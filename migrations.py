@@ -0,0 +1,262 @@
+import argparse
+import contextlib
+import datetime
+import fcntl
+import logging
+
+from sqlalchemy import text
+
+import settings
+import db
+
+
+def _table_columns(connection, table):
+    rows = connection.execute(text(f"PRAGMA table_info({table})")).fetchall()
+    return {row[1] for row in rows}
+
+
+def _add_columns(connection, table, columns):
+    """Add missing columns to `table`; False (nothing done) when the table does not exist."""
+    existing = _table_columns(connection, table)
+    if not existing:
+        logging.warning(f"migrations: table {table} missing, skipping columns {sorted(columns)}")
+        return False
+    for name, sql_type in columns.items():
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {sql_type}"))
+    return True
+
+
+def _relay_settings_cost_fields(connection):
+    # Formerly scripts/migrate_add_relay_cost_energy_fields.sql
+    return _add_columns(connection, 'relay_settings', {
+        "WATER_COST_PER_M3": f"REAL NOT NULL DEFAULT {float(settings.DEFAULT_WATER_COST_PER_M3)}",
+        "RELAY_POWER_WATTS": f"REAL NOT NULL DEFAULT {float(settings.DEFAULT_RELAY_POWER_WATTS)}",
+        "ENERGY_COST_PER_KWH": f"REAL NOT NULL DEFAULT {float(settings.DEFAULT_ENERGY_COST_PER_KWH)}",
+        "CURRENCY_CODE": f"TEXT NOT NULL DEFAULT '{settings.DEFAULT_RELAY_CURRENCY}'",
+    })
+
+
+def _sensor_settings_liters_per_cm(connection):
+    # Formerly scripts/migrate_add_liters_per_cm_to_sensor_settings.sql
+    existing = _table_columns(connection, 'sensor_settings')
+    if not _add_columns(connection, 'sensor_settings', {"liters_per_cm": "REAL NOT NULL DEFAULT 10.0"}):
+        return False
+    if 'litros_por_cm' in existing and 'liters_per_cm' not in existing:
+        connection.execute(text("""
+            UPDATE sensor_settings SET liters_per_cm = litros_por_cm WHERE litros_por_cm IS NOT NULL
+        """))
+
+
+def _relay_daily_stats(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS relay_daily_stats (
+            relay_id INTEGER NOT NULL,
+            day_date TEXT NOT NULL,
+            on_seconds INTEGER NOT NULL DEFAULT 0,
+            liters_added REAL NOT NULL DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (relay_id, day_date)
+        )
+    """))
+    connection.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_relay_daily_stats_day
+        ON relay_daily_stats(day_date)
+    """))
+
+
+def _sensor_history_stats(connection):
+    # Sums are stored so averages stay exact when hourly buckets are merged into days.
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS sensor_hourly_stats (
+            sensor_id INTEGER NOT NULL,
+            hour_start INTEGER NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 0,
+            percent_sum REAL NOT NULL DEFAULT 0,
+            percent_min REAL,
+            percent_max REAL,
+            voltage_sum REAL NOT NULL DEFAULT 0,
+            voltage_min REAL,
+            voltage_max REAL,
+            updated_at TEXT,
+            PRIMARY KEY (sensor_id, hour_start)
+        )
+    """))
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS sensor_daily_stats (
+            sensor_id INTEGER NOT NULL,
+            day_date TEXT NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 0,
+            percent_sum REAL NOT NULL DEFAULT 0,
+            percent_min REAL,
+            percent_max REAL,
+            voltage_sum REAL NOT NULL DEFAULT 0,
+            voltage_min REAL,
+            voltage_max REAL,
+            updated_at TEXT,
+            PRIMARY KEY (sensor_id, day_date)
+        )
+    """))
+    connection.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_sensor_hourly_stats_hour
+        ON sensor_hourly_stats(hour_start)
+    """))
+
+
+def _relay_events_mask(connection):
+    if not _add_columns(connection, 'relay_events', {"mask": "INTEGER NOT NULL DEFAULT 0"}):
+        return False
+    last_id = 0
+    while True:
+        rows = connection.execute(text("""
+            SELECT id, events FROM relay_events WHERE id > :last_id ORDER BY id LIMIT 5000
+        """), {"last_id": last_id}).fetchall()
+        if not rows:
+            break
+        connection.execute(text("UPDATE relay_events SET mask = :mask WHERE id = :id"),
+                           [{"id": row[0], "mask": db.relay_events_mask(row[1] or '')} for row in rows])
+        last_id = rows[-1][0]
+    connection.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_relay_events_created_mask
+        ON relay_events(created_at, mask)
+    """))
+
+
+def _write_behind_batches(connection):
+    # Tokens of applied write-behind batches: a batch retried after a crash is not applied twice.
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS write_behind_batches (
+            token TEXT PRIMARY KEY,
+            applied_at TEXT NOT NULL
+        )
+    """))
+
+
+# Ordered schema changes: (version, name, apply(connection)). Append only; never renumber.
+# Steps are idempotent so a database upgraded by the old scripts, or two processes
+# migrating at once, end up in the same state. A step returns False when its table
+# does not exist yet: the version is left unrecorded and the step runs again next time.
+MIGRATIONS = (
+    (1, 'relay_settings cost and energy fields', _relay_settings_cost_fields),
+    (2, 'sensor_settings liters_per_cm', _sensor_settings_liters_per_cm),
+    (3, 'relay_daily_stats table', _relay_daily_stats),
+    (4, 'sensor hourly/daily history tables', _sensor_history_stats),
+    (5, 'relay_events mask bitmask and (created_at, mask) index', _relay_events_mask),
+    (6, 'write_behind_batches applied batch tokens', _write_behind_batches),
+)
+
+
+def applied_versions(connection):
+    """Return the set of migration versions recorded in `schema_version`."""
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    """))
+    return {row[0] for row in connection.execute(text("SELECT version FROM schema_version")).fetchall()}
+
+
+def migrate(engine=None):
+    """Apply pending schema migrations, each in its own transaction.
+
+    Meant to run once at process start (see `docker/entrypoint.sh`) so
+    request paths never issue DDL or schema introspection.
+
+    Args:
+        engine: SQLAlchemy engine (defaults to `db.engine`).
+
+    Returns:
+        list[int]: Versions applied by this call (skipped steps are not included).
+    """
+    engine = engine if engine is not None else db.engine
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+
+    applied = []
+    for version, name, apply in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as connection:
+            if apply(connection) is False:
+                logging.warning(f"migrations: skipped {version} ({name}), will retry on the next run")
+                continue
+            connection.execute(text("""
+                INSERT OR IGNORE INTO schema_version (version, name, applied_at)
+                VALUES (:version, :name, :applied_at)
+            """), {
+                "version": version,
+                "name": name,
+                "applied_at": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            })
+        logging.warning(f"migrations: applied {version} ({name})")
+        applied.append(version)
+    return applied
+
+
+@contextlib.contextmanager
+def _migration_lock(engine):
+    """Hold an exclusive lock file next to the SQLite database (no-op for in-memory databases)."""
+    database = engine.url.database
+    if not database or database == ':memory:':
+        yield
+        return
+    with open(f"{database}.migrate-lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def ensure_current(engine=None):
+    """Apply pending migrations at process start and refuse to run on an older schema.
+
+    Called before a server starts handling requests (`gunicorn.conf.py`
+    `on_starting`, the `__main__` blocks of api.py/app.py and the
+    background workers). Processes starting together take turns through a
+    lock file, so only the first one migrates; the others find the schema
+    current.
+
+    Args:
+        engine: SQLAlchemy engine (defaults to `db.engine`).
+
+    Raises:
+        RuntimeError: Versions are still pending after migrating (a step
+            whose table does not exist yet).
+    """
+    engine = engine if engine is not None else db.engine
+    with _migration_lock(engine):
+        migrate(engine)
+        with engine.begin() as connection:
+            done = applied_versions(connection)
+    pending = [version for version, _, _ in MIGRATIONS if version not in done]
+    if pending:
+        raise RuntimeError(f"database schema is behind, pending migrations: {pending} "
+                           f"(see scripts/README_migrations.md)")
+
+
+def main():
+    """Entrypoint: migrate the configured database and exit.
+
+    Returns:
+        None.
+    """
+    parser = argparse.ArgumentParser(description="Apply pending SQLite schema migrations")
+    parser.add_argument("--list", action="store_true", help="Show applied and pending versions only")
+    args = parser.parse_args()
+
+    if args.list:
+        with db.engine.begin() as connection:
+            done = applied_versions(connection)
+        for version, name, _ in MIGRATIONS:
+            print(f"{version:>4} {'applied' if version in done else 'pending'} {name}")
+        return
+
+    applied = migrate()
+    print(f"migrations: {len(applied)} applied, schema at version {MIGRATIONS[-1][0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import redis
+from flask import jsonify, request
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+import settings
+import redis_scripts
+
+
+STATS_KEY = 'rate-limit/stats'
+REJECTED_KEY = 'rate-limit/rejected'
+# Labels kept in the rejection ZSET (lowest counts are trimmed first).
+REJECTED_MAX_LABELS = 1000
+# In-process fallback buckets kept per worker while Redis is unavailable.
+LOCAL_MAX_BUCKETS = 10000
+
+LIMITED_DEVICE = 1
+LIMITED_IP = 2
+
+redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.API_REDIS_DB,
+    decode_responses=True,
+    socket_connect_timeout=1,
+    # Checked before every device request: fall back locally instead of stalling.
+    retry=Retry(NoBackoff(), 0),
+)
+
+take_script = redis_client.register_script(redis_scripts.RATE_LIMIT_TAKE)
+
+
+def parse_policy(value, default=(0.2, 10.0)):
+    """Parse a `<tokens per second>/<burst>` policy string.
+
+    Args:
+        value: Policy string such as `0.2/20`.
+        default: Policy returned when `value` is malformed.
+
+    Returns:
+        tuple[float, float]: `(rate, burst)`.
+    """
+    try:
+        rate, burst = (float(part) for part in str(value).split('/', 1))
+    except ValueError:
+        return default
+    if rate <= 0 or burst < 1:
+        return default
+    return rate, burst
+
+
+def parse_device_policies(value):
+    """Parse `<type>=<rate>/<burst>` entries into a policy per device type.
+
+    Returns:
+        dict[str, tuple[float, float]]: Policies keyed by device type digit.
+    """
+    policies = {}
+    for entry in str(value or '').split(','):
+        device_type, sep, policy = entry.strip().partition('=')
+        if sep and device_type:
+            policies[device_type] = parse_policy(policy)
+    return policies
+
+
+DEVICE_POLICIES = parse_device_policies(settings.RATE_LIMIT_DEVICE_POLICIES)
+DEFAULT_POLICY = parse_policy(settings.RATE_LIMIT_DEFAULT_POLICY)
+IP_POLICY = parse_policy(settings.RATE_LIMIT_IP_POLICY, default=(5.0, 100.0))
+
+
+def device_policy(private_key):
+    """Return the bucket policy for a private key.
+
+    Keys are issued as `<type>prv<random>`, so the device type is known
+    before the key is validated against the database.
+    """
+    return DEVICE_POLICIES.get((private_key or '')[:1], DEFAULT_POLICY)
+
+
+def device_label(private_key):
+    """Return a non-secret label for a private key (type prefix + short hash)."""
+    private_key = private_key or ''
+    digest = hashlib.sha256(private_key.encode('utf-8')).hexdigest()[:16]
+    return f"{private_key[:4]}:{digest}"
+
+
+def client_ip():
+    """Return the client address (nginx `X-Real-IP` when proxied)."""
+    return request.headers.get('X-Real-IP') or request.remote_addr or '-'
+
+
+class LocalBuckets:
+    """Per-process token buckets used while Redis is unavailable."""
+    def __init__(self, maxsize=LOCAL_MAX_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = Counter()
+
+    def _refill(self, key, rate, burst, now):
+        tokens, ts = self._buckets.get(key, (burst, now))
+        return min(burst, tokens + max(0.0, now - ts) * rate)
+
+    def take(self, device_key, ip_key, device_rate_burst, ip_rate_burst):
+        """Same contract as the Redis script: `(limited, retry_after_ms)`."""
+        now = time.monotonic()
+        with self._lock:
+            dev_tokens = self._refill(device_key, *device_rate_burst, now)
+            ip_tokens = self._refill(ip_key, *ip_rate_burst, now)
+            limited, retry_after = 0, 0
+            if dev_tokens < 1:
+                limited = LIMITED_DEVICE
+                retry_after = int((1 - dev_tokens) / device_rate_burst[0] * 1000) + 1
+                self.rejected['rejected_device'] += 1
+            elif ip_tokens < 1:
+                limited = LIMITED_IP
+                retry_after = int((1 - ip_tokens) / ip_rate_burst[0] * 1000) + 1
+                self.rejected['rejected_ip'] += 1
+            else:
+                dev_tokens -= 1
+                ip_tokens -= 1
+            for key, tokens in ((device_key, dev_tokens), (ip_key, ip_tokens)):
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return limited, retry_after
+
+
+local_buckets = LocalBuckets()
+
+
+def take(private_key, ip):
+    """Take one token from the device and IP buckets.
+
+    Args:
+        private_key: Unvalidated `key` query parameter.
+        ip: Client address.
+
+    Returns:
+        tuple[int, int]: `(limited, retry_after_ms)`; limited is 0 when the
+        request may proceed, `LIMITED_DEVICE` or `LIMITED_IP` otherwise.
+    """
+    label = device_label(private_key)
+    policy = device_policy(private_key)
+    try:
+        limited, retry_after = take_script(
+            keys=[f'rate-limit/dev/{label}', f'rate-limit/ip/{ip}', STATS_KEY, REJECTED_KEY],
+            args=[int(time.time() * 1000), policy[0], policy[1], IP_POLICY[0], IP_POLICY[1],
+                  f'dev:{label}', f'ip:{ip}', REJECTED_MAX_LABELS],
+            client=redis_client,
+        )
+        return int(limited), int(retry_after)
+    except redis.RedisError:
+        return local_buckets.take(f'dev:{label}', f'ip:{ip}', policy, IP_POLICY)
+
+
+def limit_device_requests(view):
+    """Reject flooding devices with 429 before any key validation or DB work."""
+    @functools.wraps(view)
+    def decorated_view(*args, **kwargs):
+        if not settings.RATE_LIMIT_ENABLED:
+            return view(*args, **kwargs)
+        limited, retry_after = take(request.args.get('key'), client_ip())
+        if limited:
+            response = jsonify({'error': 'rate limited'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(max(1, -(-retry_after // 1000)))
+            return response
+        return view(*args, **kwargs)
+
+    return decorated_view
+
+
+def stats(top=50):
+    """Return rejection totals and the most rejected device/IP labels.
+
+    Args:
+        top: Number of labels to return.
+
+    Returns:
+        dict: `totals` (Redis), `local` (this process fallback) and `top`
+        as `[label, count]` pairs, highest first.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(STATS_KEY)
+    pipe.zrevrange(REJECTED_KEY, 0, max(0, int(top) - 1), withscores=True)
+    totals, rejected = pipe.execute()
+    return {
+        'totals': {name: int(value) for name, value in (totals or {}).items()},
+        'local': dict(local_buckets.rejected),
+        'top': [[label, int(count)] for label, count in rejected],
+    }
@@ -0,0 +1,434 @@
+# Sensor `/update` ingest in a single round trip.
+#
+# KEYS[1] tin-keys/<public_key>        live state "distance|epoch|voltage|rssi"
+# KEYS[2] tin-hist/<public_key>/<hour> packed history for the current hour
+# KEYS[3] key-uptime/<device_id>/<hour> hourly uptime marker
+# KEYS[4] tin-rollup/<public_key>/<hour> hourly aggregate hash
+# KEYS[5..] relay-sensor/<relay_public_key> derived level pushed to each linked relay
+#
+# ARGV[1] now (epoch seconds)
+# ARGV[2] minimum seconds between accepted updates
+# ARGV[3] tolerance seconds subtracted from the minimum interval
+# ARGV[4] live state value to store on accept
+# ARGV[5] packed history record to append on accept ('' skips history)
+# ARGV[6] history key expiry (epoch seconds)
+# ARGV[7] uptime marker TTL seconds
+# ARGV[8] percent (integer) for the hourly aggregate
+# ARGV[9] centivolts (integer) for the hourly aggregate
+# ARGV[10] relay level value "sensor_key|percent|distance|epoch|liters" (with KEYS[5..])
+# ARGV[11] relay level TTL seconds
+# ARGV[12] live-update channel the accepted state is published on ('' skips)
+#
+# Returns {accepted, new_uptime_hour}: both 0/1 flags.
+SENSOR_INGEST = """
+local now = tonumber(ARGV[1])
+local min_interval = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+
+local new_uptime_hour = 0
+if redis.call('SET', KEYS[3], 'true', 'EX', ARGV[7], 'NX') then
+    new_uptime_hour = 1
+end
+
+local previous = redis.call('GET', KEYS[1])
+if previous then
+    local rtime = tonumber(string.match(previous, '^[^|]*|([^|]*)'))
+    if rtime and (now - rtime) + tolerance < min_interval then
+        return {0, new_uptime_hour}
+    end
+end
+
+redis.call('SET', KEYS[1], ARGV[4])
+if ARGV[5] ~= '' then
+    redis.call('APPEND', KEYS[2], ARGV[5])
+    redis.call('EXPIREAT', KEYS[2], ARGV[6])
+
+    local pct = tonumber(ARGV[8])
+    local cv = tonumber(ARGV[9])
+    local count = redis.call('HINCRBY', KEYS[4], 'n', 1)
+    redis.call('HINCRBY', KEYS[4], 'p_sum', pct)
+    redis.call('HINCRBY', KEYS[4], 'v_sum', cv)
+    local bounds = redis.call('HMGET', KEYS[4], 'p_min', 'p_max', 'v_min', 'v_max')
+    if count == 1 or not bounds[1] then
+        redis.call('HSET', KEYS[4], 'p_min', pct, 'p_max', pct, 'v_min', cv, 'v_max', cv)
+    else
+        if pct < tonumber(bounds[1]) then redis.call('HSET', KEYS[4], 'p_min', pct) end
+        if pct > tonumber(bounds[2]) then redis.call('HSET', KEYS[4], 'p_max', pct) end
+        if cv < tonumber(bounds[3]) then redis.call('HSET', KEYS[4], 'v_min', cv) end
+        if cv > tonumber(bounds[4]) then redis.call('HSET', KEYS[4], 'v_max', cv) end
+    end
+    redis.call('HSET', KEYS[4], 'p_last', pct, 'v_last', cv, 'ts_last', now)
+    redis.call('EXPIREAT', KEYS[4], ARGV[6])
+end
+for i = 5, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[10], 'EX', ARGV[11])
+end
+if ARGV[12] and ARGV[12] ~= '' then
+    redis.call('PUBLISH', ARGV[12], ARGV[4])
+end
+return {1, new_uptime_hour}
+"""
+
+
+# Rebuild one hourly aggregate from the packed history of that hour.
+#
+# Used after out-of-order or retried writes (`/update-batch`, migrations):
+# identical 5-byte records are counted once, matching history readers.
+#
+# KEYS[1] tin-hist/<public_key>/<hour>   packed records (ts_offset:u16, percent:u8, centivolts:u16, LE)
+# KEYS[2] tin-rollup/<public_key>/<hour> aggregate hash to replace
+#
+# ARGV[1] hour start (epoch seconds)
+# ARGV[2] aggregate expiry (epoch seconds)
+#
+# Returns the number of distinct samples aggregated.
+SENSOR_ROLLUP_REBUILD = """
+local blob = redis.call('GET', KEYS[1])
+redis.call('DEL', KEYS[2])
+if not blob then
+    return 0
+end
+
+local seen = {}
+local count, p_sum, v_sum = 0, 0, 0
+local p_min, p_max, v_min, v_max
+local last_offset, p_last, v_last = -1, 0, 0
+for i = 1, #blob - 4, 5 do
+    local record = string.sub(blob, i, i + 4)
+    if not seen[record] then
+        seen[record] = true
+        local b1, b2, pct, b4, b5 = string.byte(record, 1, 5)
+        local offset = b1 + b2 * 256
+        local cv = b4 + b5 * 256
+        count = count + 1
+        p_sum = p_sum + pct
+        v_sum = v_sum + cv
+        if not p_min or pct < p_min then p_min = pct end
+        if not p_max or pct > p_max then p_max = pct end
+        if not v_min or cv < v_min then v_min = cv end
+        if not v_max or cv > v_max then v_max = cv end
+        if offset >= last_offset then
+            last_offset, p_last, v_last = offset, pct, cv
+        end
+    end
+end
+
+if count == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[2],
+    'n', count, 'p_sum', p_sum, 'v_sum', v_sum,
+    'p_min', p_min, 'p_max', p_max, 'v_min', v_min, 'v_max', v_max,
+    'p_last', p_last, 'v_last', v_last, 'ts_last', tonumber(ARGV[1]) + last_offset)
+redis.call('EXPIREAT', KEYS[2], ARGV[2])
+return count
+"""
+
+
+# Mark an hourly aggregate as compacted into SQLite.
+#
+# Only marks the hash when its sample count still matches what was
+# compacted, so samples added meanwhile trigger another compaction, and
+# never recreates a hash that expired or is being rebuilt.
+#
+# KEYS[1] tin-rollup/<public_key>/<hour> aggregate hash
+#
+# ARGV[1] sample count that was compacted
+#
+# Returns 1 when marked, 0 otherwise.
+SENSOR_ROLLUP_MARK_COMPACTED = """
+if redis.call('HGET', KEYS[1], 'n') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'compacted', ARGV[1])
+return 1
+"""
+
+
+# Bounded write-behind enqueue.
+#
+# KEYS[1] write-behind intent list
+# KEYS[2] write-behind metrics hash
+#
+# ARGV[1] maximum pending intents
+# ARGV[2] JSON intent payload
+#
+# Returns 1 when queued, 0 when the queue is full (caller writes synchronously).
+WRITE_BEHIND_ENQUEUE = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    redis.call('HINCRBY', KEYS[2], 'rejected', 1)
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[2])
+redis.call('HINCRBY', KEYS[2], 'enqueued', 1)
+return 1
+"""
+
+
+# Pre-auth token buckets for device endpoints (per device key and per client IP).
+#
+# Both buckets are refilled and checked together; tokens are only taken when
+# both allow the request, so a rejected call does not drain the other bucket.
+#
+# KEYS[1] rate-limit/dev/<key hash>  bucket hash {tokens, ts}
+# KEYS[2] rate-limit/ip/<ip>         bucket hash {tokens, ts}
+# KEYS[3] rate-limit/stats           rejection totals hash
+# KEYS[4] rate-limit/rejected        ZSET of rejection counts per device/IP label
+#
+# ARGV[1] now (epoch milliseconds)
+# ARGV[2] device refill rate (tokens per second)
+# ARGV[3] device burst (bucket size)
+# ARGV[4] IP refill rate (tokens per second)
+# ARGV[5] IP burst (bucket size)
+# ARGV[6] device label for the rejection ZSET
+# ARGV[7] IP label for the rejection ZSET
+# ARGV[8] maximum labels kept in the rejection ZSET
+#
+# Returns {limited, retry_after_ms}: limited is 0 (allowed), 1 (device) or 2 (IP).
+RATE_LIMIT_TAKE = """
+local now = tonumber(ARGV[1])
+
+local function refill(key, rate, burst)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    if now > ts then
+        tokens = math.min(burst, tokens + (now - ts) / 1000 * rate)
+    end
+    return tokens
+end
+
+local function store(key, tokens, rate, burst)
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+
+local dev_rate, dev_burst = tonumber(ARGV[2]), tonumber(ARGV[3])
+local ip_rate, ip_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+local dev_tokens = refill(KEYS[1], dev_rate, dev_burst)
+local ip_tokens = refill(KEYS[2], ip_rate, ip_burst)
+
+local limited, retry_after = 0, 0
+if dev_tokens < 1 then
+    limited = 1
+    retry_after = math.ceil((1 - dev_tokens) / dev_rate * 1000)
+elseif ip_tokens < 1 then
+    limited = 2
+    retry_after = math.ceil((1 - ip_tokens) / ip_rate * 1000)
+else
+    dev_tokens = dev_tokens - 1
+    ip_tokens = ip_tokens - 1
+end
+store(KEYS[1], dev_tokens, dev_rate, dev_burst)
+store(KEYS[2], ip_tokens, ip_rate, ip_burst)
+
+if limited ~= 0 then
+    local label = ARGV[6]
+    if limited == 1 then
+        redis.call('HINCRBY', KEYS[3], 'rejected_device', 1)
+    else
+        redis.call('HINCRBY', KEYS[3], 'rejected_ip', 1)
+        label = ARGV[7]
+    end
+    redis.call('ZINCRBY', KEYS[4], 1, label)
+    local extra = redis.call('ZCARD', KEYS[4]) - tonumber(ARGV[8])
+    if extra > 0 then
+        redis.call('ZREMRANGEBYRANK', KEYS[4], 0, extra - 1)
+    end
+end
+return {limited, retry_after}
+"""
+
+
+# Relay heartbeat command hand-off: acknowledge, then deliver the next command.
+#
+# Commands are appended to a capped per-relay stream by `relay_commands.issue`.
+# One command is outstanding at a time: it is re-delivered on every heartbeat
+# until a heartbeat reports the status it asked for (acknowledged, latency
+# recorded) or the ack timeout passes (expired). Queued commands older than
+# the command TTL are skipped (stale) instead of actuating a pump late.
+#
+# KEYS[1] relay-commands/<public_key>      command stream {action, issued_at}
+# KEYS[2] relay-command-state/<public_key> hash {cursor, pending_id, pending_action, issued_at, delivered_at}
+# KEYS[3] relay-command/stats              fleet counters and latency histogram
+#
+# ARGV[1] now (epoch milliseconds)
+# ARGV[2] status reported by this heartbeat (0/1)
+# ARGV[3] ack timeout (milliseconds)
+# ARGV[4] command TTL (milliseconds)
+# ARGV[5] state hash TTL (seconds)
+# ARGV[6..] latency histogram upper bounds (milliseconds, ascending)
+#
+# Returns {action, ack_latency_ms}: action 0 when nothing is pending, latency
+# -1 when this heartbeat acknowledged nothing.
+RELAY_COMMAND_TAKE = """
+local now = tonumber(ARGV[1])
+local status = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[2], 'cursor', 'pending_id', 'pending_action', 'issued_at', 'delivered_at')
+local cursor = state[1] or '0-0'
+local latency = -1
+
+if state[2] then
+    local action = tonumber(state[3])
+    local expected = 0
+    if action == 1 then expected = 1 end
+    if status == expected then
+        latency = math.max(0, now - tonumber(state[4]))
+        local bucket = 'le_inf'
+        for i = 6, #ARGV do
+            if latency <= tonumber(ARGV[i]) then
+                bucket = 'le_' .. ARGV[i]
+                break
+            end
+        end
+        redis.call('HINCRBY', KEYS[3], 'acked', 1)
+        redis.call('HINCRBY', KEYS[3], 'latency_ms_sum', latency)
+        redis.call('HINCRBY', KEYS[3], bucket, 1)
+        redis.call('HSET', KEYS[2], 'last_latency_ms', latency)
+    elseif now - tonumber(state[5]) > tonumber(ARGV[3]) then
+        redis.call('HINCRBY', KEYS[3], 'expired', 1)
+    else
+        return {action, latency}
+    end
+    redis.call('HDEL', KEYS[2], 'pending_id', 'pending_action', 'issued_at', 'delivered_at')
+end
+
+local entries = redis.call('XRANGE', KEYS[1], cursor, '+', 'COUNT', 16)
+for _, entry in ipairs(entries) do
+    if entry[1] ~= cursor then
+        local fields = {}
+        for i = 1, #entry[2], 2 do
+            fields[entry[2][i]] = entry[2][i + 1]
+        end
+        cursor = entry[1]
+        if now - tonumber(fields['issued_at']) > tonumber(ARGV[4]) then
+            redis.call('HINCRBY', KEYS[3], 'stale', 1)
+        else
+            redis.call('HSET', KEYS[2], 'cursor', cursor, 'pending_id', cursor,
+                'pending_action', fields['action'], 'issued_at', fields['issued_at'], 'delivered_at', now)
+            redis.call('EXPIRE', KEYS[2], ARGV[5])
+            redis.call('HINCRBY', KEYS[3], 'delivered', 1)
+            return {tonumber(fields['action']), latency}
+        end
+    end
+end
+if cursor ~= (state[1] or '0-0') then
+    redis.call('HSET', KEYS[2], 'cursor', cursor)
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+end
+return {0, latency}
+"""
+
+
+# Relay heartbeat runtime accounting.
+#
+# Compares this heartbeat with the previous one and adds the ON seconds
+# (split per UTC day) and the liters gained while ON to per-relay daily
+# counters that `write_behind.flush_relay_daily` moves to SQLite. Runs in one
+# call, so concurrent heartbeats of a relay cannot count an interval twice.
+#
+# KEYS[1] relay-runtime-stats/<public_key> previous heartbeat "epoch|status|liters"
+# KEYS[2] relay-keys/<public_key>          live state "status|epoch|rssi" (fallback)
+# KEYS[3] relay-daily/pending              counters hash "<relay_id>|<day epoch>|on_seconds|liters"
+#
+# ARGV[1] now (epoch seconds)
+# ARGV[2] status reported by this heartbeat (0/1)
+# ARGV[3] current linked sensor liters ('none' when unknown)
+# ARGV[4] live state value to store
+# ARGV[5] relay device id
+# ARGV[6] runtime state TTL seconds
+# ARGV[7] live-update channel the new state is published on ('' skips)
+#
+# Returns {on_seconds, liters_added}: liters as a string (4 decimals).
+RELAY_RUNTIME_ACCOUNT = """
+local now = tonumber(ARGV[1])
+local liters = tonumber(ARGV[3])
+local prev_ts, prev_status, prev_liters
+
+local previous = redis.call('GET', KEYS[1])
+if previous then
+    local ts, st, lt = string.match(previous, '^([^|]*)|([^|]*)|([^|]*)')
+    prev_ts, prev_status, prev_liters = tonumber(ts), tonumber(st), tonumber(lt)
+    if not (prev_ts and prev_status) then
+        prev_ts, prev_status, prev_liters = nil, nil, nil
+    end
+end
+if not prev_ts then
+    local live = redis.call('GET', KEYS[2])
+    if live then
+        local st, ts = string.match(live, '^([^|]*)|([^|]*)|')
+        prev_ts, prev_status = tonumber(ts), tonumber(st)
+        if not (prev_ts and prev_status) then
+            prev_ts, prev_status = nil, nil
+        end
+    end
+end
+
+local on_seconds = 0
+local added = 0
+if prev_status == 1 and prev_ts and now > prev_ts then
+    local cursor = prev_ts
+    while cursor < now do
+        local day = cursor - (cursor % 86400)
+        local chunk_end = math.min(now, day + 86400)
+        redis.call('HINCRBY', KEYS[3], ARGV[5] .. '|' .. day .. '|on_seconds', chunk_end - cursor)
+        cursor = chunk_end
+    end
+    on_seconds = now - prev_ts
+    if prev_liters and liters and liters > prev_liters then
+        added = math.floor((liters - prev_liters) * 10000 + 0.5) / 10000
+        if added > 0 then
+            redis.call('HINCRBYFLOAT', KEYS[3], ARGV[5] .. '|' .. (now - (now % 86400)) .. '|liters',
+                       string.format('%.4f', added))
+        end
+    end
+end
+
+redis.call('SET', KEYS[1], ARGV[1] .. '|' .. ARGV[2] .. '|' .. ARGV[3], 'EX', ARGV[6])
+redis.call('SET', KEYS[2], ARGV[4])
+if ARGV[7] and ARGV[7] ~= '' then
+    redis.call('PUBLISH', ARGV[7], ARGV[4])
+end
+return {on_seconds, string.format('%.4f', added)}
+"""
+
+
+# Pop due scheduled relay actions (one ZRANGEBYSCORE + ZREM, O(log n + m)).
+#
+# KEYS[1] relay-schedule/due  sorted set "<schedule_id>|on|off" scored by due epoch
+#
+# ARGV[1] now (epoch seconds)
+# ARGV[2] maximum entries popped
+#
+# Returns a flat {member, score, ...} list of the entries removed.
+RELAY_SCHEDULE_POP_DUE = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[2]))
+for i = 1, #due, 2 do
+    redis.call('ZREM', KEYS[1], due[i])
+end
+return due
+"""
+
+
+# Add a relay schedule unless the relay already has the maximum (check and insert in one call).
+#
+# KEYS[1] relay-schedule/relay/<public_key>  set of the relay's schedule ids
+# KEYS[2] relay-schedule/defs                hash schedule_id -> definition
+# KEYS[3] relay-schedule/due                 sorted set of due actions
+# KEYS[4] relay-schedule/seq                 schedule id counter
+#
+# ARGV[1] maximum schedules per relay
+# ARGV[2] schedule definition
+# ARGV[3] first due epoch of the "on" action
+#
+# Returns the new schedule id, or false when the relay is at the limit.
+RELAY_SCHEDULE_ADD = """
+if redis.call('SCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return false
+end
+local schedule_id = tostring(redis.call('INCR', KEYS[4]))
+redis.call('HSET', KEYS[2], schedule_id, ARGV[2])
+redis.call('SADD', KEYS[1], schedule_id)
+redis.call('ZADD', KEYS[3], ARGV[3], schedule_id .. '|on')
+return schedule_id
+"""
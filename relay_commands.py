@@ -0,0 +1,239 @@
+import logging
+import os
+import threading
+import time
+
+import redis
+
+import settings
+import redis_scripts
+
+
+CHANNEL_PREFIX = 'relay-action/'
+STATS_KEY = 'relay-command/stats'
+# Held requests re-check for commands at least this often, in case a
+# wake-up was published while the listener was reconnecting.
+RECHECK_SECONDS = 5
+# Issue-to-acknowledge latency histogram bounds (milliseconds).
+LATENCY_BUCKETS_MS = (1000, 2000, 5000, 10000, 30000, 60000, 120000)
+STATE_TTL_SECONDS = 60 * 60 * 24
+
+_waiters = {}
+_waiters_lock = threading.Lock()
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.API_REDIS_DB,
+    decode_responses=True,
+    socket_connect_timeout=2,
+)
+
+take_script = redis_client.register_script(redis_scripts.RELAY_COMMAND_TAKE)
+
+
+def channel(public_key):
+    """Return the pub/sub channel announcing new actions for a relay."""
+    return f'{CHANNEL_PREFIX}{public_key}'
+
+
+def stream_key(public_key):
+    return f'relay-commands/{public_key}'
+
+
+def state_key(public_key):
+    return f'relay-command-state/{public_key}'
+
+
+def issue(public_key, action, now_ms=None):
+    """Queue a command for a relay and wake its held long-poll heartbeat.
+
+    Commands are kept in a capped per-relay stream and handed out one at a
+    time by `take`, so a second command queues behind the first instead of
+    overwriting it.
+
+    Args:
+        public_key: Relay public key.
+        action: `1` on or `-1` off.
+        now_ms: Issue time in epoch milliseconds (defaults to now).
+
+    Returns:
+        str: Stream entry id.
+    """
+    return issue_many({public_key: action}, now_ms=now_ms)[public_key]
+
+
+def issue_many(actions, now_ms=None):
+    """Queue commands for several relays in one pipelined round trip.
+
+    Args:
+        actions: Mapping `public_key -> action` (`1` on, `-1` off).
+        now_ms: Issue time in epoch milliseconds (defaults to now).
+
+    Returns:
+        dict: Stream entry id per public key.
+    """
+    issued_at = int(time.time() * 1000) if now_ms is None else int(now_ms)
+    public_keys = list(actions)
+    pipe = redis_client.pipeline(transaction=False)
+    for public_key in public_keys:
+        action = int(actions[public_key])
+        pipe.xadd(stream_key(public_key), {'action': action, 'issued_at': issued_at},
+                  maxlen=settings.RELAY_COMMAND_QUEUE_MAX, approximate=True)
+        pipe.expire(stream_key(public_key), STATE_TTL_SECONDS)
+        pipe.publish(channel(public_key), action)
+    results = pipe.execute() if public_keys else []
+    return {public_key: results[index * 3] for index, public_key in enumerate(public_keys)}
+
+
+def take(public_key, status, now_ms=None):
+    """Acknowledge the outstanding command and return the one to actuate.
+
+    Runs atomically in Redis (`redis_scripts.RELAY_COMMAND_TAKE`), so racing
+    heartbeats cannot both consume a command.
+
+    Args:
+        public_key: Relay public key.
+        status: Relay status reported by this heartbeat (`0`/`1`).
+        now_ms: Heartbeat time in epoch milliseconds (defaults to now).
+
+    Returns:
+        tuple[int, int]: `(action, ack_latency_ms)`; action is `0` when
+        nothing is pending and latency `-1` when nothing was acknowledged.
+    """
+    now_ms = int(time.time() * 1000) if now_ms is None else int(now_ms)
+    action, latency = take_script(
+        keys=[stream_key(public_key), state_key(public_key), STATS_KEY],
+        args=[now_ms, int(status), settings.RELAY_COMMAND_ACK_TIMEOUT_SECONDS * 1000,
+              settings.RELAY_COMMAND_TTL_SECONDS * 1000, STATE_TTL_SECONDS, *LATENCY_BUCKETS_MS],
+        client=redis_client,
+    )
+    return int(action), int(latency)
+
+
+def peek(public_key):
+    """Return the outstanding or next queued action without consuming it.
+
+    Args:
+        public_key: Relay public key.
+
+    Returns:
+        int: Action value (`0` when nothing is pending).
+    """
+    state = redis_client.hgetall(state_key(public_key)) or {}
+    if state.get('pending_action'):
+        return int(state['pending_action'])
+    cursor = state.get('cursor', '0-0')
+    for entry_id, fields in redis_client.xrange(stream_key(public_key), cursor, '+', count=2):
+        if entry_id != cursor:
+            return int(fields['action'])
+    return 0
+
+
+def _percentile(buckets, total, fraction):
+    seen = 0
+    for bound, count in buckets:
+        seen += count
+        if seen >= total * fraction:
+            return bound
+    return None
+
+
+def stats():
+    """Return fleet command counters and issue-to-acknowledge latency.
+
+    Percentiles are bucket upper bounds (`None` beyond the last bucket).
+
+    Returns:
+        dict: `delivered`, `acked`, `expired`, `stale`, `latency_ms_avg`,
+        `latency_ms_p50`, `latency_ms_p95` and `latency_ms_buckets`.
+    """
+    raw = {name: int(value) for name, value in (redis_client.hgetall(STATS_KEY) or {}).items()}
+    acked = raw.get('acked', 0)
+    buckets = [(bound, raw.get(f'le_{bound}', 0)) for bound in LATENCY_BUCKETS_MS]
+    buckets.append((None, raw.get('le_inf', 0)))
+    return {
+        'delivered': raw.get('delivered', 0),
+        'acked': acked,
+        'expired': raw.get('expired', 0),
+        'stale': raw.get('stale', 0),
+        'latency_ms_avg': round(raw.get('latency_ms_sum', 0) / acked) if acked else None,
+        'latency_ms_p50': _percentile(buckets, acked, 0.5) if acked else None,
+        'latency_ms_p95': _percentile(buckets, acked, 0.95) if acked else None,
+        'latency_ms_buckets': {('inf' if bound is None else str(bound)): count for bound, count in buckets},
+    }
+
+
+def _wake(public_key):
+    with _waiters_lock:
+        events = list(_waiters.get(public_key, ()))
+    for event in events:
+        event.set()
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(f'{CHANNEL_PREFIX}*')
+            for message in pubsub.listen():
+                if message.get('type') == 'pmessage':
+                    _wake(message['channel'][len(CHANNEL_PREFIX):])
+        except redis.RedisError:
+            logging.warning("relay-commands: action listener disconnected, retrying")
+        except Exception:
+            logging.exception("relay-commands: action listener failed")
+        time.sleep(1)
+
+
+def _ensure_listener():
+    """Start the pub/sub listener once per process (re-started after fork)."""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        threading.Thread(target=_listen, name='relay-action-listener', daemon=True).start()
+
+
+def wait_for_action(public_key, timeout, take_action):
+    """Hold a relay heartbeat until an action is posted or `timeout` passes.
+
+    One listener per worker process receives every relay's wake-ups and
+    signals the held requests for that relay, so a held request costs an
+    event, not a Redis connection. Meant for async (gevent) workers.
+
+    Args:
+        public_key: Relay public key.
+        timeout: Maximum seconds to hold the request.
+        take_action: Callable that atomically takes the next command,
+            returning 0 when there is none (see `take`).
+
+    Returns:
+        int: Action taken (`1` on, `-1` off) or `0` on timeout.
+    """
+    _ensure_listener()
+    event = threading.Event()
+    with _waiters_lock:
+        _waiters.setdefault(public_key, set()).add(event)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            # Registered before checking, so a command issued now still wakes us.
+            action = take_action()
+            remaining = deadline - time.monotonic()
+            if action or remaining <= 0:
+                return action
+            event.wait(min(remaining, RECHECK_SECONDS))
+            event.clear()
+    finally:
+        with _waiters_lock:
+            events = _waiters.get(public_key)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del _waiters[public_key]
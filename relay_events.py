@@ -0,0 +1,174 @@
+import datetime
+import logging
+import time
+
+import redis
+
+import settings
+import db
+
+
+# Per-relay capped event log (`relay-events/<public_key>` held the legacy single-value string).
+STREAM_PREFIX = 'relay-event-log/'
+# Relays with entries not yet persisted to SQLite, and the last persisted entry id per relay.
+DIRTY_KEY = 'relay-event-log/dirty'
+PERSISTED_KEY = 'relay-event-log/persisted'
+# Identical relay events reported within this window are stored once.
+DEDUPE_SECONDS = 30
+# Viewers without a cursor get the entries of this many recent seconds.
+VIEW_WINDOW_SECONDS = 60
+STREAM_TTL_SECONDS = 60 * 60 * 24 * 7
+
+redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.API_REDIS_DB,
+    decode_responses=True,
+    socket_connect_timeout=2,
+)
+
+
+def stream_key(public_key):
+    return f'{STREAM_PREFIX}{public_key}'
+
+
+def append(public_key, relay_id, events, at=None):
+    """Append a reported events CSV to the relay event log.
+
+    Args:
+        public_key: Relay public key.
+        relay_id: Relay device id (stored for bulk persistence).
+        events: Events CSV as reported in the `EVENTS` header.
+        at: Report time in epoch seconds (defaults to now).
+
+    Returns:
+        str: Stream entry id.
+    """
+    at = int(time.time()) if at is None else int(at)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.xadd(stream_key(public_key), {'relay_id': int(relay_id), 'events': events, 'at': at},
+              maxlen=settings.RELAY_EVENTS_STREAM_MAX, approximate=True)
+    pipe.expire(stream_key(public_key), STREAM_TTL_SECONDS)
+    pipe.sadd(DIRTY_KEY, public_key)
+    return pipe.execute()[0]
+
+
+def read(public_key, since=None, now_ms=None, count=100):
+    """Return log entries after a viewer cursor without consuming them.
+
+    Every viewer keeps its own cursor, so all of them see each event.
+
+    Args:
+        public_key: Relay public key.
+        since: Last entry id seen by the viewer; without one the entries of
+            the last `VIEW_WINDOW_SECONDS` are returned.
+        now_ms: Current time in epoch milliseconds (defaults to now).
+        count: Maximum entries returned.
+
+    Returns:
+        tuple[list[tuple[str, dict]], str]: `(entries, cursor)`; pass the
+        cursor back as `since` on the next read.
+    """
+    if since:
+        start = f'({since}'
+    else:
+        now_ms = int(time.time() * 1000) if now_ms is None else int(now_ms)
+        start = str(now_ms - VIEW_WINDOW_SECONDS * 1000)
+    entries = redis_client.xrange(stream_key(public_key), start, '+', count=count)
+    cursor = entries[-1][0] if entries else (since or start)
+    return entries, cursor
+
+
+def _stored_at(created_at):
+    """Epoch seconds of a stored `created_at` (local server time), or None."""
+    if isinstance(created_at, datetime.datetime):
+        return int(created_at.timestamp())
+    try:
+        return int(datetime.datetime.strptime(str(created_at), "%Y-%m-%d %H:%M:%S").timestamp())
+    except ValueError:
+        return None
+
+
+def dedupe(events_by_relay):
+    """Drop repeated relay events before they are stored.
+
+    A report equal to the previous one is skipped when it carries a
+    blind-area event (`1`/`2`) or arrives within `DEDUPE_SECONDS` of it. The
+    first report of each relay is compared with its last stored row (events
+    and `created_at`), so repeats are also dropped across flushes.
+
+    Args:
+        events_by_relay: Mapping `relay_id -> [(at_epoch, events_csv), ...]`
+            in report order.
+
+    Returns:
+        list[tuple[int, str, str]]: `(relay_id, events_csv, created_at)` rows.
+    """
+    rows = []
+    for relay_id, items in events_by_relay.items():
+        past_event = db.DevicesDB.get_relay_events(relay_id, 1)
+        last_events = past_event[0].get("events", "") if past_event else None
+        last_at = _stored_at(past_event[0].get("created_at")) if past_event else None
+        for at, events in items:
+            if events == last_events:
+                events_int = events.split(',')
+                if '1' in events_int or '2' in events_int:
+                    continue
+                if last_at is not None and at - last_at < DEDUPE_SECONDS:
+                    continue
+            created_at = datetime.datetime.fromtimestamp(at).strftime("%Y-%m-%d %H:%M:%S")
+            rows.append((relay_id, events, created_at))
+            last_events, last_at = events, at
+    return rows
+
+
+def persist(max_entries=None):
+    """Bulk-insert new log entries of every dirty relay into `relay_events`.
+
+    Relays are taken off the dirty set before their stream is read, so an
+    event appended meanwhile marks the relay dirty again. Cursors move only
+    after the transaction commits; a failed batch is retried on the next call.
+
+    Args:
+        max_entries: Maximum entries read per relay (defaults to settings).
+
+    Returns:
+        int: Number of rows inserted.
+    """
+    max_entries = max_entries or settings.WRITE_BEHIND_BATCH_SIZE
+    public_keys = redis_client.smembers(DIRTY_KEY)
+    if not public_keys:
+        return 0
+    public_keys = sorted(public_keys)
+    redis_client.srem(DIRTY_KEY, *public_keys)
+    cursors = redis_client.hmget(PERSISTED_KEY, public_keys)
+
+    events_by_relay = {}
+    new_cursors = {}
+    for public_key, cursor in zip(public_keys, cursors):
+        start = f'({cursor}' if cursor else '-'
+        entries = redis_client.xrange(stream_key(public_key), start, '+', count=max_entries)
+        if not entries:
+            continue
+        if len(entries) == max_entries:
+            # Backlog left: keep the relay dirty for the next call.
+            redis_client.sadd(DIRTY_KEY, public_key)
+        for _, fields in entries:
+            try:
+                events_by_relay.setdefault(int(fields['relay_id']), []).append((int(fields['at']), fields['events']))
+            except (KeyError, ValueError):
+                logging.warning(f"relay-events: dropping malformed entry for {public_key}: {fields}")
+        new_cursors[public_key] = entries[-1][0]
+    if not new_cursors:
+        return 0
+
+    try:
+        rows = dedupe(events_by_relay)
+        if rows:
+            db.DevicesDB.apply_write_batch(relay_events=rows)
+    except Exception:
+        logging.exception("relay-events: persist failed, retrying on next flush")
+        redis_client.sadd(DIRTY_KEY, *new_cursors)
+        return 0
+    redis_client.hset(PERSISTED_KEY, mapping=new_cursors)
+    return len(rows)
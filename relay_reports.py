@@ -0,0 +1,241 @@
+import datetime
+import logging
+import time
+
+import redis
+
+import settings
+import db
+import write_behind
+
+
+SUPPORTED_CURRENCY_CODES = {
+    'USD', 'DOP', 'EUR', 'MXN', 'COP', 'ARS', 'CLP', 'PEN', 'INR', 'CNY'
+}
+ONE_DAY = datetime.timedelta(days=1)
+
+redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.API_REDIS_DB,
+    decode_responses=True,
+    socket_connect_timeout=2,
+)
+
+
+def resolve_rates(relay_settings):
+    """Return the cost settings in effect for a relay.
+
+    Missing, invalid or non-positive values fall back to the global defaults.
+    The tuple is also the settings version reports are cached under.
+
+    Args:
+        relay_settings: Relay settings mapping (or None).
+
+    Returns:
+        tuple: `(water_cost_per_m3, relay_power_watts, energy_cost_per_kwh, currency_code)`.
+    """
+    water_cost_per_m3 = float(settings.DEFAULT_WATER_COST_PER_M3)
+    relay_power_watts = float(settings.DEFAULT_RELAY_POWER_WATTS)
+    energy_cost_per_kwh = float(settings.DEFAULT_ENERGY_COST_PER_KWH)
+    currency_code = str(settings.DEFAULT_RELAY_CURRENCY).upper()
+    if relay_settings:
+        try:
+            water_cost_per_m3 = float(relay_settings.get('WATER_COST_PER_M3', water_cost_per_m3) or water_cost_per_m3)
+        except Exception:
+            water_cost_per_m3 = float(settings.DEFAULT_WATER_COST_PER_M3)
+        try:
+            relay_power_watts = float(relay_settings.get('RELAY_POWER_WATTS', relay_power_watts) or relay_power_watts)
+        except Exception:
+            relay_power_watts = float(settings.DEFAULT_RELAY_POWER_WATTS)
+        try:
+            energy_cost_per_kwh = float(relay_settings.get('ENERGY_COST_PER_KWH', energy_cost_per_kwh) or energy_cost_per_kwh)
+        except Exception:
+            energy_cost_per_kwh = float(settings.DEFAULT_ENERGY_COST_PER_KWH)
+        try:
+            currency_candidate = str(relay_settings.get('CURRENCY_CODE', currency_code) or currency_code).strip().upper()
+            if currency_candidate in SUPPORTED_CURRENCY_CODES:
+                currency_code = currency_candidate
+        except Exception:
+            currency_code = str(settings.DEFAULT_RELAY_CURRENCY).upper()
+
+    if water_cost_per_m3 <= 0:
+        water_cost_per_m3 = float(settings.DEFAULT_WATER_COST_PER_M3)
+    if relay_power_watts <= 0:
+        relay_power_watts = float(settings.DEFAULT_RELAY_POWER_WATTS)
+    if energy_cost_per_kwh <= 0:
+        energy_cost_per_kwh = float(settings.DEFAULT_ENERGY_COST_PER_KWH)
+    return water_cost_per_m3, relay_power_watts, energy_cost_per_kwh, currency_code
+
+
+def summarize(on_minutes, liters, rates):
+    """Derive water and energy figures from ON minutes and liters.
+
+    Args:
+        on_minutes: Minutes the relay was ON.
+        liters: Liters added while ON.
+        rates: Tuple from `resolve_rates`.
+
+    Returns:
+        dict: `on_minutes`, `liters`, `water_cost`, `energy_cost`, `energy_wh`.
+    """
+    water_cost_per_m3, relay_power_watts, energy_cost_per_kwh, _ = rates
+    water_cost = (liters / 1000.0) * water_cost_per_m3
+    energy_wh = relay_power_watts * (on_minutes / 60.0)
+    energy_cost = (energy_wh / 1000.0) * energy_cost_per_kwh
+    return {
+        'on_minutes': on_minutes,
+        'liters': round(liters, 2),
+        'water_cost': round(water_cost, 4),
+        'energy_cost': round(energy_cost, 4),
+        'energy_wh': round(energy_wh, 2)
+    }
+
+
+def _totals(days, rates):
+    return summarize(sum(day['on_minutes'] for day in days), sum(day['liters'] for day in days), rates)
+
+
+def _next_month(month_start):
+    if month_start.month == 12:
+        return month_start.replace(year=month_start.year + 1, month=1)
+    return month_start.replace(month=month_start.month + 1)
+
+
+@db.cache.memoize(settings.RELAY_REPORT_CACHE_SECONDS)
+def settled_month(relay_id, month, through_day, rates, generation):
+    """Return the report of a month's settled days.
+
+    Settled days never change, so the document is memoized per relay,
+    month, last settled day, settings version (`rates`) and data
+    `generation`: a closed month is built once, the current month's
+    prefix once per day.
+
+    Args:
+        relay_id: Relay device id.
+        month: `YYYY-MM`.
+        through_day: Last day included (`YYYY-MM-DD`).
+        rates: Tuple from `resolve_rates`.
+        generation: `RELAY_REPORT_GENERATION_KEY` value.
+
+    Returns:
+        dict: `days` (one row per day) and `totals`.
+    """
+    days = [dict(day=item['day'], **summarize(int(item.get('on_minutes', 0) or 0),
+                                               float(item.get('liters', 0.0) or 0.0), rates))
+            for item in db.DevicesDB.get_relay_daily_stats(relay_id, start_date=f'{month}-01', end_date=through_day)]
+    return {'days': days, 'totals': _totals(days, rates)}
+
+
+def _live_days(relay_id, start_date, end_date, rates):
+    """Rows for days not settled yet: SQLite plus the counters still in Redis."""
+    items = db.DevicesDB.get_relay_daily_stats(relay_id, start_date=start_date, end_date=end_date)
+    fields = []
+    for item in items:
+        day_ts = int(datetime.datetime.strptime(item['day'], '%Y-%m-%d')
+                     .replace(tzinfo=datetime.timezone.utc).timestamp())
+        fields.extend([f'{relay_id}|{day_ts}|on_seconds', f'{relay_id}|{day_ts}|liters'])
+    pending = [None] * (2 * len(fields))
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hmget(write_behind.RELAY_DAILY_KEY, fields)
+        pipe.hmget(write_behind.RELAY_DAILY_FLUSHING_KEY, fields)
+        pending_values, flushing_values = pipe.execute()
+        pending = list(pending_values) + list(flushing_values)
+    except redis.RedisError:
+        logging.warning("relay-reports: pending counters unavailable")
+
+    days = []
+    for index, item in enumerate(items):
+        on_seconds = sum(float(pending[offset] or 0) for offset in (2 * index, len(fields) + 2 * index))
+        liters = sum(float(pending[offset] or 0) for offset in (2 * index + 1, len(fields) + 2 * index + 1))
+        on_minutes = int(item.get('on_minutes', 0) or 0) + int(round(on_seconds / 60.0))
+        liters += float(item.get('liters', 0.0) or 0.0)
+        days.append(dict(day=item['day'], **summarize(on_minutes, liters, rates)))
+    return days
+
+
+def _settled_context(now_ts):
+    settled = write_behind.relay_daily_settled_day(now_ts)
+    try:
+        generation = int(redis_client.get(write_behind.RELAY_REPORT_GENERATION_KEY) or 0)
+        build = settled_month
+    except redis.RedisError:
+        # Without the generation a cached document could be stale: build it directly.
+        logging.warning("relay-reports: generation unavailable, not using the report cache")
+        generation = None
+        build = settled_month.uncached
+    return settled, generation, build
+
+
+def _report(relay_id, start_date, end_date, rates, context):
+    settled, generation, build = context
+    start_key = start_date.strftime('%Y-%m-%d')
+    end_key = end_date.strftime('%Y-%m-%d')
+    days = []
+    month_start = start_date.replace(day=1)
+    while month_start <= end_date:
+        next_month = _next_month(month_start)
+        through_day = min(next_month - ONE_DAY, settled)
+        if through_day >= month_start:
+            document = build(relay_id, month_start.strftime('%Y-%m'), through_day.strftime('%Y-%m-%d'),
+                             rates, generation)
+            days.extend(day for day in document['days'] if start_key <= day['day'] <= end_key)
+        month_start = next_month
+
+    live_start = max(start_date, settled + ONE_DAY)
+    if live_start <= end_date:
+        days.extend(_live_days(relay_id, live_start, end_date, rates))
+    return {'days': days, 'totals': _totals(days, rates)}
+
+
+def report(relay_id, start_date, end_date, rates, now_ts=None):
+    """Return the daily consumption report of a relay for a date range.
+
+    Settled days come from the memoized month documents (`settled_month`);
+    only the days after them (today, and yesterday until its counters are
+    flushed) are read from SQLite and the pending Redis counters.
+
+    Args:
+        relay_id: Relay device id.
+        start_date: First day (`datetime.date`).
+        end_date: Last day (`datetime.date`), inclusive.
+        rates: Tuple from `resolve_rates`.
+        now_ts: Current epoch seconds (defaults to now).
+
+    Returns:
+        dict: `days` (zero-filled, one row per day) and `totals`.
+    """
+    now_ts = time.time() if now_ts is None else now_ts
+    return _report(relay_id, start_date, end_date, rates, _settled_context(now_ts))
+
+
+def year_report(relay_id, year, end_date, rates, now_ts=None):
+    """Return one summary row per month of a year, up to `end_date`.
+
+    Args:
+        relay_id: Relay device id.
+        year: Calendar year.
+        end_date: Last day included (`datetime.date`, usually today).
+        rates: Tuple from `resolve_rates`.
+        now_ts: Current epoch seconds (defaults to now).
+
+    Returns:
+        dict: `months` (`month` plus the `summarize` fields) and `totals`.
+    """
+    now_ts = time.time() if now_ts is None else now_ts
+    context = _settled_context(now_ts)
+    settled, generation, build = context
+    months = []
+    month_start = datetime.date(year, 1, 1)
+    while month_start.year == year and month_start <= end_date:
+        last_day = _next_month(month_start) - ONE_DAY
+        if last_day <= min(settled, end_date):
+            # Closed month: its cached document already carries the summary.
+            totals = build(relay_id, month_start.strftime('%Y-%m'), last_day.strftime('%Y-%m-%d'),
+                           rates, generation)['totals']
+        else:
+            totals = _report(relay_id, month_start, min(last_day, end_date), rates, context)['totals']
+        months.append(dict(month=month_start.strftime('%Y-%m'), **totals))
+        month_start = _next_month(month_start)
+    return {'months': months, 'totals': _totals(months, rates)}
@@ -0,0 +1,297 @@
+import argparse
+import datetime
+import logging
+import signal
+import time
+import zoneinfo
+
+import redis
+
+import settings
+import redis_scripts
+import relay_commands
+
+
+# Due actions "<schedule_id>|on" / "<schedule_id>|off" scored by due epoch seconds.
+DUE_KEY = 'relay-schedule/due'
+# Schedule definitions: schedule_id -> "public_key|HH:MM|duration_minutes|action|timezone".
+DEFS_KEY = 'relay-schedule/defs'
+SEQ_KEY = 'relay-schedule/seq'
+POP_BATCH = 500
+# Zone of schedules created without one (and of definitions stored before zones were kept).
+DEFAULT_TIMEZONE = 'UTC'
+
+redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.API_REDIS_DB,
+    decode_responses=True,
+    socket_connect_timeout=2,
+)
+
+pop_due_script = redis_client.register_script(redis_scripts.RELAY_SCHEDULE_POP_DUE)
+add_script = redis_client.register_script(redis_scripts.RELAY_SCHEDULE_ADD)
+
+
+def relay_key(public_key):
+    return f'relay-schedule/relay/{public_key}'
+
+
+def parse_time(at):
+    """Parse a `HH:MM` time of day.
+
+    Returns:
+        tuple[int, int]: `(hour, minute)`.
+
+    Raises:
+        ValueError: When `at` is not a valid time of day.
+    """
+    hour, minute = (int(part) for part in str(at).strip().split(':'))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"invalid time of day: {at}")
+    return hour, minute
+
+
+def get_zone(tz):
+    """Return the `ZoneInfo` of an IANA timezone name.
+
+    Raises:
+        ValueError: When `tz` is not a known timezone.
+    """
+    try:
+        return zoneinfo.ZoneInfo(str(tz))
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"unknown timezone: {tz}")
+
+
+def next_run(at, after_ts, tz=DEFAULT_TIMEZONE):
+    """Return the first `HH:MM` in timezone `tz` strictly after `after_ts`.
+
+    Args:
+        at: Time of day as `HH:MM`.
+        after_ts: Epoch seconds.
+        tz: IANA timezone the time of day is given in.
+
+    Returns:
+        int: Epoch seconds of the next occurrence.
+    """
+    hour, minute = parse_time(at)
+    zone = get_zone(tz)
+    day = datetime.datetime.fromtimestamp(after_ts, zone).date()
+    candidate = datetime.datetime.combine(day, datetime.time(hour, minute), tzinfo=zone)
+    if candidate.timestamp() <= after_ts:
+        candidate = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(hour, minute),
+                                              tzinfo=zone)
+    return int(candidate.timestamp())
+
+
+def _parse_def(raw):
+    public_key, at, duration, action, *tz = raw.split('|')
+    return {'public_key': public_key, 'at': at, 'duration_minutes': int(duration), 'action': int(action),
+            'timezone': tz[0] if tz else DEFAULT_TIMEZONE}
+
+
+def add(public_key, at, duration_minutes=0, action=1, now_ts=None, tz=DEFAULT_TIMEZONE):
+    """Schedule a daily relay action, e.g. on at 06:00 for 20 minutes.
+
+    Args:
+        public_key: Relay public key.
+        at: Time of day (`HH:MM` in `tz`).
+        duration_minutes: When set, the opposite action follows after this
+            many minutes (`0` sends only `action`).
+        action: `1` on or `-1` off.
+        now_ts: Current epoch seconds (defaults to now).
+        tz: IANA timezone of `at` (the user's zone; daylight saving time
+            shifts are followed).
+
+    Returns:
+        str: Schedule id.
+
+    Raises:
+        ValueError: On invalid values or when the relay already has
+            `RELAY_SCHEDULES_MAX_PER_RELAY` schedules.
+    """
+    hour, minute = parse_time(at)
+    at = f'{hour:02d}:{minute:02d}'
+    duration_minutes = int(duration_minutes)
+    action = int(action)
+    if action not in (1, -1) or not 0 <= duration_minutes <= 24 * 60:
+        raise ValueError("invalid action or duration")
+    tz = str(tz or DEFAULT_TIMEZONE)
+    get_zone(tz)
+
+    now_ts = int(time.time()) if now_ts is None else int(now_ts)
+    # The limit check and the insert run in one script, so concurrent adds cannot exceed it.
+    schedule_id = add_script(
+        keys=[relay_key(public_key), DEFS_KEY, DUE_KEY, SEQ_KEY],
+        args=[settings.RELAY_SCHEDULES_MAX_PER_RELAY, f'{public_key}|{at}|{duration_minutes}|{action}|{tz}',
+              next_run(at, now_ts, tz)],
+        client=redis_client,
+    )
+    if not schedule_id:
+        raise ValueError("too many schedules for this relay")
+    return str(schedule_id)
+
+
+def remove(public_key, schedule_id):
+    """Delete one of a relay's schedules, including a pending follow-up action.
+
+    Returns:
+        bool: True when the schedule existed for that relay.
+    """
+    schedule_id = str(schedule_id)
+    if not redis_client.sismember(relay_key(public_key), schedule_id):
+        return False
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hdel(DEFS_KEY, schedule_id)
+    pipe.srem(relay_key(public_key), schedule_id)
+    pipe.zrem(DUE_KEY, f'{schedule_id}|on', f'{schedule_id}|off')
+    pipe.execute()
+    return True
+
+
+def list_schedules(public_key):
+    """Return a relay's schedules with their next start time.
+
+    Returns:
+        list[dict]: `id`, `at`, `duration_minutes`, `action`, `timezone`
+        (the zone `at` is in) and `next_run` (epoch seconds), ordered by
+        time of day.
+    """
+    schedule_ids = sorted(redis_client.smembers(relay_key(public_key)), key=int)
+    if not schedule_ids:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hmget(DEFS_KEY, schedule_ids)
+    for schedule_id in schedule_ids:
+        pipe.zscore(DUE_KEY, f'{schedule_id}|on')
+    raw_defs, *scores = pipe.execute()
+
+    schedules = []
+    for schedule_id, raw, score in zip(schedule_ids, raw_defs, scores):
+        if not raw:
+            continue
+        item = _parse_def(raw)
+        del item['public_key']
+        schedules.append({'id': schedule_id, **item, 'next_run': int(score) if score is not None else None})
+    return sorted(schedules, key=lambda item: item['at'])
+
+
+def run_due(now_ts=None, limit=POP_BATCH):
+    """Send every due scheduled action and queue its next occurrence.
+
+    Due entries are popped from the sorted set in one script call, so the
+    cost is O(log n) per due action however many schedules exist. Starts
+    due longer than `RELAY_COMMAND_TTL_SECONDS` ago (scheduler down) are
+    skipped; follow-up actions are always sent. A relay gets one command per
+    call: when several of its entries are due together (a follow-up "off"
+    and another schedule's start, or two schedules at the same minute) the
+    latest due one wins and the others are logged as superseded. When the
+    commands cannot be queued the popped entries are put back.
+
+    Args:
+        now_ts: Current epoch seconds (defaults to now).
+        limit: Maximum entries handled per call.
+
+    Returns:
+        int: Due actions handled (sent or superseded).
+    """
+    now_ts = int(time.time()) if now_ts is None else int(now_ts)
+    popped = pop_due_script(keys=[DUE_KEY], args=[now_ts, limit], client=redis_client)
+    entries = [(popped[i], int(float(popped[i + 1]))) for i in range(0, len(popped), 2)]
+    if not entries:
+        return 0
+
+    schedule_ids = [member.split('|')[0] for member, _ in entries]
+    raw_defs = dict(zip(schedule_ids, redis_client.hmget(DEFS_KEY, schedule_ids)))
+    actions = {}
+    superseded = 0
+    reschedule = {}
+
+    def queue(public_key, action, member):
+        nonlocal superseded
+        if public_key in actions:
+            superseded += 1
+            logging.warning(f"relay-scheduler: {public_key}: {actions[public_key][1]} superseded by {member}")
+        actions[public_key] = (action, member)
+
+    # Entries come in due order, so a later entry for the same relay replaces an earlier one.
+    for member, due_ts in sorted(entries, key=lambda entry: entry[1]):
+        schedule_id, phase = member.split('|')
+        raw = raw_defs.get(schedule_id)
+        if not raw:
+            continue
+        schedule = _parse_def(raw)
+        if phase == 'off':
+            queue(schedule['public_key'], -schedule['action'], member)
+            continue
+        if due_ts >= now_ts - settings.RELAY_COMMAND_TTL_SECONDS:
+            queue(schedule['public_key'], schedule['action'], member)
+            if schedule['duration_minutes']:
+                reschedule[f'{schedule_id}|off'] = due_ts + schedule['duration_minutes'] * 60
+        reschedule[member] = next_run(schedule['at'], max(due_ts, now_ts), schedule['timezone'])
+
+    try:
+        if actions:
+            relay_commands.issue_many({public_key: action for public_key, (action, _) in actions.items()})
+    except Exception:
+        logging.exception("relay-scheduler: issue failed, re-queueing due actions")
+        redis_client.zadd(DUE_KEY, dict(entries))
+        return 0
+    if reschedule:
+        redis_client.zadd(DUE_KEY, reschedule)
+    return len(actions) + superseded
+
+
+class RelayScheduler:
+    """Periodically send due scheduled relay actions."""
+    def __init__(self, interval):
+        self.interval = max(1, int(interval))
+        self.running = True
+
+    def run(self, once=False):
+        """Run the scheduler loop until stopped.
+
+        Args:
+            once: When True, handle due actions once and exit.
+
+        Returns:
+            None.
+        """
+        while self.running:
+            try:
+                while run_due() and self.running:
+                    pass
+            except Exception:
+                logging.exception("relay-scheduler: run failed")
+            if once:
+                return
+            deadline = time.time() + self.interval
+            while self.running and time.time() < deadline:
+                time.sleep(min(1.0, self.interval))
+
+
+def main():
+    """Entrypoint for the scheduled relay actions service.
+
+    Returns:
+        None.
+    """
+    parser = argparse.ArgumentParser(description="Send scheduled relay actions when due")
+    parser.add_argument("--interval", type=int, default=settings.RELAY_SCHEDULER_INTERVAL_SECONDS,
+                        help="Seconds between checks for due actions")
+    parser.add_argument("--once", action="store_true", help="Handle due actions once and exit")
+    args = parser.parse_args()
+
+    scheduler = RelayScheduler(args.interval)
+
+    def _stop(*_):
+        scheduler.running = False
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    scheduler.run(once=args.once)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+import redis
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import settings  # noqa: E402
+import sensor_history  # noqa: E402
+
+
+def build_samples(days, interval):
+    """Build synthetic `(ts, percent, voltage)` samples ending now.
+
+    Args:
+        days: History length in days.
+        interval: Seconds between samples.
+
+    Returns:
+        list[tuple[int, int, float]]: Samples in time order.
+    """
+    now_ts = int(time.time())
+    start_ts = now_ts - days * 86400
+    return [
+        (ts, random.randint(0, 100), round(random.uniform(3.3, 4.2), 2))
+        for ts in range(start_ts, now_ts, interval)
+    ]
+
+
+def memory_usage(client, keys):
+    """Sum `MEMORY USAGE` (bytes) across keys."""
+    return sum(client.memory_usage(key, samples=0) or 0 for key in keys)
+
+
+def main():
+    """Compare Redis memory of the legacy ZSET and packed hourly history layouts.
+
+    Returns:
+        None.
+    """
+    parser = argparse.ArgumentParser(description="Sensor history memory benchmark (ZSET vs packed strings)")
+    parser.add_argument("--days", type=int, default=3, help="History length in days")
+    parser.add_argument("--interval", type=int, default=30, help="Seconds between samples")
+    parser.add_argument("--db", type=int, default=15, help="Scratch Redis DB (keys are removed afterwards)")
+    args = parser.parse_args()
+
+    client = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=args.db)
+    public_key = f"bench{os.getpid()}"
+    samples = build_samples(args.days, args.interval)
+
+    legacy = sensor_history.legacy_key(public_key)
+    pipe = client.pipeline(transaction=False)
+    for ts, percent, voltage in samples:
+        pipe.zadd(legacy, {f"{percent}|{voltage}|{time.time_ns()}": ts})
+    sensor_history.append_samples(pipe, public_key, samples, sensor_history.RETENTION_SECONDS)
+    pipe.execute()
+
+    packed_keys = sorted({sensor_history.hour_key(public_key, sensor_history.hour_start(ts)) for ts, _, _ in samples})
+    try:
+        zset_bytes = memory_usage(client, [legacy])
+        packed_bytes = memory_usage(client, packed_keys)
+    finally:
+        client.delete(legacy, *packed_keys)
+
+    points = len(samples)
+    print(f"points: {points} ({args.days} days every {args.interval}s)")
+    print(f"zset:   {zset_bytes} bytes, {zset_bytes / points:.1f} bytes/point")
+    print(f"packed: {packed_bytes} bytes, {packed_bytes / points:.1f} bytes/point "
+          f"({len(packed_keys)} keys, {sensor_history.RECORD.size} bytes/record)")
+    if packed_bytes:
+        print(f"ratio:  {zset_bytes / packed_bytes:.1f}x smaller")
+
+
+if __name__ == "__main__":
+    main()
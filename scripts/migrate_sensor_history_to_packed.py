@@ -0,0 +1,104 @@
+import argparse
+import os
+import sys
+
+import redis
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import redis_scripts  # noqa: E402
+import settings  # noqa: E402
+import sensor_history  # noqa: E402
+
+
+def migrate_device(client, public_key, delete_legacy=False):
+    """Copy a device's legacy ZSET history into packed hourly keys.
+
+    Points already present in the packed keys are skipped, so the migration
+    can be re-run safely while devices keep reporting. Hourly rollups of the
+    touched hours are rebuilt from the packed keys afterwards.
+
+    Args:
+        client: Redis client with `decode_responses=False`.
+        public_key: Sensor public key.
+        delete_legacy: Delete the legacy ZSET after copying.
+
+    Returns:
+        int: Number of points copied.
+    """
+    members = client.zrange(sensor_history.legacy_key(public_key), 0, -1, withscores=True)
+    samples = []
+    for member, score in members:
+        parsed = sensor_history.parse_legacy_member(member.decode(errors='ignore'))
+        if parsed is not None:
+            samples.append((int(score), parsed[0], parsed[1]))
+
+    hour_starts = sorted({sensor_history.hour_start(ts) for ts, _, _ in samples})
+    existing = sensor_history.read_hours(client, public_key, hour_starts)
+    present = {
+        (ts, int(round(percent)), int(round(voltage * 100)))
+        for hour_samples in existing.values() for ts, percent, voltage in hour_samples
+    }
+    pending = sorted(
+        sample for sample in samples
+        if (sample[0], int(round(sample[1])), int(round(sample[2] * 100))) not in present
+    )
+
+    pipe = client.pipeline(transaction=True)
+    if pending:
+        rollup_script = client.register_script(redis_scripts.SENSOR_ROLLUP_REBUILD)
+        for hour_ts in sensor_history.append_samples(pipe, public_key, pending, sensor_history.RETENTION_SECONDS):
+            rollup_script(
+                keys=[sensor_history.hour_key(public_key, hour_ts), sensor_history.rollup_key(public_key, hour_ts)],
+                args=[hour_ts, sensor_history.expire_at(hour_ts, sensor_history.RETENTION_SECONDS)],
+                client=pipe
+            )
+    if delete_legacy:
+        pipe.delete(sensor_history.legacy_key(public_key))
+    pipe.execute()
+    return len(pending)
+
+
+def parse_args():
+    """Parse CLI arguments for the history migration.
+
+    Returns:
+        argparse.Namespace: Parsed command-line options.
+    """
+    parser = argparse.ArgumentParser(
+        description="Migrate tin-history/<pub> ZSET sensor history to packed tin-hist/<pub>/<hour> strings"
+    )
+    parser.add_argument("--public-key", default="", help="Migrate a single device (default: all devices)")
+    parser.add_argument("--delete-legacy", action="store_true", help="Delete each legacy ZSET after copying")
+    return parser.parse_args()
+
+
+def main():
+    """Entrypoint for the sensor history migration.
+
+    Returns:
+        None.
+    """
+    args = parse_args()
+    client = redis.StrictRedis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.API_REDIS_DB,
+        decode_responses=False
+    )
+
+    if args.public_key:
+        public_keys = [args.public_key]
+    else:
+        public_keys = [key.decode().split('/', 1)[1] for key in client.scan_iter(match='tin-history/*', count=500)]
+
+    total = 0
+    for public_key in public_keys:
+        copied = migrate_device(client, public_key, delete_legacy=args.delete_legacy)
+        total += copied
+        print(f"{public_key}: {copied} points")
+    print(f"migrated {len(public_keys)} devices, {total} points")
+
+
+if __name__ == "__main__":
+    main()
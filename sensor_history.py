@@ -0,0 +1,335 @@
+import struct
+
+import numpy as np
+
+
+HOUR_SECONDS = 3600
+RETENTION_SECONDS = 60 * 60 * 24 * 3
+
+# Bucket widths and aggregations accepted by `bucket_stats`.
+BUCKET_WIDTHS = {'5m': 300, '15m': 900, '1h': 3600, '1d': 86400}
+AGGREGATIONS = ('avg', 'min', 'max', 'last', 'count')
+
+# One Redis string per device per hour holding fixed-width packed records:
+# (ts offset within the hour: u16, percent: u8, centivolts: u16) = 5 bytes.
+RECORD = struct.Struct('<HBH')
+
+
+def hour_start(ts):
+    """Return the epoch of the hour containing `ts`."""
+    ts = int(ts)
+    return ts - (ts % HOUR_SECONDS)
+
+
+def hour_key(public_key, hour_start_ts):
+    """Return the packed history key for a device hour."""
+    return f'tin-hist/{public_key}/{int(hour_start_ts)}'
+
+
+def rollup_key(public_key, hour_start_ts):
+    """Return the hourly aggregate hash key for a device hour."""
+    return f'tin-rollup/{public_key}/{int(hour_start_ts)}'
+
+
+def legacy_key(public_key):
+    """Return the legacy ZSET history key (`percent|voltage[|unique]` members)."""
+    return f'tin-history/{public_key}'
+
+
+def record_values(percent, voltage):
+    """Clamp a sample to the stored integer units.
+
+    Args:
+        percent: Fill percent (clamped to 0-255).
+        voltage: Battery voltage in volts.
+
+    Returns:
+        tuple[int, int]: `(percent, centivolts)`.
+    """
+    percent = int(max(0, min(255, round(float(percent)))))
+    centivolts = int(max(0, min(65535, round(float(voltage) * 100))))
+    return percent, centivolts
+
+
+def pack_record(ts, percent, voltage):
+    """Pack one sample into a fixed-width record.
+
+    Args:
+        ts: Sample epoch seconds.
+        percent: Fill percent (clamped to 0-255).
+        voltage: Battery voltage in volts (stored as centivolts).
+
+    Returns:
+        bytes: `RECORD.size` bytes.
+    """
+    return RECORD.pack(int(ts) % HOUR_SECONDS, *record_values(percent, voltage))
+
+
+def unpack_records(blob, hour_start_ts):
+    """Decode a packed hour blob into samples.
+
+    A trailing partial record (interrupted write) is ignored.
+
+    Args:
+        blob: Raw bytes stored at `hour_key(...)`.
+        hour_start_ts: Epoch of the hour the blob belongs to.
+
+    Returns:
+        list[tuple[int, int, float]]: `(ts, percent, voltage)` in storage order.
+    """
+    if not blob:
+        return []
+    usable = len(blob) - (len(blob) % RECORD.size)
+    return [
+        (hour_start_ts + offset, percent, centivolts / 100.0)
+        for offset, percent, centivolts in RECORD.iter_unpack(bytes(blob[:usable]))
+    ]
+
+
+def parse_legacy_member(member):
+    """Parse a legacy ZSET member `percent|voltage[|unique_suffix]`.
+
+    Returns:
+        tuple[float, float] | None: `(percent, voltage)` or None when malformed.
+    """
+    try:
+        parts = member.split('|')
+        if len(parts) < 2:
+            return None
+        return float(parts[0]), float(parts[1])
+    except Exception:
+        return None
+
+
+def expire_at(hour_start_ts, retention_seconds):
+    """Return the epoch at which a packed hour key expires."""
+    return int(hour_start_ts) + HOUR_SECONDS + int(retention_seconds)
+
+
+def append_samples(pipe, public_key, samples, retention_seconds):
+    """Queue APPEND/EXPIREAT commands for samples on a Redis pipeline.
+
+    Samples are grouped per hour so each hour key gets a single APPEND.
+
+    Args:
+        pipe: Redis pipeline (or client).
+        public_key: Sensor public key.
+        samples: Iterable of `(ts, percent, voltage)`.
+        retention_seconds: History retention window.
+
+    Returns:
+        list[int]: Hour starts written, in ascending order.
+    """
+    by_hour = {}
+    for ts, percent, voltage in samples:
+        by_hour.setdefault(hour_start(ts), []).append(pack_record(ts, percent, voltage))
+    for hour_ts, records in by_hour.items():
+        key = hour_key(public_key, hour_ts)
+        pipe.append(key, b''.join(records))
+        pipe.expireat(key, expire_at(hour_ts, retention_seconds))
+    return sorted(by_hour)
+
+
+def read_hours(client, public_key, hour_starts, legacy_client=None):
+    """Read samples for several hours of a device in one round trip.
+
+    Packed hour keys are fetched with a single pipeline. When `legacy_client`
+    is given, points still held in the legacy ZSET (not yet migrated or
+    expired) are merged in. Identical samples (e.g. a retried batch upload)
+    are reported once.
+
+    Args:
+        client: Redis client returning bytes (`decode_responses=False`).
+        public_key: Sensor public key.
+        hour_starts: Hour-aligned epochs to read.
+        legacy_client: Optional string client used for the legacy ZSET.
+
+    Returns:
+        dict[int, list[tuple[int, float, float]]]: Samples per hour sorted by ts.
+    """
+    hour_starts = [int(ts) for ts in hour_starts]
+    samples = {ts: set() for ts in hour_starts}
+    if not hour_starts:
+        return {}
+
+    pipe = client.pipeline(transaction=False)
+    for hour_ts in hour_starts:
+        pipe.get(hour_key(public_key, hour_ts))
+    for hour_ts, blob in zip(hour_starts, pipe.execute()):
+        samples[hour_ts].update(unpack_records(blob, hour_ts))
+
+    if legacy_client is not None:
+        members = legacy_client.zrangebyscore(
+            legacy_key(public_key), min(hour_starts), max(hour_starts) + HOUR_SECONDS - 1, withscores=True)
+        for member, score in members or []:
+            parsed = parse_legacy_member(member)
+            bucket = samples.get(hour_start(score))
+            if parsed is None or bucket is None:
+                continue
+            bucket.add((int(score), parsed[0], parsed[1]))
+
+    return {hour_ts: sorted(bucket) for hour_ts, bucket in samples.items()}
+
+
+def summarize(samples):
+    """Aggregate raw samples into the hourly rollup shape.
+
+    Args:
+        samples: `(ts, percent, voltage)` tuples sorted by ts.
+
+    Returns:
+        dict | None: Hour summary (see `decode_rollup`) or None when empty.
+    """
+    if not samples:
+        return None
+    percents = [float(percent) for _, percent, _ in samples]
+    volts = [float(voltage) for _, _, voltage in samples]
+    return {
+        'count': len(samples),
+        'percent_avg': sum(percents) / len(percents),
+        'percent_min': min(percents),
+        'percent_max': max(percents),
+        'percent_last': percents[-1],
+        'voltage_avg': sum(volts) / len(volts),
+        'voltage_min': min(volts),
+        'voltage_max': max(volts),
+        'voltage_last': volts[-1],
+        'last_ts': int(samples[-1][0]),
+    }
+
+
+def decode_rollup(raw):
+    """Decode a `tin-rollup` hash (percent in %, voltage in centivolts).
+
+    Args:
+        raw: HGETALL result (bytes or str keys/values).
+
+    Returns:
+        dict | None: `count`, `percent_{avg,min,max,last}`,
+        `voltage_{avg,min,max,last}` (volts) and `last_ts`; None when empty.
+    """
+    if not raw:
+        return None
+    fields = {
+        (name.decode() if isinstance(name, bytes) else name): int(float(value))
+        for name, value in raw.items()
+    }
+    count = fields.get('n', 0)
+    if count <= 0:
+        return None
+    return {
+        'count': count,
+        'percent_avg': fields['p_sum'] / count,
+        'percent_min': float(fields['p_min']),
+        'percent_max': float(fields['p_max']),
+        'percent_last': float(fields['p_last']),
+        'voltage_avg': fields['v_sum'] / count / 100.0,
+        'voltage_min': fields['v_min'] / 100.0,
+        'voltage_max': fields['v_max'] / 100.0,
+        'voltage_last': fields['v_last'] / 100.0,
+        'last_ts': fields.get('ts_last', 0),
+    }
+
+
+def read_summaries(client, public_key, hour_starts, legacy_client=None):
+    """Read per-hour aggregates for several hours in one round trip.
+
+    Hours with a rollup hash are answered from it (O(1) per hour regardless
+    of sample rate). Hours without one (data written before rollups existed
+    or only in the legacy ZSET) fall back to aggregating raw samples.
+
+    Args:
+        client: Redis client returning bytes (`decode_responses=False`).
+        public_key: Sensor public key.
+        hour_starts: Hour-aligned epochs to read.
+        legacy_client: Optional string client used for the legacy ZSET.
+
+    Returns:
+        dict[int, dict | None]: Summary per hour (None when no samples).
+    """
+    hour_starts = [int(ts) for ts in hour_starts]
+    pipe = client.pipeline(transaction=False)
+    for hour_ts in hour_starts:
+        pipe.hgetall(rollup_key(public_key, hour_ts))
+
+    summaries = {}
+    missing = []
+    for hour_ts, raw in zip(hour_starts, pipe.execute()):
+        summaries[hour_ts] = decode_rollup(raw)
+        if summaries[hour_ts] is None:
+            missing.append(hour_ts)
+
+    if missing:
+        raw_samples = read_hours(client, public_key, missing, legacy_client=legacy_client)
+        for hour_ts in missing:
+            summaries[hour_ts] = summarize(raw_samples.get(hour_ts))
+    return summaries
+
+
+def pick_resolution(start_ts, end_ts, max_points, hourly_since):
+    """Pick the long-term history resolution for a window.
+
+    Hourly rows are used while the window fits in `max_points` hours and is
+    still covered by hourly retention; anything longer reads daily rows
+    (a one-year chart is ~365 rows).
+
+    Args:
+        start_ts: Window start epoch seconds.
+        end_ts: Window end epoch seconds.
+        max_points: Maximum points a chart should receive.
+        hourly_since: Oldest epoch still kept at hourly resolution.
+
+    Returns:
+        str: `hour` or `day`.
+    """
+    hours = (int(end_ts) - int(start_ts)) / HOUR_SECONDS
+    if hours <= max_points and int(start_ts) >= int(hourly_since):
+        return 'hour'
+    return 'day'
+
+
+def bucket_stats(samples, start_ts, width, bucket_count, aggregations=AGGREGATIONS):
+    """Aggregate samples into fixed-width buckets in one vectorized pass.
+
+    Args:
+        samples: `(ts, percent, voltage)` tuples sorted by ts.
+        start_ts: Start epoch of the first bucket.
+        width: Bucket width in seconds.
+        bucket_count: Number of buckets.
+        aggregations: Subset of `AGGREGATIONS`.
+
+    Returns:
+        list[dict | None]: Per bucket `count` and/or `percent_<agg>` and
+        `voltage_<agg>` values; None for buckets without samples.
+    """
+    buckets = [None] * bucket_count
+    if not samples:
+        return buckets
+    data = np.asarray(samples, dtype=float)
+    index = ((data[:, 0] - start_ts) // width).astype(np.int64)
+    inside = (index >= 0) & (index < bucket_count)
+    data, index = data[inside], index[inside]
+    if not len(index):
+        return buckets
+
+    # Samples are sorted by ts, so each bucket is one contiguous run.
+    starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    ends = np.r_[starts[1:], len(index)]
+    counts = ends - starts
+    columns = {}
+    for offset, name in ((1, 'percent'), (2, 'voltage')):
+        values = data[:, offset]
+        if 'avg' in aggregations:
+            columns[f'{name}_avg'] = np.add.reduceat(values, starts) / counts
+        if 'min' in aggregations:
+            columns[f'{name}_min'] = np.minimum.reduceat(values, starts)
+        if 'max' in aggregations:
+            columns[f'{name}_max'] = np.maximum.reduceat(values, starts)
+        if 'last' in aggregations:
+            columns[f'{name}_last'] = values[ends - 1]
+    if 'count' in aggregations:
+        columns['count'] = counts
+
+    for row, bucket in enumerate(index[starts]):
+        buckets[bucket] = {name: column[row].item() for name, column in columns.items()}
+    return buckets
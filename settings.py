@@ -105,10 +105,63 @@ API_REDIS_DB = 0
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///database.db?journal_mode=WAL2")
 
+# Write-behind queue for device hot-path SQLite writes: enable only with the write_behind.py flusher
+# running. When off, writes are synchronous and /relay-update persists relay events and daily
+# counters itself (`write_behind.persist_relay_inline`).
+WRITE_BEHIND_ENABLED = env_bool("WRITE_BEHIND_ENABLED", False)
+WRITE_BEHIND_FLUSH_SECONDS = int(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "5"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "1000"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "50000"))
+# Relay daily ON seconds/liters are counted in Redis and flushed to relay_daily_stats by the same service
+RELAY_DAILY_FLUSH_SECONDS = int(os.getenv("RELAY_DAILY_FLUSH_SECONDS", "60"))
+
+# In-process LRU tier in front of the Redis memoize for device identity/settings lookups
+DEVICE_LOCAL_CACHE_ENABLED = env_bool("DEVICE_LOCAL_CACHE_ENABLED", True)
+DEVICE_LOCAL_CACHE_SIZE = int(os.getenv("DEVICE_LOCAL_CACHE_SIZE", "4096"))
+DEVICE_LOCAL_CACHE_TTL = int(os.getenv("DEVICE_LOCAL_CACHE_TTL", "30"))
+
+# API logging: records are formatted and written by a background listener thread.
+# LOG_FORMAT: kv (key=value), json or text; LOG_SAMPLE_RATES: "<event>=<N>" logs one in N.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "kv")
+LOG_ASYNC = env_bool("LOG_ASYNC", True)
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "sensor_update=10,relay_update=10")
+
+# Pre-auth token-bucket rate limits for device endpoints.
+# Device policies: "<type>=<tokens per second>/<burst>" comma separated (1 = sensor S1, 3 = relay R1).
+RATE_LIMIT_ENABLED = env_bool("RATE_LIMIT_ENABLED", True)
+RATE_LIMIT_DEVICE_POLICIES = os.getenv("RATE_LIMIT_DEVICE_POLICIES", "1=0.2/20,3=0.5/20")
+RATE_LIMIT_DEFAULT_POLICY = os.getenv("RATE_LIMIT_DEFAULT_POLICY", "0.2/10")
+RATE_LIMIT_IP_POLICY = os.getenv("RATE_LIMIT_IP_POLICY", "5/100")
+
+# Longest `/relay-update?wait=` hold in seconds (0 disables long-poll). Held requests need an
+# async API worker (gunicorn gevent) and must stay below the proxy read timeout (nginx: 60 s).
+RELAY_LONG_POLL_MAX_SECONDS = int(os.getenv("RELAY_LONG_POLL_MAX_SECONDS", "25"))
+# `/device_stream` (SSE) keep-alive interval and lifetime before the browser reconnects; keep the
+# keep-alive below the proxy read timeout. Also served by the gevent API worker.
+LIVE_STREAM_HEARTBEAT_SECONDS = int(os.getenv("LIVE_STREAM_HEARTBEAT_SECONDS", "15"))
+LIVE_STREAM_MAX_SECONDS = int(os.getenv("LIVE_STREAM_MAX_SECONDS", "300"))
+# Relay command queue: commands older than the TTL are skipped; unacknowledged ones are
+# re-delivered until the ack timeout.
+RELAY_COMMAND_QUEUE_MAX = int(os.getenv("RELAY_COMMAND_QUEUE_MAX", "32"))
+RELAY_COMMAND_TTL_SECONDS = int(os.getenv("RELAY_COMMAND_TTL_SECONDS", "300"))
+RELAY_COMMAND_ACK_TIMEOUT_SECONDS = int(os.getenv("RELAY_COMMAND_ACK_TIMEOUT_SECONDS", "120"))
+# Entries kept in each relay's live event log stream (persisted to relay_events by write_behind.py).
+RELAY_EVENTS_STREAM_MAX = int(os.getenv("RELAY_EVENTS_STREAM_MAX", "200"))
+# Server-side scheduled relay actions (requires relay_scheduler.py running).
+RELAY_SCHEDULER_INTERVAL_SECONDS = int(os.getenv("RELAY_SCHEDULER_INTERVAL_SECONDS", "5"))
+RELAY_SCHEDULES_MAX_PER_RELAY = int(os.getenv("RELAY_SCHEDULES_MAX_PER_RELAY", "16"))
+
+# Long-term sensor history in SQLite (requires history_compactor.py running)
+SENSOR_COMPACT_INTERVAL_SECONDS = int(os.getenv("SENSOR_COMPACT_INTERVAL_SECONDS", "900"))
+SENSOR_HOURLY_RETENTION_DAYS = int(os.getenv("SENSOR_HOURLY_RETENTION_DAYS", "90"))
+SENSOR_HISTORY_MAX_POINTS = int(os.getenv("SENSOR_HISTORY_MAX_POINTS", "400"))
+
 REPORTS_FOLDER = './reports/'
 
 # Relay consumption estimation defaults (global residential baseline values)
 DEFAULT_WATER_COST_PER_M3 = float(os.getenv("DEFAULT_WATER_COST_PER_M3", "1.5"))
 DEFAULT_ENERGY_COST_PER_KWH = float(os.getenv("DEFAULT_ENERGY_COST_PER_KWH", "0.17"))
 DEFAULT_RELAY_POWER_WATTS = float(os.getenv("DEFAULT_RELAY_POWER_WATTS", "750"))
-DEFAULT_RELAY_CURRENCY = os.getenv("DEFAULT_RELAY_CURRENCY", "USD").strip().upper() or "USD"
\ No newline at end of file
+DEFAULT_RELAY_CURRENCY = os.getenv("DEFAULT_RELAY_CURRENCY", "USD").strip().upper() or "USD"
+# Relay consumption reports of settled days are memoized this long (they do not change)
+RELAY_REPORT_CACHE_SECONDS = int(os.getenv("RELAY_REPORT_CACHE_SECONDS", "3024000"))
\ No newline at end of file
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+DEFAULT_LITERS_PER_CM = 10.0
+
+
+def _usable_depth(empty_level, top_margin):
+    if empty_level == 0:
+        empty_level = 1
+    usable = empty_level - top_margin
+    return usable if usable != 0 else 1.0
+
+
+def level_percent(distance, empty_level, top_margin):
+    """Return the tank fill percent for one distance reading.
+
+    Canonical formula shared by relay headers, alerts and sensor history:
+    `100 - trunc((distance - top_margin) * 100 / (empty_level - top_margin))`
+    clamped to 0-100. A distance at or beyond a positive `EMPTY_LEVEL` is
+    empty, an `EMPTY_LEVEL` of 0 is treated as 1 and a zero usable depth as
+    1 cm (instead of raising).
+
+    Args:
+        distance: Sensor-to-water distance in cm.
+        empty_level: Distance reported when the tank is empty (`EMPTY_LEVEL`).
+        top_margin: Distance reported when the tank is full (`TOP_MARGIN`).
+
+    Returns:
+        int: Fill percent in 0-100.
+    """
+    distance = float(distance)
+    empty_level = float(empty_level)
+    top_margin = float(top_margin)
+    if 0 < empty_level <= distance:
+        return 0
+    used = int(((distance - top_margin) * 100.0) / _usable_depth(empty_level, top_margin))
+    return max(0, min(100, 100 - min(100, used)))
+
+
+def water_height_cm(distance, empty_level, top_margin):
+    """Return the water column height in cm (distance clamped to the tank)."""
+    distance = float(distance)
+    empty_level = float(empty_level)
+    top_margin = float(top_margin)
+    if distance > empty_level:
+        distance = empty_level
+    if distance < top_margin:
+        distance = top_margin
+    return max(0.0, empty_level - distance)
+
+
+def liters(distance, empty_level, top_margin, liters_per_cm=DEFAULT_LITERS_PER_CM):
+    """Return the stored water volume in liters (unrounded)."""
+    return water_height_cm(distance, empty_level, top_margin) * float(liters_per_cm)
+
+
+def settings_levels(sensor_settings, distance):
+    """Compute `(percent, water_height_cm, liters)` from a sensor settings row.
+
+    Args:
+        sensor_settings: Settings with `EMPTY_LEVEL`, `TOP_MARGIN` and
+            optional `liters_per_cm`.
+        distance: Sensor-to-water distance in cm.
+
+    Returns:
+        tuple[int, float, float]: Fill percent, water height and liters.
+    """
+    empty_level = float(sensor_settings.EMPTY_LEVEL)
+    top_margin = float(sensor_settings.TOP_MARGIN)
+    liters_per_cm = float(sensor_settings.get('liters_per_cm', DEFAULT_LITERS_PER_CM))
+    height = water_height_cm(distance, empty_level, top_margin)
+    return level_percent(distance, empty_level, top_margin), height, height * liters_per_cm
+
+
+def batch_levels(distances, empty_levels, top_margins, liters_per_cm=DEFAULT_LITERS_PER_CM):
+    """Compute percent, water height and liters for N devices in one pass.
+
+    Same results as the scalar helpers, element by element. Arguments may be
+    sequences or NumPy arrays (scalars broadcast).
+
+    Args:
+        distances: Sensor-to-water distances in cm.
+        empty_levels: `EMPTY_LEVEL` per device.
+        top_margins: `TOP_MARGIN` per device.
+        liters_per_cm: Liters per cm per device (or one value for all).
+
+    Returns:
+        dict[str, numpy.ndarray]: `percent` (int), `water_height_cm` and `liters`.
+    """
+    distance = np.asarray(distances, dtype=float)
+    empty_level = np.asarray(empty_levels, dtype=float)
+    top_margin = np.asarray(top_margins, dtype=float)
+
+    usable = np.where(empty_level == 0, 1.0, empty_level) - top_margin
+    usable = np.where(usable == 0, 1.0, usable)
+    used = np.trunc((distance - top_margin) * 100.0 / usable)
+    percent = np.clip(100 - np.minimum(100, used), 0, 100)
+    percent = np.where((empty_level > 0) & (distance >= empty_level), 0, percent).astype(int)
+
+    clamped = np.maximum(np.minimum(distance, empty_level), top_margin)
+    height = np.maximum(0.0, empty_level - clamped)
+    return {
+        'percent': percent,
+        'water_height_cm': height,
+        'liters': height * np.asarray(liters_per_cm, dtype=float),
+    }
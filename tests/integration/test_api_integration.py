@@ -152,7 +152,7 @@ class ApiIntegrationTestCase(unittest.TestCase):
         self.assertIn("pool-time", response.headers)
         self.assertIn("fw-version", response.headers)
 
-    def test_relay_update_events_then_relay_view_consumes_events(self):
+    def test_relay_update_events_then_relay_view_reads_from_cursor(self):
         response_update = self._get(
             "/relay-update",
             params={"key": self.runtime["demo_relay_prv_key"], "status": "1"},
@@ -161,38 +161,47 @@ class ApiIntegrationTestCase(unittest.TestCase):
         self.assertEqual(200, response_update.status_code)
 
         response_view_1 = self._get("/relay_view_api", params={"public_key": "demorelay"})
-        self.assertTrue(len(response_view_1.json()["events"]) >= 1)
+        payload_1 = response_view_1.json()
+        self.assertTrue(len(payload_1["events"]) >= 1)
+        self.assertTrue(payload_1["events_cursor"])
 
-        response_view_2 = self._get("/relay_view_api", params={"public_key": "demorelay"})
+        # Reads do not consume: from its cursor this viewer sees nothing new...
+        response_view_2 = self._get("/relay_view_api",
+                                    params={"public_key": "demorelay", "since": payload_1["events_cursor"]})
         self.assertEqual([], response_view_2.json()["events"])
 
-    def test_relay_action_flow_on_then_off(self):
-        response_on = self._post("/relay_view_api", data={"public_key": self.runtime["demo_relay_pub_key"], "action": "on"})
-        self.assertEqual("success", response_on.json()["status"])
+        # ...while a viewer without a cursor still gets the recent events.
+        response_view_3 = self._get("/relay_view_api", params={"public_key": "demorelay"})
+        self.assertEqual(payload_1["events"], response_view_3.json()["events"])
 
-        response_update_on = self._get(
+    def _relay_heartbeat(self, status):
+        return self._get(
             "/relay-update",
-            params={"key": self.runtime["demo_relay_prv_key"], "status": "1"},
+            params={"key": self.runtime["demo_relay_prv_key"], "status": status},
             headers={"RSSI": "-59", "FW-Version": "19", "EVENTS": "0,0,0,0,0"},
         )
-        self.assertEqual("1", response_update_on.headers.get("ACTION"))
+
+    def test_relay_action_flow_on_then_off(self):
+        response_on = self._post("/relay_view_api", data={"public_key": self.runtime["demo_relay_pub_key"], "action": "on"})
+        self.assertEqual("success", response_on.json()["status"])
+        self.assertEqual("1", self._relay_heartbeat("0").headers.get("ACTION"))
+        # Reporting ON acknowledges the command; nothing else is queued.
+        self.assertEqual("0", self._relay_heartbeat("1").headers.get("ACTION"))
 
         response_off = self._post("/relay_view_api", data={"public_key": self.runtime["demo_relay_pub_key"], "action": "off"})
         self.assertEqual("success", response_off.json()["status"])
+        self.assertEqual("-1", self._relay_heartbeat("1").headers.get("ACTION"))
+        self.assertEqual("0", self._relay_heartbeat("0").headers.get("ACTION"))
+        self.assertEqual("0", self._relay_heartbeat("0").headers.get("ACTION"))
 
-        response_update_off = self._get(
-            "/relay-update",
-            params={"key": self.runtime["demo_relay_prv_key"], "status": "1"},
-            headers={"RSSI": "-58", "FW-Version": "19", "EVENTS": "0,0,0,0,0"},
-        )
-        self.assertEqual("-1", response_update_off.headers.get("ACTION"))
+    def test_relay_action_redelivered_until_acked(self):
+        response_on = self._post("/relay_view_api", data={"public_key": self.runtime["demo_relay_pub_key"], "action": "on"})
+        self.assertEqual("success", response_on.json()["status"])
 
-        response_update_reset = self._get(
-            "/relay-update",
-            params={"key": self.runtime["demo_relay_prv_key"], "status": "1"},
-            headers={"RSSI": "-58", "FW-Version": "19", "EVENTS": "0,0,0,0,0"},
-        )
-        self.assertEqual("0", response_update_reset.headers.get("ACTION"))
+        # The relay keeps reporting OFF: the ON command stays pending and is handed out again.
+        self.assertEqual("1", self._relay_heartbeat("0").headers.get("ACTION"))
+        self.assertEqual("1", self._relay_heartbeat("0").headers.get("ACTION"))
+        self.assertEqual("0", self._relay_heartbeat("1").headers.get("ACTION"))
 
     def test_update_invalid_private_key_returns_404(self):
         response = self._get("/update", params={"key": "invalid-key", "distance": "80", "voltage": "370"})
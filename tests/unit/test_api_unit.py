@@ -3,6 +3,7 @@ from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 
 import api
+import sensor_history
 
 
 class FakeRedis:
@@ -13,6 +14,10 @@ class FakeRedis:
     def get(self, key):
         return self.store.get(key)
 
+    def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+
     def set(self, key, value, ex=None):
         self.store[key] = str(value)
 
@@ -39,10 +44,55 @@ class FakeRedis:
     def expire(self, key, seconds):
         return True
 
+    def append(self, key, value):
+        self.store[key] = self.store.get(key, b'') + value
+        return len(self.store[key])
+
+    def expireat(self, key, when):
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        results = [method(*args, **kwargs) for method, args, kwargs in self.calls]
+        self.calls = []
+        return results
+
 
 class ApiUnitTestCase(unittest.TestCase):
     def setUp(self):
         self.client = api.app.test_client()
+        # Relay snapshots must be rebuilt from each test's patched loaders.
+        local_cache_patcher = patch('device_cache.settings.DEVICE_LOCAL_CACHE_ENABLED', False)
+        local_cache_patcher.start()
+        self.addCleanup(local_cache_patcher.stop)
+        sensor_relays_patcher = patch('api.db.DevicesDB.load_sensor_relays', return_value=())
+        sensor_relays_patcher.start()
+        self.addCleanup(sensor_relays_patcher.stop)
+        take_patcher = patch('api.relay_commands.take', return_value=(0, -1))
+        self.take_command = take_patcher.start()
+        self.addCleanup(take_patcher.stop)
+        runtime_patcher = patch.object(api, 'relay_runtime_script', return_value=[0, '0.0000'])
+        self.runtime_script = runtime_patcher.start()
+        self.addCleanup(runtime_patcher.stop)
+        persist_patcher = patch('api.write_behind.persist_relay_inline')
+        self.persist_relay_inline = persist_patcher.start()
+        self.addCleanup(persist_patcher.stop)
 
     def test_generate_secure_random_string_complexity(self):
         generated = api.generate_secure_random_string(24)
@@ -93,19 +143,87 @@ class ApiUnitTestCase(unittest.TestCase):
             self.assertAlmostEqual(3.76, payload["voltage"])
             self.assertEqual("-71", payload["rssi"])
 
-    def test_relay_view_api_get_consumes_events(self):
+    def test_view_apis_answer_304_until_state_changes(self):
+        fake_redis = FakeRedis({"tin-keys/1pubX": "80|1700000000|376|-71", "relay-keys/3pubR": "1|1700000000|-66"})
+        with patch.object(api, "redis_client", fake_redis), patch("api.time.time", return_value=1700000060), \
+            patch("api.relay_events.read", return_value=([], "1-0")) as read_events:
+            first = self.client.get("/sensor_view_api", query_string={"public_key": "1pubX"})
+            etag = first.headers["ETag"]
+            self.assertTrue(etag.startswith('W/"'))
+            self.assertEqual("no-cache", first.headers["Cache-Control"])
+
+            unchanged = self.client.get("/sensor_view_api", query_string={"public_key": "1pubX"},
+                                        headers={"If-None-Match": etag})
+            self.assertEqual(304, unchanged.status_code)
+            self.assertEqual(b"", unchanged.data)
+            self.assertEqual(etag, unchanged.headers["ETag"])
+
+            fake_redis.set("tin-keys/1pubX", "81|1700000031|376|-71")
+            changed = self.client.get("/sensor_view_api", query_string={"public_key": "1pubX"},
+                                      headers={"If-None-Match": etag})
+            self.assertEqual(200, changed.status_code)
+            self.assertEqual("81", changed.get_json()["distance"])
+
+            relay = self.client.get("/relay_view_api", query_string={"public_key": "3pubR", "since": "1-0"})
+            relay_unchanged = self.client.get("/relay_view_api", query_string={"public_key": "3pubR", "since": "1-0"},
+                                              headers={"If-None-Match": relay.headers["ETag"]})
+            self.assertEqual(304, relay_unchanged.status_code)
+            read_events.assert_called_once()
+
+    def test_device_stream_resumes_relay_events_from_last_event_id(self):
+        fake_redis = FakeRedis({"relay-keys/3pubR": "1|1700000000|-66"})
+        entries = [("1700000005000-0", {"relay_id": "20", "events": "9", "at": "1700000005"})]
+        with patch.object(api, "redis_client", fake_redis), patch("api.time.time", return_value=1700000010), \
+            patch("api.relay_events.read", return_value=(entries, "1700000005000-0")) as read_events, \
+            patch("api.live_stream._ensure_listener"), \
+            patch.object(api.settings, "LIVE_STREAM_MAX_SECONDS", 0.01):
+            response = self.client.get("/device_stream", query_string={"public_key": "3pubR", "type": "relay"},
+                                       headers={"Last-Event-ID": "1699999990/1699999990000-0"})
+            body = response.get_data(as_text=True)
+
+        self.assertEqual("text/event-stream", response.mimetype)
+        self.assertEqual("no", response.headers["X-Accel-Buffering"])
+        self.assertIn("id: 1700000000/1700000005000-0\nevent: state\n", body)
+        self.assertIn(api.RELAY_EVENTS_CODE[9][1], body)
+        read_events.assert_called_once_with("3pubR", since="1699999990000-0")
+        self.assertEqual(400, self.client.get("/device_stream").status_code)
+
+    def test_relay_view_api_get_reads_events_from_viewer_cursor(self):
         fake_redis = FakeRedis({
             "relay-keys/demorelay": "1|1700000000|-66",
-            "relay-events/demorelay": "1,0,4",
         })
-        with patch.object(api, "redis_client", fake_redis), patch.object(api.settings, "DEMO_RELAY_PUB_KEY", "demorelay"), patch("api.time.time", return_value=1700000010):
+        entries = [("1700000005000-0", {"relay_id": "20", "events": "1,0,4", "at": "1700000005"})]
+        with patch.object(api, "redis_client", fake_redis), patch.object(api.settings, "DEMO_RELAY_PUB_KEY", "demorelay"), \
+            patch("api.relay_events.read", return_value=(entries, "1700000005000-0")) as read_events, \
+            patch("api.time.time", return_value=1700000010):
             response = self.client.get("/relay_view_api", query_string={"public_key": "demorelay"})
             payload = response.get_json()
             self.assertEqual(200, response.status_code)
             self.assertEqual(1, payload["status"])
             self.assertEqual(10, payload["diff_time"])
-            self.assertTrue(len(payload["events"]) >= 1)
-            self.assertIsNone(fake_redis.get("relay-events/demorelay"))
+            self.assertEqual([api.RELAY_EVENTS_CODE[1][1], api.RELAY_EVENTS_CODE[4][1]], payload["events"])
+            self.assertEqual("1700000005000-0", payload["events_cursor"])
+            read_events.assert_called_once_with("demorelay", since=None)
+
+            read_events.return_value = ([], "1700000005000-0")
+            response = self.client.get("/relay_view_api", query_string={"public_key": "demorelay",
+                                                                        "since": "1700000005000-0"})
+            self.assertEqual([], response.get_json()["events"])
+            read_events.assert_called_with("demorelay", since="1700000005000-0")
+
+    def test_relay_update_appends_reported_events_to_log(self):
+        snapshot = api.db.AttrDict({
+            "public_key": "3pubR", "relay_device_id": 20, "headers": {"ALGO": "1"},
+            "sensor_key": None, "sensor_device_id": None, "sensor_settings": None,
+        })
+        with patch.object(api, "redis_client", FakeRedis()), \
+            patch("api.db.DevicesDB.load_relay_snapshot", return_value=snapshot), \
+            patch("api.relay_events.append") as append_events, \
+            patch("api.time.time", return_value=1700000100):
+            response = self.client.get("/relay-update", query_string={"key": "3prvR", "status": 1},
+                                       headers={"EVENTS": "0,5,0,0,0"})
+        self.assertEqual(200, response.status_code)
+        append_events.assert_called_once_with("3pubR", 20, "0,5,0,0,0", 1700000100)
 
     def test_update_invalid_private_key_returns_404(self):
         with patch("api.db.DevicesDB.valid_private_key", return_value=False):
@@ -125,9 +243,10 @@ class ApiUnitTestCase(unittest.TestCase):
         sensor_settings = SimpleNamespace(WIFI_POOL_TIME=45)
 
         with patch.object(api, "redis_client", fake_redis), \
+            patch.object(api, "sensor_ingest_script", return_value=[1, 0]) as ingest_script, \
             patch("api.db.DevicesDB.valid_private_key", return_value="1pubSENSOR"), \
             patch("api.db.DevicesDB.load_device_id_by_public_key", return_value=9), \
-            patch("api.db.DevicesDB.record_uptime"), \
+            patch("api.db.DevicesDB.record_uptime") as record_uptime, \
             patch("api.db.DevicesDB.load_device_settings", return_value=sensor_settings), \
             patch("api.db.DevicesDB.update_sensor_pool_time") as update_pool, \
             patch("api.time.time", return_value=1700000100):
@@ -142,9 +261,83 @@ class ApiUnitTestCase(unittest.TestCase):
             self.assertEqual("OK", response.get_data(as_text=True))
             self.assertEqual(str(api.LAST_SENSOR_FW_VERSION), response.headers["fw-version"])
             self.assertEqual("45", response.headers["wpl"])
-            self.assertEqual("82|1700000100|375|-70", fake_redis.get("tin-keys/1pubSENSOR"))
+            script_call = ingest_script.call_args
+            self.assertEqual("tin-keys/1pubSENSOR", script_call.kwargs["keys"][0])
+            self.assertIn("82|1700000100|375|-70", script_call.kwargs["args"])
+            self.assertIs(fake_redis, script_call.kwargs["client"])
+            record_uptime.assert_not_called()
             update_pool.assert_not_called()
 
+    def test_update_frequency_violation_still_answers_ok(self):
+        sensor_settings = SimpleNamespace(EMPTY_LEVEL=100, TOP_MARGIN=20, WIFI_POOL_TIME=30)
+
+        with patch.object(api, "sensor_ingest_script", return_value=[0, 1]), \
+            patch("api.db.DevicesDB.valid_private_key", return_value="1pubSENSOR"), \
+            patch("api.db.DevicesDB.load_device_id_by_public_key", return_value=9), \
+            patch("api.db.DevicesDB.record_uptime") as record_uptime, \
+            patch("api.db.DevicesDB.load_device_settings", return_value=sensor_settings):
+
+            response = self.client.get("/update", query_string={"key": "1prvSENSOR", "distance": "82", "voltage": "375"})
+
+            self.assertEqual(200, response.status_code)
+            self.assertEqual("OK", response.get_data(as_text=True))
+            self.assertEqual("30", response.headers["wpl"])
+            record_uptime.assert_called_once_with(9)
+
+    def test_parse_batch_readings_filters_invalid_lines(self):
+        now_ts = 1700000000
+        body = "\n".join([
+            f"{now_ts - 60}|80|375|-70",
+            "garbage",
+            f"{now_ts - 120}|81|376",
+            f"{now_ts + 3600}|80|375|-70",
+            f"{now_ts - api.HISTORY_RETENTION_SECONDS}|80|375|-70",
+            "",
+        ])
+        readings = api.parse_batch_readings(body, now_ts)
+        self.assertEqual([(now_ts - 120, 81, 376, 0), (now_ts - 60, 80, 375, -70)], readings)
+        self.assertIsNone(api.parse_batch_readings("1|2|3\n" * 3, now_ts, max_readings=2))
+
+    def test_update_batch_writes_history_once_and_is_idempotent(self):
+        fake_redis = FakeRedis()
+        sensor_settings = SimpleNamespace(EMPTY_LEVEL=100, TOP_MARGIN=20, WIFI_POOL_TIME=30)
+        body = "1700000000|60|375|-70\n1700000030|20|380|-71\n"
+
+        with patch.object(api, "redis_client", fake_redis), \
+            patch("api.db.DevicesDB.valid_private_key", return_value="1pubSENSOR") as valid_key, \
+            patch("api.db.DevicesDB.load_device_id_by_public_key", return_value=9), \
+            patch("api.db.DevicesDB.load_device_settings", return_value=sensor_settings), \
+            patch("api.sensor_rollup_script") as rollup_script, \
+            patch("api.time.time", return_value=1700000100):
+            response = self.client.post("/update-batch", query_string={"key": "1prvSENSOR"}, data=body)
+            self.client.post("/update-batch", query_string={"key": "1prvSENSOR"}, data=body)
+
+            self.assertEqual(200, response.status_code)
+            self.assertEqual("OK", response.get_data(as_text=True))
+            self.assertEqual("2", response.headers["accepted"])
+            self.assertEqual("30", response.headers["wpl"])
+            self.assertEqual(2, valid_key.call_count)
+
+            hour_ts = sensor_history.hour_start(1700000000)
+            self.assertEqual(4 * sensor_history.RECORD.size,
+                             len(fake_redis.get(sensor_history.hour_key("1pubSENSOR", hour_ts))))
+            points = sensor_history.read_hours(fake_redis, "1pubSENSOR", [hour_ts])[hour_ts]
+            self.assertEqual([(1700000000, 50, 3.75), (1700000030, 100, 3.8)], points)
+            self.assertEqual(2, rollup_script.call_count)
+            self.assertEqual([sensor_history.hour_key("1pubSENSOR", hour_ts), sensor_history.rollup_key("1pubSENSOR", hour_ts)],
+                             rollup_script.call_args.kwargs["keys"])
+            self.assertIsNone(fake_redis.get("tin-keys/1pubSENSOR"))
+
+    def test_update_batch_rejects_oversized_and_invalid_key(self):
+        with patch("api.db.DevicesDB.valid_private_key", return_value=False):
+            response = self.client.post("/update-batch", query_string={"key": "bad"}, data="1|2|3")
+            self.assertEqual(404, response.status_code)
+
+        body = "1700000000|60|375\n" * (api.BATCH_MAX_READINGS + 1)
+        with patch("api.db.DevicesDB.valid_private_key", return_value="1pubSENSOR"):
+            response = self.client.post("/update-batch", query_string={"key": "1prvSENSOR"}, data=body)
+            self.assertEqual(413, response.status_code)
+
     def test_relay_update_invalid_private_key_returns_404(self):
         with patch("api.db.DevicesDB.valid_private_key", return_value=False):
             response = self.client.get("/relay-update", query_string={"key": "bad", "status": 1})
@@ -194,9 +387,8 @@ class ApiUnitTestCase(unittest.TestCase):
             self.assertEqual(500, response.status_code)
             self.assertEqual("relay settings missing", response.get_json()["error"])
 
-    def test_relay_update_persists_runtime_and_liters_delta(self):
+    def test_relay_update_accounts_runtime_in_redis(self):
         fake_redis = FakeRedis({
-            "relay-runtime-stats/3pubR": "1700000000|1|100.0",
             "tin-keys/1pubS": "89|1700000098|375|-66",
         })
         relay_settings = SimpleNamespace(
@@ -227,8 +419,6 @@ class ApiUnitTestCase(unittest.TestCase):
             patch("api.db.DevicesDB.valid_private_key", return_value="3pubR"), \
             patch("api.db.DevicesDB.load_device_id_by_public_key", side_effect=[20, 7, 7]), \
             patch("api.db.DevicesDB.load_device_settings", side_effect=_load_device_settings), \
-            patch("api.db.DevicesDB.add_relay_on_runtime") as add_runtime, \
-            patch("api.db.DevicesDB.add_relay_liters_for_day") as add_liters, \
             patch("api.time.time", return_value=1700000100):
 
             response = self.client.get(
@@ -238,12 +428,13 @@ class ApiUnitTestCase(unittest.TestCase):
             )
 
             self.assertEqual(200, response.status_code)
-            add_runtime.assert_called_once_with(20, 1700000000, 1700000100)
-            add_liters.assert_called_once()
-            liters_call = add_liters.call_args
-            self.assertEqual(20, liters_call.args[0])
-            self.assertEqual(1700000100, liters_call.args[1])
-            self.assertGreater(liters_call.args[2], 0)
+            self.persist_relay_inline.assert_called_once_with()
+            self.assertEqual(
+                ["relay-runtime-stats/3pubR", "relay-keys/3pubR", "relay-daily/pending"],
+                self.runtime_script.call_args.kwargs["keys"])
+            self.assertEqual(
+                [1700000100, 1, 110.0, "1|1700000100|-65", 20, api.RELAY_RUNTIME_STATE_TTL_SECONDS, "device-live/3pubR"],
+                self.runtime_script.call_args.kwargs["args"])
 
     def test_relay_update_invalid_status_sanitized(self):
         fake_redis = FakeRedis()
@@ -270,36 +461,163 @@ class ApiUnitTestCase(unittest.TestCase):
                 headers={"RSSI": "-65", "FW-Version": "11", "EVENTS": "0,0,0,0,0"},
             )
             self.assertEqual(200, response.status_code)
-            self.assertEqual("0|1700000100|-65", fake_redis.get("relay-keys/3pubR"))
+            self.assertEqual([1700000100, 0, "none", "0|1700000100|-65", 20, api.RELAY_RUNTIME_STATE_TTL_SECONDS,
+                              "device-live/3pubR"],
+                             self.runtime_script.call_args.kwargs["args"])
+
+    def test_relay_update_serves_cached_snapshot_with_one_read(self):
+        fake_redis = FakeRedis({
+            "tin-keys/1pubS": "60|1700000090|375|-66",
+        })
+        fake_redis.mget = MagicMock(side_effect=fake_redis.mget)
+        self.take_command.return_value = (1, -1)
+        snapshot = api.db.AttrDict({
+            "public_key": "3pubR",
+            "relay_device_id": 20,
+            "headers": {"ALGO": "1", "START_LEVEL": "30", "HOURS_OFF": "-"},
+            "sensor_key": "1pubS",
+            "sensor_device_id": 7,
+            "sensor_settings": api.db.AttrDict({"EMPTY_LEVEL": 100, "TOP_MARGIN": 20, "WIFI_POOL_TIME": 30}),
+        })
+        with patch.object(api, "redis_client", fake_redis), \
+            patch("api.db.DevicesDB.load_relay_snapshot", return_value=snapshot), \
+            patch("api.db.DevicesDB.valid_private_key") as valid_key, \
+            patch("api.db.DevicesDB.load_device_settings") as load_settings, \
+            patch("api.time.time", return_value=1700000100):
+            response = self.client.get("/relay-update", query_string={"key": "3prvR", "status": 0},
+                                       headers={"RSSI": "-65"})
+
+            self.assertEqual(200, response.status_code)
+            valid_key.assert_not_called()
+            load_settings.assert_not_called()
+            fake_redis.mget.assert_called_once()
+            self.assertEqual("1", response.headers["ACTION"])
+            self.assertEqual("30", response.headers["START_LEVEL"])
+            self.assertEqual("50", response.headers["percent"])
+            self.assertEqual("30", response.headers["pool-time"])
+            self.take_command.assert_called_once_with("3pubR", 0)
+            self.assertEqual(400.0, self.runtime_script.call_args.kwargs["args"][2])
+
+    def test_update_pushes_level_to_linked_relays(self):
+        sensor_settings = api.db.AttrDict({'EMPTY_LEVEL': 100, 'TOP_MARGIN': 20, 'WIFI_POOL_TIME': 30,
+                                           'liters_per_cm': 10.0})
+        with patch.object(api, "sensor_ingest_script", return_value=[1, 0]) as ingest_script, \
+            patch("api.db.DevicesDB.valid_private_key", return_value="1pubS"), \
+            patch("api.db.DevicesDB.load_device_id_by_public_key", return_value=7), \
+            patch("api.db.DevicesDB.load_device_settings", return_value=sensor_settings), \
+            patch("api.db.DevicesDB.load_sensor_relays", return_value=("3pubA", "3pubB")), \
+            patch("api.time.time", return_value=1700000100):
+            response = self.client.get("/update", query_string={"key": "1prvS", "distance": "60", "voltage": "375"})
+
+        self.assertEqual(200, response.status_code)
+        keys = ingest_script.call_args.kwargs["keys"]
+        args = ingest_script.call_args.kwargs["args"]
+        self.assertEqual(["relay-sensor/3pubA", "relay-sensor/3pubB"], keys[4:])
+        self.assertEqual("1pubS|50|60|1700000100|400.0", args[9])
+        self.assertEqual(api.RELAY_SENSOR_STATE_TTL_SECONDS, args[10])
+
+    def test_relay_update_uses_pushed_sensor_level(self):
+        fake_redis = FakeRedis({
+            "relay-sensor/3pubR": "1pubS|42|66|1700000090|340.0",
+            "tin-keys/1pubS": "99|1700000000|375|-66",
+        })
+        snapshot = api.db.AttrDict({
+            "public_key": "3pubR",
+            "relay_device_id": 20,
+            "headers": {"ALGO": "1"},
+            "sensor_key": "1pubS",
+            "sensor_device_id": 7,
+            "sensor_settings": api.db.AttrDict({"EMPTY_LEVEL": 100, "TOP_MARGIN": 20, "WIFI_POOL_TIME": 30}),
+        })
+        with patch.object(api, "redis_client", fake_redis), \
+            patch("api.db.DevicesDB.load_relay_snapshot", return_value=snapshot), \
+            patch("api.tank_level.settings_levels") as settings_levels, \
+            patch("api.time.time", return_value=1700000100):
+            response = self.client.get("/relay-update", query_string={"key": "3prvR", "status": 0})
+
+            settings_levels.assert_not_called()
+            self.assertEqual("42", response.headers["percent"])
+            self.assertEqual("66", response.headers["distance"])
+            self.assertEqual("1700000090", response.headers["event-time"])
+            self.assertEqual(340.0, self.runtime_script.call_args.kwargs["args"][2])
+
+    def test_relay_sensor_level_ignores_level_pushed_by_previous_sensor(self):
+        sensor_settings = api.db.AttrDict({"EMPTY_LEVEL": 100, "TOP_MARGIN": 20, "liters_per_cm": 10.0})
+        level = api.relay_sensor_level("1pubNEW", sensor_settings, "1pubOLD|42|66|1700000090|340.0",
+                                       "60|1700000095|375|-66")
+        self.assertEqual((50, 60, 1700000095, 400.0), level)
+        self.assertEqual((100, 0, 0, None), api.relay_sensor_level("1pubNEW", sensor_settings, None, None))
 
     def test_relay_action_helpers(self):
-        fake_redis = FakeRedis()
-        with patch.object(api, "redis_client", fake_redis):
-            self.assertEqual(0, api.get_relay_action("3pubX"))
+        with patch("api.relay_commands.issue") as issue, \
+            patch("api.relay_commands.peek", return_value=-1) as peek:
             api.set_relay_action("3pubX", -1)
             self.assertEqual(-1, api.get_relay_action("3pubX"))
+        issue.assert_called_once_with("3pubX", -1)
+        peek.assert_called_once_with("3pubX")
+
+    def test_relay_update_logs_command_ack(self):
+        snapshot = api.db.AttrDict({
+            "public_key": "3pubR", "relay_device_id": 20, "headers": {},
+            "sensor_key": None, "sensor_device_id": None, "sensor_settings": None,
+        })
+        self.take_command.return_value = (0, 4200)
+        with patch.object(api, "redis_client", FakeRedis()), \
+            patch("api.db.DevicesDB.load_relay_snapshot", return_value=snapshot), \
+            patch("api.log_pipeline.log_event") as log_event:
+            response = self.client.get("/relay-update", query_string={"key": "3prvR", "status": 1})
+        self.assertEqual("0", response.headers["ACTION"])
+        log_event.assert_any_call('relay_command_ack', public_key="3pubR", status=1, latency_ms=4200)
+
+    def test_relay_update_long_poll_waits_only_without_pending_action(self):
+        snapshot = api.db.AttrDict({
+            "public_key": "3pubR", "relay_device_id": 20, "headers": {},
+            "sensor_key": None, "sensor_device_id": None, "sensor_settings": None,
+        })
+        with patch.object(api, "redis_client", FakeRedis()), \
+            patch("api.db.DevicesDB.load_relay_snapshot", return_value=snapshot), \
+            patch.object(api.settings, "RELAY_LONG_POLL_MAX_SECONDS", 20), \
+            patch("api.relay_commands.wait_for_action", return_value=-1) as wait_for_action:
+            response = self.client.get("/relay-update", query_string={"key": "3prvR", "status": 1, "wait": 60})
+            self.assertEqual("-1", response.headers["ACTION"])
+            self.assertEqual(("3pubR", 20), wait_for_action.call_args.args[:2])
+            wait_for_action.call_args.args[2]()
+            self.take_command.assert_called_with("3pubR", 1)
+
+            wait_for_action.reset_mock()
+            self.take_command.return_value = (1, -1)
+            response = self.client.get("/relay-update", query_string={"key": "3prvR", "status": 1, "wait": 60})
+            self.assertEqual("1", response.headers["ACTION"])
+            wait_for_action.assert_not_called()
 
     def test_version_constants_positive(self):
         self.assertGreater(api.LAST_SENSOR_FW_VERSION, 0)
         self.assertGreater(api.LAST_RELAY_FW_VERSION, 0)
 
     def test_update_persists_history_point(self):
-        # Ensure update() calls redis zadd/zremrangebyscore/expire when persisting history
+        # Ensure update() runs the ingest script once with the history key and point
         fake_redis = MagicMock()
-        fake_redis.get.return_value = None
+        fake_redis.evalsha.return_value = [1, 1]
         with patch.object(api, 'redis_client', fake_redis), \
             patch('api.db.DevicesDB.valid_private_key', return_value='1pubSENSOR'), \
             patch('api.db.DevicesDB.load_device_id_by_public_key', return_value=9), \
-            patch('api.db.DevicesDB.record_uptime'), \
+            patch('api.db.DevicesDB.record_uptime') as record_uptime, \
             patch('api.db.DevicesDB.load_device_settings', return_value=SimpleNamespace(EMPTY_LEVEL=100, TOP_MARGIN=0, WIFI_POOL_TIME=30)), \
             patch('api.time.time', return_value=1700000100):
 
             response = self.client.get('/update', query_string={'key': '1prvSENSOR', 'distance': '80', 'voltage': '375'}, headers={'RSSI':'-70'})
             self.assertEqual(200, response.status_code)
-            # zadd should be called to store history point
-            self.assertTrue(fake_redis.zadd.called)
-            self.assertTrue(fake_redis.zremrangebyscore.called)
-            self.assertTrue(fake_redis.expire.called)
+            fake_redis.evalsha.assert_called_once()
+            evalsha_args = fake_redis.evalsha.call_args.args
+            self.assertEqual(4, evalsha_args[1])
+            hour_ts = sensor_history.hour_start(1700000100)
+            self.assertEqual(sensor_history.hour_key('1pubSENSOR', hour_ts), evalsha_args[3])
+            self.assertEqual(sensor_history.rollup_key('1pubSENSOR', hour_ts), evalsha_args[5])
+            self.assertEqual(sensor_history.pack_record(1700000100, 20, 3.75), evalsha_args[10])
+            self.assertEqual(sensor_history.expire_at(hour_ts, api.HISTORY_RETENTION_SECONDS), evalsha_args[11])
+            self.assertEqual((20, 375), evalsha_args[13:15])
+            fake_redis.zadd.assert_not_called()
+            record_uptime.assert_called_once_with(9)
 
 
 if __name__ == "__main__":
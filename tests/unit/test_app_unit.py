@@ -3,6 +3,7 @@ from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 
 import app as web_app
+import sensor_history
 
 
 class FakeRedis:
@@ -12,6 +13,15 @@ class FakeRedis:
     def get(self, key):
         return self.store.get(key)
 
+    def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+    def hmget(self, key, fields):
+        return [None for _ in fields]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
     def set(self, key, value, ex=None):
         self.store[key] = str(value)
 
@@ -30,6 +40,23 @@ class FakeRedis:
         self.store.clear()
 
 
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+
 class AppUnitTestCase(unittest.TestCase):
     def setUp(self):
         self.app = web_app.app
@@ -38,6 +65,9 @@ class AppUnitTestCase(unittest.TestCase):
         self.client = web_app.app.test_client()
         self.original_redis = web_app.redis_client
         web_app.redis_client = FakeRedis()
+        patcher = patch.object(web_app.relay_reports, 'redis_client', FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
         web_app.redis_client = self.original_redis
@@ -121,6 +151,24 @@ class AppUnitTestCase(unittest.TestCase):
             self.assertEqual("99", payload["distance"])
             self.assertEqual(3.8, payload["voltage"])
 
+    def test_get_device_data_etag_tracks_state_and_settings(self):
+        web_app.redis_client.set("tin-keys/pub1", "99|1700000000|380|-69")
+        device = SimpleNamespace(id=7, type=1)
+        sensor_settings = {'liters_per_cm': 10.0, 'EMPTY_LEVEL': 120, 'TOP_MARGIN': 20}
+        with patch("app.time.time", return_value=1700000030), \
+            patch("app.db.DevicesDB.load_device_by_public_key", return_value=device), \
+            patch("app.db.DevicesDB.load_device_settings", return_value=sensor_settings), \
+            patch("app.tank_level.water_height_cm", wraps=web_app.tank_level.water_height_cm) as water_height:
+            etag = self.client.get("/data-api", query_string={"key": "pub1"}).headers["ETag"]
+            unchanged = self.client.get("/data-api", query_string={"key": "pub1"}, headers={"If-None-Match": etag})
+            sensor_settings['liters_per_cm'] = 12.5
+            changed = self.client.get("/data-api", query_string={"key": "pub1"}, headers={"If-None-Match": etag})
+
+        self.assertEqual(304, unchanged.status_code)
+        self.assertEqual(200, changed.status_code)
+        self.assertEqual(12.5, changed.get_json()["liters_per_cm"])
+        self.assertEqual(2, water_height.call_count)
+
     def test_get_device_data_demo_alias(self):
         # Ensure demo alias maps to configured demo public key
         demo_pub = "1pubDEMO_TEST"
@@ -135,15 +183,15 @@ class AppUnitTestCase(unittest.TestCase):
                 self.assertAlmostEqual(3.7, payload["voltage"])
 
     def test_sensor_stats_endpoint_unit(self):
-        # Patch redis zrangebyscore to return sample entries for aggregation
+        # Patch the packed history pipeline to return one sample in the first hour
         demo_pub = "1pubDEMO_TEST"
-        sample_items = ["60|3.8"]
-        fake_redis = web_app.redis_client
-        def fake_zrange(key, lo, hi):
-            return sample_items
+        first_hour = 1700003600 + 3600 - 24 * 3600
+        packed = sensor_history.pack_record(first_hour + 10, 60, 3.8)
 
-        with patch.object(web_app, 'redis_client') as rc:
-            rc.zrangebyscore = MagicMock(side_effect=fake_zrange)
+        with patch.object(web_app, 'history_redis_client') as hc, patch.object(web_app, 'redis_client') as rc:
+            # no rollup hashes yet -> raw packed history fallback
+            hc.pipeline.return_value.execute.side_effect = [[{}] * 24, [packed] + [None] * 23]
+            rc.zrangebyscore = MagicMock(return_value=[])
             with patch.object(web_app.settings, 'DEMO_S1_PUB_KEY', demo_pub):
                 with patch('app.time.time', return_value=1700003600):
                     response = self.client.get('/sensor_stats', query_string={'public_key': 'demo'})
@@ -156,6 +204,47 @@ class AppUnitTestCase(unittest.TestCase):
                     self.assertFalse(first.get('offline'))
                     self.assertEqual(60.0, first.get('percent'))
                     self.assertEqual(3.8, first.get('voltage'))
+                    self.assertTrue(payload['buckets'][1].get('offline'))
+                    self.assertEqual(1, first.get('samples'))
+                    rc.zrangebyscore.assert_called_once()
+
+    def test_sensor_stats_buckets_reads_range_once(self):
+        now = 1700006400
+        samples = [(now - 3600 + 10, 60, 3.8), (now - 3600 + 20, 70, 3.9), (now - 3600 + 1000, 80, 4.0)]
+        with patch('app.sensor_history.read_hours', return_value={now - 3600: samples}) as read_hours, \
+            patch('app.time.time', return_value=now):
+            response = self.client.get('/sensor_stats_buckets', query_string={
+                'public_key': '1pubS', 'start': now - 3600, 'end': now, 'bucket': '15m', 'agg': 'avg,count'})
+            bad = self.client.get('/sensor_stats_buckets', query_string={'public_key': '1pubS', 'agg': 'median'})
+
+        payload = response.get_json()
+        self.assertEqual(4, len(payload['buckets']))
+        self.assertEqual({'start': now - 3600, 'offline': False, 'percent_avg': 65.0, 'voltage_avg': 3.85,
+                          'count': 2}, payload['buckets'][0])
+        self.assertEqual(80.0, payload['buckets'][1]['percent_avg'])
+        self.assertTrue(payload['buckets'][2]['offline'])
+        read_hours.assert_called_once()
+        self.assertEqual([now - 3600], list(read_hours.call_args.args[2]))
+        self.assertEqual(400, bad.status_code)
+
+    def test_sensor_history_range_picks_resolution(self):
+        with patch('app.db.DevicesDB.load_device_id_by_public_key', return_value=7), \
+            patch('app.db.DevicesDB.get_sensor_history_range', return_value=[]) as get_range, \
+            patch('app.time.time', return_value=1700000000):
+            response = self.client.get('/sensor_history_range', query_string={'public_key': '1pubS', 'days': 7})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('hour', response.get_json()['resolution'])
+            get_range.assert_called_with(7, 1700000000 - 7 * 86400, 1700000000, 'hour')
+
+            response = self.client.get('/sensor_history_range', query_string={'public_key': '1pubS', 'days': 365})
+            self.assertEqual('day', response.get_json()['resolution'])
+
+            response = self.client.get('/sensor_history_range', query_string={'public_key': '1pubS', 'start': 10, 'end': 5})
+            self.assertEqual(400, response.status_code)
+
+        with patch('app.db.DevicesDB.load_device_id_by_public_key', return_value=None):
+            response = self.client.get('/sensor_history_range', query_string={'public_key': 'unknown'})
+            self.assertEqual(404, response.status_code)
 
     def test_relay_consumption_stats_missing_public_key(self):
         response = self.client.get('/relay_consumption_stats')
@@ -196,6 +285,7 @@ class AppUnitTestCase(unittest.TestCase):
         demo_pub = 'pubDemoRelay'
         with patch.object(web_app.settings, 'DEMO_RELAY_PUB_KEY', demo_pub), \
             patch('app.db.DevicesDB.load_device_by_public_key', return_value=SimpleNamespace(id=99, type=3)) as load_device, \
+            patch('app.db.DevicesDB.load_device_settings', return_value={}), \
             patch('app.db.DevicesDB.get_relay_daily_stats', return_value=[]):
             response = self.client.get('/relay_consumption_stats', query_string={'public_key': 'demorelay'})
             self.assertEqual(200, response.status_code)
@@ -219,6 +309,23 @@ class AppUnitTestCase(unittest.TestCase):
 
             self.assertGreaterEqual(get_stats.call_count, 2)
 
+    def test_relay_consumption_stats_year_view(self):
+        year_data = {'months': [{'month': '2025-01', 'on_minutes': 60, 'liters': 10.0, 'water_cost': 0.015,
+                                 'energy_cost': 0.1275, 'energy_wh': 750.0}],
+                     'totals': {'on_minutes': 60}}
+        with patch('app.db.DevicesDB.load_device_by_public_key', return_value=SimpleNamespace(id=22, type=3)), \
+            patch('app.db.DevicesDB.load_device_settings', return_value={}), \
+            patch('app.relay_reports.year_report', return_value=year_data) as year_report:
+            response = self.client.get('/relay_consumption_stats', query_string={'public_key': '3pubR', 'year': '2025'})
+            bad = self.client.get('/relay_consumption_stats', query_string={'public_key': '3pubR', 'year': 'x'})
+
+        payload = response.get_json()
+        self.assertEqual(year_data['months'], payload['months'])
+        self.assertEqual({'mode': 'year', 'start_date': '2025-01-01', 'end_date': '2025-12-31', 'year': 2025},
+                         payload['period'])
+        self.assertEqual((22, 2025), year_report.call_args.args[:2])
+        self.assertEqual(400, bad.status_code)
+
     def test_device_info_demo_relay_accepts_attrdict_settings(self):
         demo_pub = '3pubDEMO_TEST'
         relay_info = SimpleNamespace(id=77, type=3)
@@ -229,7 +336,9 @@ class AppUnitTestCase(unittest.TestCase):
             patch('app.db.DevicesDB.get_device_uptime', return_value=0), \
             patch('app.db.DevicesDB.load_model_info_by_public_key', return_value=None), \
             patch('app.db.DevicesDB.load_device_settings', return_value=relay_settings), \
-            patch('app.db.DevicesDB.get_relay_events', return_value=[]), \
+            patch('app.db.DevicesDB.get_relay_events', return_value=[
+                {'id': 1, 'events': '2,14,0,0,0', 'mask': (1 << 2) | (1 << 14), 'created_at': '2026-03-07 10:00:00'},
+            ]), \
             patch('app.render_template', return_value='OK') as render_template:
             response = self.client.get('/device_info', query_string={'public_key': 'demorelay'})
 
@@ -242,6 +351,105 @@ class AppUnitTestCase(unittest.TestCase):
         self.assertEqual(1, context['device_setting']['ALGO'])
         self.assertEqual(30, context['device_setting']['START_LEVEL'])
         self.assertEqual(float(web_app.settings.DEFAULT_RELAY_POWER_WATTS), context['device_setting']['RELAY_POWER_WATTS'])
+        self.assertEqual(1, len(context['DISPLAY_EVENTS']))
+        self.assertIn(web_app.get_relay_event_text(2), context['DISPLAY_EVENTS'][0])
+        self.assertIn(web_app.get_relay_event_text(14), context['DISPLAY_EVENTS'][0])
+
+    def test_admin_relay_events_query(self):
+        admin = SimpleNamespace(is_authenticated=True, is_admin=True)
+        relays = [{'relay_id': 20, 'public_key': '3pubR', 'note': '-', 'reports': 3,
+                   'first_at': '2026-03-07 08:00:00', 'last_at': '2026-03-07 10:00:00'}]
+        with patch('flask_login.utils._get_user', return_value=admin), \
+            patch('app.db.DevicesDB.find_relays_with_events', return_value=relays) as find_relays:
+            response = self.client.post('/admin_dashboard', data={
+                'action': 'relay-events-query', 'events': 'SENSOR_FAULT,2', 'hours': '48'})
+            bad = self.client.post('/admin_dashboard', data={'action': 'relay-events-query', 'events': 'NOPE'})
+
+        payload = response.get_json()
+        self.assertEqual(['BLIND_AREA_DANGER', 'SENSOR_FAULT'], payload['events'])
+        self.assertEqual(48, payload['hours'])
+        self.assertEqual(relays, payload['relays'])
+        self.assertEqual((1 << 2) | (1 << 14), find_relays.call_args.args[0])
+        self.assertEqual(400, bad.status_code)
+
+    def test_devices_status_reads_all_live_states_at_once(self):
+        web_app.redis_client = MagicMock(wraps=FakeRedis({
+            "tin-keys/1pubS": "80|1700000000|376|-71",
+            "relay-keys/3pubR": "1|1700000010|-60",
+        }))
+        with patch("app.time.time", return_value=1700000030):
+            response = self.client.get("/devices_status", query_string={"public_keys": "3pubR,1pubS,1pubX"})
+            unchanged = self.client.get("/devices_status", query_string={"public_keys": ["1pubS", "3pubR", "1pubX"]},
+                                        headers={"If-None-Match": response.headers["ETag"]})
+
+        self.assertEqual({
+            "now": 1700000030,
+            "devices": {
+                "1pubS": {"type": "sensor", "distance": 80, "rtime": 1700000000, "diff_time": 30,
+                          "voltage": 3.76, "rssi": -71},
+                "1pubX": None,
+                "3pubR": {"type": "relay", "status": 1, "rtime": 1700000010, "diff_time": 20, "rssi": -60},
+            },
+        }, response.get_json())
+        self.assertEqual(304, unchanged.status_code)
+        web_app.redis_client.get.assert_not_called()
+        self.assertEqual(["tin-keys/1pubS", "relay-keys/1pubS", "tin-keys/1pubX", "relay-keys/1pubX",
+                          "tin-keys/3pubR", "relay-keys/3pubR"], web_app.redis_client.mget.call_args.args[0])
+
+    def test_devices_status_defaults_to_user_devices(self):
+        web_app.redis_client = FakeRedis({"tin-keys/1pubS": "80|1700000000|376|-71"})
+        user = SimpleNamespace(is_authenticated=True, get_devices=lambda: [SimpleNamespace(public_key="1pubS")])
+        with patch('flask_login.utils._get_user', return_value=user):
+            response = self.client.get("/devices_status")
+        anonymous = self.client.get("/devices_status")
+
+        self.assertEqual(["1pubS"], list(response.get_json()["devices"]))
+        self.assertEqual(401, anonymous.status_code)
+
+    def test_relay_bulk_action(self):
+        user = SimpleNamespace(is_authenticated=True, is_admin=False, id=7)
+        with patch('flask_login.utils._get_user', return_value=user), \
+            patch('app.relay_commands.issue_many') as issue_many, \
+            patch('app.db.DevicesDB.user_relay_permissions',
+                  return_value={'3pubA': True, '3pubB': True}) as permissions:
+            response = self.client.post('/relay_bulk_action', data={'action': 'off', 'public_keys': '3pubB,3pubA'})
+            by_group = self.client.post('/relay_bulk_action', data={'action': 'on', 'group': 'Tower A'})
+
+        self.assertEqual(['3pubA', '3pubB'], response.get_json()['public_keys'])
+        self.assertEqual({'3pubA': -1, '3pubB': -1}, issue_many.call_args_list[0].args[0])
+        self.assertEqual({'3pubA': 1, '3pubB': 1}, issue_many.call_args_list[1].args[0])
+        self.assertEqual(200, by_group.status_code)
+        self.assertEqual('Tower A', permissions.call_args.kwargs['group'])
+
+    def test_relay_bulk_action_rejects_whole_set_without_admin_rights(self):
+        user = SimpleNamespace(is_authenticated=True, is_admin=False, id=7)
+        with patch('flask_login.utils._get_user', return_value=user), \
+            patch('app.relay_commands.issue_many') as issue_many, \
+            patch('app.db.DevicesDB.user_relay_permissions', return_value={'3pubA': True, '3pubB': False}):
+            denied = self.client.post('/relay_bulk_action', data={'action': 'on', 'public_keys': ['3pubA', '3pubB']})
+            unknown = self.client.post('/relay_bulk_action', data={'action': 'on', 'public_keys': '3pubA,3pubX'})
+            bad_action = self.client.post('/relay_bulk_action', data={'action': 'toggle', 'public_keys': '3pubA'})
+
+        self.assertEqual(403, denied.status_code)
+        self.assertEqual(['3pubB'], denied.get_json()['public_keys'])
+        self.assertEqual(404, unknown.status_code)
+        self.assertEqual(400, bad_action.status_code)
+        issue_many.assert_not_called()
+
+    def test_relay_schedule_requires_relay_admin(self):
+        owner = SimpleNamespace(is_authenticated=True, is_admin=False, id=7, can_admin_device=lambda key: key == '3pubR')
+        with patch('flask_login.utils._get_user', return_value=owner), \
+            patch('app.relay_scheduler.add') as add, \
+            patch('app.relay_scheduler.list_schedules', return_value=[{'id': '1', 'at': '06:00'}]):
+            created = self.client.post('/relay_schedule', data={
+                'public_key': '3pubR', 'action': 'add', 'at': '06:00', 'duration': '20', 'relay_action': 'on',
+                'timezone': 'America/Santo_Domingo'})
+            denied = self.client.get('/relay_schedule?public_key=3pubOther')
+
+        self.assertEqual([{'id': '1', 'at': '06:00'}], created.get_json()['schedules'])
+        add.assert_called_once_with('3pubR', '06:00', duration_minutes=20, action=1, tz='America/Santo_Domingo')
+        self.assertEqual('UTC', created.get_json()['default_timezone'])
+        self.assertEqual(403, denied.status_code)
 
     def test_devices_post_paths(self):
         with patch.object(web_app, "current_user", SimpleNamespace(is_authenticated=False)):
@@ -3,8 +3,11 @@ import datetime
 from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 from flask import Flask
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
 
 import db
+import migrations
 
 
 class _CtxConn:
@@ -132,24 +135,15 @@ class DbUnitTestCase(unittest.TestCase):
             self.assertEqual(1, db.DevicesDB.load_device_settings(3, 3).ALGO)
 
     def test_devicesdb_update_methods(self):
-        fake_prag_result = MagicMock()
-        fake_prag_result.fetchall.return_value = [
-            (0, 'device', 'INTEGER', 1, None, 1),
-            (1, 'WATER_COST_PER_M3', 'REAL', 1, '1.5', 0),
-            (2, 'RELAY_POWER_WATTS', 'REAL', 1, '750', 0),
-            (3, 'ENERGY_COST_PER_KWH', 'REAL', 1, '0.17', 0),
-            (4, 'CURRENCY_CODE', 'TEXT', 1, 'USD', 0),
-        ]
-        fake_exists_result = MagicMock()
-        fake_exists_result.fetchone.return_value = ('relay_settings',)
+        fake_previous_result = MagicMock()
+        fake_previous_result.fetchone.return_value = None
         fake_conn = MagicMock()
 
         def execute_side_effect(statement, *args, **kwargs):
             sql = str(statement)
-            if "SELECT name FROM sqlite_master WHERE type='table' AND name='relay_settings'" in sql:
-                return fake_exists_result
-            if 'PRAGMA table_info(relay_settings)' in sql:
-                return fake_prag_result
+            self.assertNotIn('PRAGMA', sql)
+            if 'SELECT SENSOR_KEY FROM relay_settings' in sql:
+                return fake_previous_result
             return object()
 
         fake_conn.execute.side_effect = execute_side_effect
@@ -176,22 +170,27 @@ class DbUnitTestCase(unittest.TestCase):
             devices = db.DevicesDB.get_all_devices_by_type(1)
             self.assertEqual(1, len(devices))
 
-        event_rows = [SimpleNamespace(id=1, events="1,2", created_at="2026-01-01")]
+        event_rows = [SimpleNamespace(id=1, events="1,2", mask=6, created_at="2026-01-01")]
         fake_conn, _ = self._fake_connection(fetchall=event_rows)
         with patch.object(db.engine, "connect", return_value=fake_conn):
             events = db.DevicesDB.get_relay_events.uncached(1, 20)
             self.assertEqual("1,2", events[0]["events"])
+            self.assertEqual([1, 2], db.relay_events_codes(events[0]["mask"]))
 
     def test_devicesdb_add_device_paths(self):
         exec_result = SimpleNamespace(lastrowid=42)
         fake_conn, _ = self._fake_connection(execute_result=exec_result)
         with patch.object(db.engine, "connect", return_value=_CtxConn(fake_conn)), \
             patch("db.DevicesDB.update_sensor_settings") as update_sensor, \
-            patch("db.DevicesDB.update_relay_settings") as update_relay:
+            patch("db.DevicesDB.update_relay_settings") as update_relay, \
+            patch.object(db.cache, "delete_memoized"), \
+            patch("db.device_cache.invalidate") as invalidate:
             self.assertTrue(db.DevicesDB.add_device("1prv", "1pub", "note", 1))
             self.assertTrue(db.DevicesDB.add_device("3prv", "3pub", "note", 3))
             update_sensor.assert_called_once_with(42)
             update_relay.assert_called_once_with(42)
+            invalidate.assert_any_call('valid_private_key', '1prv')
+            invalidate.assert_any_call('load_device_id_by_public_key', '3pub')
 
     def test_user_model_methods(self):
         user = db.User(1, "u@example.com", "hash", 0)
@@ -256,46 +255,6 @@ class DbUnitTestCase(unittest.TestCase):
         with patch.object(db.engine, "connect", return_value=_CtxConn(fake_conn)), patch.object(db.cache, "delete_memoized"):
             self.assertTrue(db.Support.add_user_support_record("u@example.com", "hello", support_type=1))
 
-    def test_ensure_relay_daily_stats_table_executes_schema(self):
-        fake_conn = MagicMock()
-        with patch.object(db.engine, 'connect', return_value=_CtxConn(fake_conn)):
-            db.DevicesDB.ensure_relay_daily_stats_table()
-            self.assertGreaterEqual(fake_conn.execute.call_count, 2)
-            fake_conn.commit.assert_called_once()
-
-    def test_add_relay_on_runtime_splits_across_days(self):
-        # 2026-03-07 23:59:30 UTC -> 2026-03-08 00:00:30 UTC
-        start_ts = int(datetime.datetime(2026, 3, 7, 23, 59, 30, tzinfo=datetime.timezone.utc).timestamp())
-        end_ts = int(datetime.datetime(2026, 3, 8, 0, 0, 30, tzinfo=datetime.timezone.utc).timestamp())
-
-        with patch('db.DevicesDB._upsert_relay_daily_stats') as upsert:
-            db.DevicesDB.add_relay_on_runtime(12, start_ts, end_ts)
-            self.assertEqual(2, upsert.call_count)
-
-            first = upsert.call_args_list[0]
-            second = upsert.call_args_list[1]
-
-            self.assertEqual(12, first.args[0])
-            self.assertEqual('2026-03-07', first.args[1])
-            self.assertEqual(30, first.kwargs['on_seconds_inc'])
-
-            self.assertEqual(12, second.args[0])
-            self.assertEqual('2026-03-08', second.args[1])
-            self.assertEqual(30, second.kwargs['on_seconds_inc'])
-
-    def test_add_relay_liters_for_day_ignores_non_positive(self):
-        with patch('db.DevicesDB._upsert_relay_daily_stats') as upsert:
-            db.DevicesDB.add_relay_liters_for_day(3, 1700000000, 0)
-            db.DevicesDB.add_relay_liters_for_day(3, 1700000000, -5)
-            upsert.assert_not_called()
-
-    def test_add_relay_liters_for_day_positive(self):
-        with patch('db.DevicesDB._upsert_relay_daily_stats') as upsert:
-            db.DevicesDB.add_relay_liters_for_day(3, 1700000000, 12.75)
-            upsert.assert_called_once()
-            self.assertEqual(3, upsert.call_args.args[0])
-            self.assertEqual(12.75, upsert.call_args.kwargs['liters_added_inc'])
-
     def test_get_relay_daily_stats_zero_fills_days(self):
         rows = [SimpleNamespace(day_date='2026-03-06', on_seconds=120, liters_added=8.2)]
         fake_result = MagicMock()
@@ -309,7 +268,6 @@ class DbUnitTestCase(unittest.TestCase):
                 return cls(2026, 3, 7, 12, 0, 0)
 
         with patch.object(db.engine, 'connect', return_value=_CtxConn(fake_conn)), \
-            patch('db.DevicesDB.ensure_relay_daily_stats_table'), \
             patch('db.datetime.datetime', _FixedDateTime):
             data = db.DevicesDB.get_relay_daily_stats(10, days=2)
             self.assertEqual(2, len(data))
@@ -321,5 +279,225 @@ class DbUnitTestCase(unittest.TestCase):
             self.assertEqual(0.0, data[1]['liters'])
 
 
+    def test_split_runtime_by_day_crosses_utc_midnight(self):
+        start_ts = int(datetime.datetime(2026, 3, 6, 23, 59, 0, tzinfo=datetime.timezone.utc).timestamp())
+        chunks = db.DevicesDB.split_runtime_by_day(start_ts, start_ts + 180)
+        self.assertEqual([('2026-03-06', 60), ('2026-03-07', 120)], chunks)
+        self.assertEqual([], db.DevicesDB.split_runtime_by_day(start_ts, start_ts))
+
+    def test_apply_write_batch_single_commit(self):
+        fake_conn, _ = self._fake_connection()
+        with patch.object(db.engine, 'connect', return_value=_CtxConn(fake_conn)), \
+            patch('db.DevicesDB.invalidate_relay_snapshots') as invalidate_snapshots, \
+            patch.object(db.cache, "delete_memoized") as delete_memoized:
+            self.assertTrue(db.DevicesDB.apply_write_batch(
+                uptime_hours={1: 2},
+                pool_times={1: 30},
+                relay_events=[(3, '5,6', '2026-03-07 10:00:00')],
+                relay_daily={(3, '2026-03-07'): (120, 4.5)},
+            ))
+            self.assertEqual(4, delete_memoized.call_count)
+            invalidate_snapshots.assert_called_once_with(1)
+
+        self.assertEqual(4, fake_conn.execute.call_count)
+        fake_conn.commit.assert_called_once()
+        uptime_rows = fake_conn.execute.call_args_list[0].args[1]
+        self.assertEqual([{"device_id": 1, "hours": 2}], uptime_rows)
+        daily_rows = fake_conn.execute.call_args_list[3].args[1]
+        self.assertEqual(120, daily_rows[0]['on_seconds_inc'])
+        self.assertEqual(4.5, daily_rows[0]['liters_added_inc'])
+
+    def test_apply_write_batch_skips_batch_token_already_applied(self):
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        migrations.migrate(engine)
+        with patch.object(db, 'engine', engine), patch.object(db.cache, "delete_memoized"):
+            self.assertTrue(db.DevicesDB.apply_write_batch(relay_daily={(3, '2026-03-07'): (120, 4.5)},
+                                                           batch_token='batch-1'))
+            self.assertFalse(db.DevicesDB.apply_write_batch(relay_daily={(3, '2026-03-07'): (120, 4.5)},
+                                                            batch_token='batch-1'))
+            self.assertTrue(db.DevicesDB.apply_write_batch(relay_daily={(3, '2026-03-07'): (60, 0.5)},
+                                                           batch_token='batch-2'))
+        with engine.connect() as connection:
+            row = connection.execute(text("SELECT on_seconds, liters_added FROM relay_daily_stats")).fetchone()
+        self.assertEqual((180, 5.0), tuple(row))
+
+    def test_apply_write_batch_empty_skips_statements(self):
+        fake_conn, _ = self._fake_connection()
+        with patch.object(db.engine, 'connect', return_value=_CtxConn(fake_conn)):
+            self.assertTrue(db.DevicesDB.apply_write_batch())
+        fake_conn.execute.assert_not_called()
+
+    def test_load_relay_snapshot_bundles_relay_and_sensor_settings(self):
+        relay_settings = db.AttrDict({
+            'SENSOR_KEY': '1pubS', 'ALGO': 1, 'SAFE_MODE': 1, 'START_LEVEL': 30, 'END_LEVEL': 90,
+            'AUTO_OFF': 1, 'AUTO_ON': 0, 'MIN_FLOW_MM_X_MIN': 10, 'BLIND_DISTANCE': 15, 'HOURS_OFF': '',
+        })
+        sensor_settings = db.AttrDict({'EMPTY_LEVEL': 100, 'TOP_MARGIN': 20, 'WIFI_POOL_TIME': 30})
+
+        with patch('db.DevicesDB.valid_private_key', return_value='3pubR'), \
+            patch('db.DevicesDB.load_device_id_by_public_key', side_effect=[20, 7]), \
+            patch('db.DevicesDB.load_device_settings', side_effect=[relay_settings, sensor_settings]):
+            snapshot = db.DevicesDB.load_relay_snapshot.uncached('3prvR')
+
+        self.assertEqual('3pubR', snapshot.public_key)
+        self.assertEqual(20, snapshot.relay_device_id)
+        self.assertEqual(('1pubS', 7), (snapshot.sensor_key, snapshot.sensor_device_id))
+        self.assertIs(sensor_settings, snapshot.sensor_settings)
+        self.assertEqual('0', snapshot.headers['AUTO_ON'])
+        self.assertEqual('-', snapshot.headers['HOURS_OFF'])
+
+        with patch('db.DevicesDB.valid_private_key', return_value='3pubR'), \
+            patch('db.DevicesDB.load_device_id_by_public_key', return_value=20), \
+            patch('db.DevicesDB.load_device_settings', return_value=None):
+            self.assertIsNone(db.DevicesDB.load_relay_snapshot.uncached('3prvR'))
+        with patch('db.DevicesDB.valid_private_key', return_value=False):
+            self.assertIsNone(db.DevicesDB.load_relay_snapshot.uncached('bad'))
+
+    def test_invalidate_relay_snapshots_drops_linked_relays(self):
+        fake_conn, _ = self._fake_connection(fetchall=[
+            SimpleNamespace(private_key='3prvA'), SimpleNamespace(private_key='3prvB'),
+        ])
+        with patch.object(db.engine, 'connect', return_value=_CtxConn(fake_conn)), \
+            patch.object(db.cache, 'delete_memoized') as delete_memoized, \
+            patch('db.device_cache.invalidate') as invalidate:
+            db.DevicesDB.invalidate_relay_snapshots(7)
+
+        self.assertEqual({'device_id': 7}, fake_conn.execute.call_args.args[1])
+        self.assertEqual(['3prvA', '3prvB'], [c.args[1] for c in delete_memoized.call_args_list])
+        invalidate.assert_any_call('load_relay_snapshot', '3prvB')
+
+    def test_load_sensor_relays_and_relink_invalidation(self):
+        fake_conn, _ = self._fake_connection(fetchall=[
+            SimpleNamespace(public_key='3pubB'), SimpleNamespace(public_key='3pubA'),
+        ])
+        with patch.object(db.engine, 'connect', return_value=_CtxConn(fake_conn)):
+            self.assertEqual(('3pubA', '3pubB'), db.DevicesDB.load_sensor_relays.uncached('1pubS'))
+        self.assertEqual({'sensor_key': '1pubS'}, fake_conn.execute.call_args.args[1])
+
+        fake_conn, _ = self._fake_connection(fetchone=SimpleNamespace(SENSOR_KEY='1pubOLD'))
+        with patch.object(db.engine, 'connect', return_value=_CtxConn(fake_conn)), \
+            patch('db.DevicesDB.invalidate_relay_snapshots'), \
+            patch.object(db.cache, 'delete_memoized'), \
+            patch('db.device_cache.invalidate') as invalidate:
+            self.assertTrue(db.DevicesDB.update_relay_settings(20, SENSOR_KEY='1pubNEW'))
+        relinked = {c.args[1] for c in invalidate.call_args_list if c.args[0] == 'load_sensor_relays'}
+        self.assertEqual({'1pubOLD', '1pubNEW'}, relinked)
+
+    def test_relay_settings_writes_invalidate_snapshots(self):
+        fake_conn, _ = self._fake_connection()
+        with patch.object(db.engine, 'connect', return_value=_CtxConn(fake_conn)), \
+            patch.object(db.cache, 'delete_memoized'), \
+            patch('db.device_cache.invalidate'), \
+            patch('db.DevicesDB.invalidate_relay_snapshots') as invalidate_snapshots:
+            db.DevicesDB.turn_off_relay_smart_mode(20)
+            db.DevicesDB.update_sensor_pool_time(7, 60)
+        self.assertEqual([20, 7], [c.args[0] for c in invalidate_snapshots.call_args_list])
+
+    def test_relay_events_mask_roundtrip(self):
+        self.assertEqual((1 << 2) | (1 << 14), db.relay_events_mask("2,14,0,0,0"))
+        self.assertEqual((1 << 2) | (1 << 14), db.relay_events_mask(["sensor_fault", "BLIND_AREA_DANGER", 99]))
+        self.assertEqual(0, db.relay_events_mask("0,0,0,0,0"))
+        self.assertEqual([2, 14], db.relay_events_codes((1 << 2) | (1 << 14)))
+        self.assertEqual([], db.relay_events_codes(None))
+
+    def test_find_relays_with_events_uses_created_mask_index(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import StaticPool
+
+        memory_engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        with memory_engine.begin() as connection:
+            connection.execute(db.text("CREATE TABLE devices (id INTEGER PRIMARY KEY, type INTEGER, public_key TEXT, "
+                                       "private_key TEXT, note TEXT)"))
+            connection.execute(db.text("CREATE TABLE relay_events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                       "relay_id INTEGER NOT NULL, events TEXT NOT NULL, created_at TEXT NOT NULL)"))
+            connection.execute(db.text("INSERT INTO devices VALUES (20, 3, '3pubA', '3prvA', 'pump'), "
+                                       "(21, 3, '3pubB', '3prvB', NULL)"))
+        migrations.migrate(memory_engine)
+        with patch.object(db, 'engine', memory_engine), patch.object(db.cache, 'delete_memoized'):
+            db.DevicesDB.apply_write_batch(relay_events=[
+                (20, '0,14,0,0,0', '2026-03-06 08:00:00'),
+                (20, '14,0,0,0,0', '2026-03-07 09:00:00'),
+                (21, '2,0,0,0,0', '2026-03-07 10:00:00'),
+                (21, '9,0,0,0,0', '2026-03-07 11:00:00'),
+            ])
+            faults = db.DevicesDB.find_relays_with_events(db.relay_events_mask('SENSOR_FAULT,BLIND_AREA_DANGER'),
+                                                          datetime.datetime(2026, 3, 7))
+            boots = db.DevicesDB.find_relays_with_events(db.relay_events_mask('BOOT'), '2026-03-07 00:00:00',
+                                                         until='2026-03-07 11:00:00')
+        with memory_engine.connect() as connection:
+            plan = connection.execute(db.text(
+                "EXPLAIN QUERY PLAN SELECT relay_id FROM relay_events "
+                "WHERE created_at >= '2026-03-07' AND (mask & 4) != 0")).fetchall()
+
+        self.assertEqual([(21, '3pubB', 1), (20, '3pubA', 1)],
+                         [(r['relay_id'], r['public_key'], r['reports']) for r in faults])
+        self.assertEqual([], boots)
+        self.assertIn('idx_relay_events_created_mask', ' '.join(str(row[-1]) for row in plan))
+
+    def test_user_relay_permissions_resolves_keys_and_groups_in_one_query(self):
+        from sqlalchemy import create_engine, event
+        from sqlalchemy.pool import StaticPool
+
+        memory_engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        with memory_engine.begin() as connection:
+            connection.execute(db.text("CREATE TABLE devices (id INTEGER PRIMARY KEY, type INTEGER, public_key TEXT, "
+                                       "private_key TEXT, note TEXT)"))
+            connection.execute(db.text("CREATE TABLE user_devices (user_id INTEGER, device_id INTEGER, name TEXT, "
+                                       "can_admin INTEGER)"))
+            connection.execute(db.text("INSERT INTO devices VALUES (20, 3, '3pubA', '3prvA', ''), "
+                                       "(21, 3, '3pubB', '3prvB', ''), (22, 3, '3pubC', '3prvC', ''), "
+                                       "(23, 1, '1pubS', '1prvS', '')"))
+            connection.execute(db.text("INSERT INTO user_devices VALUES (7, 20, 'Tower A/Pump 1', 1), "
+                                       "(7, 21, 'Tower A/Pump 2', 0), (7, 22, 'Tower AB/Pump', 1), "
+                                       "(7, 23, 'Tower A/Sensor', 1), (8, 22, 'Tower A/Pump', 1)"))
+        statements = []
+        event.listen(memory_engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        with patch.object(db, 'engine', memory_engine):
+            by_keys = db.DevicesDB.user_relay_permissions(7, public_keys=['3pubA', '3pubB', '3pubC', '1pubS', '3pubX'])
+            by_group = db.DevicesDB.user_relay_permissions(7, group='Tower A')
+
+        self.assertEqual({'3pubA': True, '3pubB': False, '3pubC': True}, by_keys)
+        self.assertEqual({'3pubA': True, '3pubB': False}, by_group)
+        self.assertEqual(2, len(statements))
+        self.assertEqual({}, db.DevicesDB.user_relay_permissions(7, public_keys=[]))
+
+    def test_sensor_history_stats_hourly_to_daily_roundtrip(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import StaticPool
+
+        memory_engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        day_ts = int(datetime.datetime(2026, 3, 6, tzinfo=datetime.timezone.utc).timestamp())
+
+        def _summary(count, percent, voltage):
+            return {'count': count, 'percent_avg': percent, 'percent_min': percent - 5, 'percent_max': percent + 5,
+                    'voltage_avg': voltage, 'voltage_min': voltage, 'voltage_max': voltage}
+
+        migrations.migrate(memory_engine)
+        with patch.object(db, 'engine', memory_engine):
+            self.assertEqual(2, db.DevicesDB.store_sensor_hourly_stats([
+                (7, day_ts, _summary(2, 40.0, 3.6)),
+                (7, day_ts + 3600, _summary(1, 70.0, 3.9)),
+                (7, day_ts + 86400, None),
+            ]))
+            # Re-compacting an hour replaces it instead of adding to it
+            db.DevicesDB.store_sensor_hourly_stats([(7, day_ts + 3600, _summary(2, 70.0, 3.9))])
+            db.DevicesDB.store_sensor_hourly_stats([(7, day_ts + 86400, _summary(1, 10.0, 3.5))])
+
+            hours = db.DevicesDB.get_sensor_history_range(7, day_ts, day_ts + 86400, 'hour')
+            days = db.DevicesDB.get_sensor_history_range(7, day_ts, day_ts + 2 * 86400, 'day')
+
+            db.DevicesDB.store_sensor_hourly_stats([], prune_before=day_ts + 86400)
+            pruned = db.DevicesDB.get_sensor_history_range(7, day_ts, day_ts + 2 * 86400, 'hour')
+            kept_days = db.DevicesDB.get_sensor_history_range(7, day_ts, day_ts + 2 * 86400, 'day')
+
+        self.assertEqual([(day_ts, 2, 40.0), (day_ts + 3600, 2, 70.0)],
+                         [(p['ts'], p['samples'], p['percent']) for p in hours])
+        self.assertEqual([(day_ts, 4, 55.0, 35.0, 75.0, 3.75), (day_ts + 86400, 1, 10.0, 5.0, 15.0, 3.5)],
+                         [(p['ts'], p['samples'], p['percent'], p['percent_min'], p['percent_max'], p['voltage'])
+                          for p in days])
+        self.assertEqual([day_ts + 86400], [p['ts'] for p in pruned])
+        self.assertEqual(2, len(kept_days))
+
 if __name__ == "__main__":
     unittest.main()
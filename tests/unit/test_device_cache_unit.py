@@ -0,0 +1,98 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+from flask_caching import Cache
+
+import device_cache
+
+
+class DeviceCacheUnitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.cache = Cache(config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 300})
+        self.cache.init_app(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.redis = MagicMock()
+        patchers = [
+            patch.object(device_cache, '_get_redis', return_value=self.redis),
+            patch.object(device_cache, '_ensure_listener'),
+            patch('device_cache.settings.DEVICE_LOCAL_CACHE_ENABLED', True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.ctx.pop)
+
+    def _tiered_loader(self, name):
+        calls = []
+
+        def loader(device_id, device_type=1):
+            calls.append((device_id, device_type))
+            return {"device": device_id, "type": device_type}
+        loader.__name__ = name
+        loader.__qualname__ = f"DeviceCacheUnitTestCase.{name}"
+        self.addCleanup(device_cache._tiers.pop, name, None)
+        return device_cache.tiered(self.cache, 300)(loader), calls
+
+    def test_local_lru_evicts_oldest_and_expires(self):
+        lru = device_cache.LocalLRU(maxsize=2, ttl=30)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual((True, 1), lru.get('a'))
+        lru.set('c', 3)
+        self.assertEqual((False, None), lru.get('b'))
+        self.assertEqual(1, lru.evictions)
+
+        with patch('device_cache.time.monotonic', return_value=10 ** 9):
+            self.assertEqual((False, None), lru.get('a'))
+        self.assertEqual(1, lru.hits)
+        self.assertEqual(2, lru.misses)
+
+    def test_tiered_serves_local_then_redis_tier(self):
+        load, calls = self._tiered_loader('tiered_settings_a')
+        self.assertEqual(5, load(5)["device"])
+        self.assertEqual(5, load(device_id=5, device_type=1)["device"])
+        self.assertEqual(1, len(calls))
+
+        device_cache._tiers['tiered_settings_a']['local'].clear()
+        self.assertEqual(5, load(5, 1)["device"])
+        self.assertEqual(1, len(calls))
+
+        stats = device_cache.stats()['tiered_settings_a']
+        self.assertEqual({'hits': 1, 'misses': 2}, {k: stats['local'][k] for k in ('hits', 'misses')})
+        self.assertEqual({'hits': 1, 'misses': 1}, stats['redis'])
+
+    def test_tiered_keeps_delete_memoized_and_uncached(self):
+        load, calls = self._tiered_loader('tiered_settings_b')
+        load(7, 3)
+        self.cache.delete_memoized(load, 7, 3)
+        device_cache.invalidate('tiered_settings_b', 7, 3)
+        load(7, 3)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(7, load.uncached(7, 3)["device"])
+        self.redis.publish.assert_called_with(device_cache.INVALIDATION_CHANNEL, json.dumps(['tiered_settings_b', [7, 3]]))
+
+    def test_invalidation_message_drops_local_entry(self):
+        load, calls = self._tiered_loader('tiered_settings_c')
+        load(8)
+        load(9)
+        device_cache._apply_invalidation(json.dumps(['tiered_settings_c', [8, 1]]))
+        local = device_cache._tiers['tiered_settings_c']['local']
+        self.assertEqual((False, None), local.get(('tiered_settings_c', 8, 1)))
+        self.assertTrue(local.get(('tiered_settings_c', 9, 1))[0])
+
+        device_cache._apply_invalidation(device_cache.FLUSH_ALL)
+        self.assertEqual(0, len(local))
+
+    def test_disabled_bypasses_local_tier(self):
+        load, calls = self._tiered_loader('tiered_settings_d')
+        with patch('device_cache.settings.DEVICE_LOCAL_CACHE_ENABLED', False):
+            load(1)
+        self.assertEqual(0, len(device_cache._tiers['tiered_settings_d']['local']))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import history_compactor
+
+
+class FakeRollupRedis:
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    def scan_iter(self, match=None, count=None):
+        return iter(sorted(self.hashes))
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def pipeline(self, transaction=True):
+        return FakeRollupPipeline(self)
+
+
+class FakeRollupPipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+
+def _rollup(n, compacted=None):
+    raw = {'n': str(n), 'p_sum': str(50 * n), 'v_sum': str(370 * n), 'p_min': '40', 'p_max': '60',
+           'p_last': '50', 'v_min': '360', 'v_max': '380', 'v_last': '370', 'ts_last': '0'}
+    if compacted is not None:
+        raw['compacted'] = str(compacted)
+    return raw
+
+
+class HistoryCompactorUnitTestCase(unittest.TestCase):
+    def test_parse_rollup_key(self):
+        self.assertEqual(('1pubA', 3600), history_compactor.parse_rollup_key('tin-rollup/1pubA/3600'))
+        self.assertIsNone(history_compactor.parse_rollup_key('tin-rollup/1pubA'))
+        self.assertIsNone(history_compactor.parse_rollup_key('tin-rollup/1pubA/x'))
+
+    def test_compact_once_folds_closed_uncompacted_hours(self):
+        now_ts = 10 * 3600 + 100
+        fake = FakeRollupRedis({
+            'tin-rollup/1pubA/3600': _rollup(2),
+            'tin-rollup/1pubA/7200': _rollup(3, compacted=3),
+            'tin-rollup/1pubA/10800': _rollup(4, compacted=2),
+            'tin-rollup/1pubA/36000': _rollup(1),
+            'tin-rollup/unknown/3600': _rollup(1),
+        })
+        mark_script = MagicMock()
+        with patch.object(history_compactor, 'redis_client', fake), \
+            patch.object(history_compactor, 'mark_compacted_script', mark_script), \
+            patch('history_compactor.db.DevicesDB.load_device_id_by_public_key',
+                  side_effect=lambda pub: 7 if pub == '1pubA' else None), \
+            patch('history_compactor.db.DevicesDB.store_sensor_hourly_stats', return_value=2) as store:
+            self.assertEqual(2, history_compactor.compact_once(now_ts))
+
+        rows = sorted(store.call_args.args[0], key=lambda row: row[1])
+        # Open hour (36000), already compacted (7200) and unknown devices are skipped
+        self.assertEqual([(7, 3600), (7, 10800)], [(sensor_id, hour_ts) for sensor_id, hour_ts, _ in rows])
+        self.assertEqual(50.0, rows[0][2]['percent_avg'])
+        self.assertEqual(3.7, rows[0][2]['voltage_avg'])
+        self.assertEqual(now_ts - history_compactor.settings.SENSOR_HOURLY_RETENTION_DAYS * 86400,
+                         store.call_args.kwargs['prune_before'])
+        self.assertEqual(sorted([(['tin-rollup/1pubA/3600'], ['2']), (['tin-rollup/1pubA/10800'], ['4'])]),
+                         sorted((c.kwargs['keys'], c.kwargs['args']) for c in mark_script.call_args_list))
+
+    def test_compact_once_nothing_pending_skips_sqlite(self):
+        fake = FakeRollupRedis({'tin-rollup/1pubA/3600': _rollup(2, compacted=2)})
+        with patch.object(history_compactor, 'redis_client', fake), \
+            patch('history_compactor.db.DevicesDB.store_sensor_hourly_stats') as store:
+            self.assertEqual(0, history_compactor.compact_once(10 * 3600))
+        store.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
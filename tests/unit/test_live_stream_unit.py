@@ -0,0 +1,49 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import live_stream
+
+
+def _render(state, last_id):
+    return state.split('|')[1], {'state': state}
+
+
+class LiveStreamUnitTest(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('live_stream._ensure_listener')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_channel_name(self):
+        self.assertEqual('device-live/1pubS', live_stream.channel('1pubS'))
+
+    def test_sends_current_state_then_published_updates(self):
+        frames = live_stream.events('1pubS', lambda: '80|1700000000|376|-71', _render, heartbeat=5, max_seconds=5)
+        self.assertEqual(f'retry: {live_stream.RETRY_MS}\n\n', next(frames))
+        self.assertEqual('id: 1700000000\nevent: state\ndata: {"state":"80|1700000000|376|-71"}\n\n', next(frames))
+
+        def publish():
+            time.sleep(0.05)
+            live_stream._deliver('1pubS', '81|1700000031|376|-71')
+
+        threading.Thread(target=publish).start()
+        started = time.monotonic()
+        self.assertTrue(next(frames).startswith('id: 1700000031\n'))
+        self.assertLess(time.monotonic() - started, 2)
+        frames.close()
+        self.assertNotIn('1pubS', live_stream._viewers)
+
+    def test_reconnect_skips_state_already_seen_and_sends_heartbeats(self):
+        frames = live_stream.events('1pubS', lambda: '80|1700000000|376|-71', _render,
+                                    last_id='1700000000', heartbeat=0.05, max_seconds=0.2)
+        output = list(frames)
+        self.assertEqual(f'retry: {live_stream.RETRY_MS}\n\n', output[0])
+        self.assertNotIn('event: state', ''.join(output))
+        self.assertIn(': keepalive\n\n', output)
+        self.assertNotIn('1pubS', live_stream._viewers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import io
+import json
+import logging
+import unittest
+from unittest.mock import patch
+
+import log_pipeline
+
+
+def _record(msg='sensor_update', level=logging.WARNING, **extra):
+    record = logging.LogRecord('root', level, __file__, 1, msg, None, None)
+    for name, value in extra.items():
+        setattr(record, name, value)
+    return record
+
+
+class LogPipelineUnitTestCase(unittest.TestCase):
+    def tearDown(self):
+        log_pipeline.stop_listener()
+
+    def test_key_value_formatter_quotes_values(self):
+        line = log_pipeline.KeyValueFormatter().format(
+            _record(event='sensor_update', fields={'public_key': '1pubA', 'fw': 'v 22', 'rssi': -70}))
+        self.assertIn('level=WARNING event=sensor_update public_key=1pubA fw="v 22" rssi=-70', line)
+        self.assertNotIn('msg=', line)
+
+        plain = log_pipeline.KeyValueFormatter().format(_record('plain message'))
+        self.assertIn('msg="plain message"', plain)
+
+    def test_json_formatter(self):
+        payload = json.loads(log_pipeline.JsonFormatter().format(
+            _record(event='relay_update', fields={'status': 1})))
+        self.assertEqual('relay_update', payload['event'])
+        self.assertEqual(1, payload['status'])
+
+    def test_parse_sample_rates(self):
+        self.assertEqual({'a': 10, 'b': 1}, log_pipeline.parse_sample_rates('a=10, b=0, c=x, d'))
+
+    def test_log_event_samples_routine_events_but_not_errors(self):
+        emitted = []
+        with patch.object(log_pipeline, 'SAMPLE_RATES', {'sensor_update': 3}), \
+            patch.object(log_pipeline, '_sample_counters', {}), \
+            patch.object(logging.getLogger(), 'log', side_effect=lambda *a, **k: emitted.append(k['extra'])):
+            results = [log_pipeline.log_event('sensor_update', public_key='1pubA') for _ in range(7)]
+            self.assertTrue(log_pipeline.log_event('sensor_update', level=logging.ERROR))
+            self.assertTrue(log_pipeline.log_event('frequency_violation', device_id=1))
+
+        self.assertEqual([True, False, False, True, False, False, True], results)
+        self.assertEqual(3, emitted[0]['fields']['sample'])
+        self.assertNotIn('sample', emitted[-1]['fields'])
+        self.assertEqual(5, len(emitted))
+
+    def test_queue_handler_writes_from_listener_thread(self):
+        stream = io.StringIO()
+        logger = logging.getLogger('log_pipeline_test')
+        logger.propagate = False
+        with patch('sys.stderr', stream):
+            handler = log_pipeline.build_handler(fmt='kv', use_queue=True)
+        self.assertIsInstance(handler, log_pipeline.DeferredQueueHandler)
+        logger.addHandler(handler)
+        try:
+            logger.warning('relay_update', extra={'event': 'relay_update', 'fields': {'status': 1}})
+            log_pipeline.stop_listener()
+        finally:
+            logger.removeHandler(handler)
+        self.assertIn('event=relay_update status=1', stream.getvalue())
+
+    def test_build_handler_synchronous(self):
+        handler = log_pipeline.build_handler(fmt='text', use_queue=False)
+        self.assertIsInstance(handler, logging.StreamHandler)
+        self.assertNotIsInstance(handler, log_pipeline.DeferredQueueHandler)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import StaticPool
+
+import db
+import migrations
+
+
+class MigrationsUnitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+
+    def _columns(self, table):
+        with self.engine.connect() as connection:
+            return [row[1] for row in connection.execute(text(f"PRAGMA table_info({table})")).fetchall()]
+
+    def test_migrate_upgrades_legacy_schema_once(self):
+        with self.engine.begin() as connection:
+            connection.execute(text("CREATE TABLE relay_settings (device INTEGER PRIMARY KEY, ALGO INTEGER)"))
+            connection.execute(text("CREATE TABLE sensor_settings (device INTEGER PRIMARY KEY, litros_por_cm REAL)"))
+            connection.execute(text("INSERT INTO sensor_settings (device, litros_por_cm) VALUES (1, 25.5)"))
+
+        self.assertEqual([1, 2, 3, 4, 6], migrations.migrate(self.engine))
+        self.assertEqual([], migrations.migrate(self.engine))
+
+        self.assertIn('CURRENCY_CODE', self._columns('relay_settings'))
+        self.assertIn('samples', self._columns('sensor_daily_stats'))
+        self.assertEqual(['relay_id', 'day_date', 'on_seconds', 'liters_added', 'updated_at'],
+                         self._columns('relay_daily_stats'))
+        with self.engine.connect() as connection:
+            liters = connection.execute(text("SELECT liters_per_cm FROM sensor_settings")).scalar()
+            versions = connection.execute(text("SELECT version FROM schema_version ORDER BY version")).fetchall()
+        self.assertEqual(25.5, liters)
+        # No relay_events table yet: step 5 is left pending.
+        self.assertEqual([1, 2, 3, 4, 6], [row[0] for row in versions])
+
+    def test_migrate_backfills_relay_event_masks(self):
+        with self.engine.begin() as connection:
+            connection.execute(text("CREATE TABLE relay_events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                    "relay_id INTEGER NOT NULL, events TEXT NOT NULL, created_at TEXT NOT NULL)"))
+            connection.execute(text("INSERT INTO relay_events (relay_id, events, created_at) VALUES "
+                                    "(20, '2,14,0,0,0', '2026-03-07 10:00:00'), (20, '0,0,0,0,0', '2026-03-07 11:00:00')"))
+        migrations.migrate(self.engine)
+        with self.engine.connect() as connection:
+            masks = connection.execute(text("SELECT mask FROM relay_events ORDER BY id")).fetchall()
+        self.assertEqual([(1 << 2) | (1 << 14), 0], [row[0] for row in masks])
+
+    def test_migrate_retries_step_whose_table_was_missing(self):
+        with patch.object(migrations, 'MIGRATIONS', migrations.MIGRATIONS[4:5]):
+            self.assertEqual([], migrations.migrate(self.engine))
+            with self.engine.begin() as connection:
+                connection.execute(text("CREATE TABLE relay_events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                        "relay_id INTEGER NOT NULL, events TEXT NOT NULL, created_at TEXT NOT NULL)"))
+            self.assertEqual([5], migrations.migrate(self.engine))
+        self.assertIn('mask', self._columns('relay_events'))
+
+    def test_migrate_records_already_upgraded_columns(self):
+        with self.engine.begin() as connection:
+            connection.execute(text("CREATE TABLE sensor_settings (device INTEGER PRIMARY KEY, liters_per_cm REAL)"))
+
+        with patch.object(migrations, 'MIGRATIONS', migrations.MIGRATIONS[1:2]):
+            self.assertEqual([2], migrations.migrate(self.engine))
+        self.assertEqual(1, self._columns('sensor_settings').count('liters_per_cm'))
+
+    def test_ensure_current_migrates_under_lock_file(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        path = os.path.join(tmp_dir.name, 'database.db')
+        engine = create_engine(f"sqlite:///{path}")
+        self.addCleanup(engine.dispose)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE relay_settings (device INTEGER PRIMARY KEY)"))
+            connection.execute(text("CREATE TABLE sensor_settings (device INTEGER PRIMARY KEY)"))
+            connection.execute(text("CREATE TABLE relay_events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                    "relay_id INTEGER NOT NULL, events TEXT NOT NULL, created_at TEXT NOT NULL)"))
+
+        migrations.ensure_current(engine)
+        migrations.ensure_current(engine)
+
+        self.assertTrue(os.path.exists(f"{path}.migrate-lock"))
+        self.assertEqual([], migrations.migrate(engine))
+
+    def test_ensure_current_fails_when_schema_stays_behind(self):
+        # No relay_events table: step 5 cannot run, so starting on this database must fail.
+        with self.assertRaisesRegex(RuntimeError, r'pending migrations: \[1, 2, 5\]'):
+            migrations.ensure_current(self.engine)
+
+    def test_hot_paths_issue_no_ddl(self):
+        migrations.migrate(self.engine)
+        statements = []
+
+        def _record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute', _record)
+        try:
+            with patch.object(db, 'engine', self.engine):
+                db.DevicesDB.apply_write_batch(relay_daily={(3, '2026-03-07'): (60, 0.0)})
+                db.DevicesDB.get_relay_daily_stats(3, start_date='2026-03-07', end_date='2026-03-07')
+                db.DevicesDB.get_sensor_history_range(7, 0, 3600, 'hour')
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', _record)
+
+        self.assertEqual(3, len(statements))
+        for statement in statements:
+            self.assertNotIn('CREATE', statement.upper())
+            self.assertNotIn('PRAGMA', statement.upper())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from unittest.mock import patch
+
+import redis
+
+import api
+import rate_limit
+
+
+class RateLimitUnitTestCase(unittest.TestCase):
+    def test_parse_policies(self):
+        self.assertEqual((0.5, 20.0), rate_limit.parse_policy('0.5/20'))
+        self.assertEqual((0.2, 10.0), rate_limit.parse_policy('bad'))
+        self.assertEqual((0.2, 10.0), rate_limit.parse_policy('0/20'))
+        self.assertEqual({'1': (0.2, 20.0), '3': (1.0, 5.0)},
+                         rate_limit.parse_device_policies('1=0.2/20, 3=1/5,broken'))
+
+    def test_device_policy_uses_key_type_prefix(self):
+        with patch.object(rate_limit, 'DEVICE_POLICIES', {'3': (1.0, 5.0)}), \
+            patch.object(rate_limit, 'DEFAULT_POLICY', (0.1, 2.0)):
+            self.assertEqual((1.0, 5.0), rate_limit.device_policy('3prvABC'))
+            self.assertEqual((0.1, 2.0), rate_limit.device_policy('1prvABC'))
+            self.assertEqual((0.1, 2.0), rate_limit.device_policy(None))
+
+    def test_device_label_hides_private_key(self):
+        label = rate_limit.device_label('1prvSECRETSECRET')
+        self.assertTrue(label.startswith('1prv:'))
+        self.assertNotIn('SECRET', label)
+        self.assertEqual(label, rate_limit.device_label('1prvSECRETSECRET'))
+
+    def test_local_buckets_burst_then_refill(self):
+        buckets = rate_limit.LocalBuckets(maxsize=10)
+        with patch('rate_limit.time.monotonic', return_value=100.0):
+            results = [buckets.take('dev:a', 'ip:a', (0.5, 2.0), (10.0, 100.0)) for _ in range(3)]
+        self.assertEqual([(0, 0), (0, 0)], results[:2])
+        self.assertEqual(rate_limit.LIMITED_DEVICE, results[2][0])
+        self.assertEqual(2001, results[2][1])
+        with patch('rate_limit.time.monotonic', return_value=102.0):
+            self.assertEqual((0, 0), buckets.take('dev:a', 'ip:a', (0.5, 2.0), (10.0, 100.0)))
+        # Another device from the same exhausted IP is rejected by the IP bucket
+        with patch('rate_limit.time.monotonic', return_value=102.0):
+            self.assertEqual((0, 0), buckets.take('dev:b', 'ip:b', (0.5, 2.0), (1.0, 1.0)))
+            self.assertEqual(rate_limit.LIMITED_IP, buckets.take('dev:c', 'ip:b', (0.5, 2.0), (1.0, 1.0))[0])
+        self.assertEqual({'rejected_device': 1, 'rejected_ip': 1}, dict(buckets.rejected))
+
+    def test_local_buckets_are_bounded(self):
+        buckets = rate_limit.LocalBuckets(maxsize=4)
+        for index in range(10):
+            buckets.take(f'dev:{index}', 'ip:a', (1.0, 5.0), (100.0, 1000.0))
+        self.assertEqual(4, len(buckets._buckets))
+
+    def test_take_falls_back_to_local_buckets_when_redis_fails(self):
+        with patch.object(rate_limit, 'take_script', side_effect=redis.ConnectionError('down')), \
+            patch.object(rate_limit.local_buckets, 'take', return_value=(1, 500)) as local_take:
+            self.assertEqual((1, 500), rate_limit.take('1prvX', '10.0.0.1'))
+        local_take.assert_called_once()
+        self.assertEqual('ip:10.0.0.1', local_take.call_args.args[1])
+
+    def test_take_uses_single_script_call(self):
+        with patch.object(rate_limit, 'take_script', return_value=[0, 0]) as script:
+            self.assertEqual((0, 0), rate_limit.take('1prvX', '10.0.0.1'))
+        script.assert_called_once()
+        keys = script.call_args.kwargs['keys']
+        self.assertEqual(f"rate-limit/dev/{rate_limit.device_label('1prvX')}", keys[0])
+        self.assertEqual('rate-limit/ip/10.0.0.1', keys[1])
+
+    def test_limited_request_is_rejected_before_key_validation(self):
+        client = api.app.test_client()
+        with patch('rate_limit.take', return_value=(rate_limit.LIMITED_DEVICE, 2500)) as take, \
+            patch('api.db.DevicesDB.valid_private_key') as valid_key:
+            response = client.get('/update', query_string={'key': '1prvX', 'distance': 10, 'voltage': 4},
+                                  headers={'X-Real-IP': '203.0.113.9'})
+        self.assertEqual(429, response.status_code)
+        self.assertEqual('3', response.headers['Retry-After'])
+        take.assert_called_once_with('1prvX', '203.0.113.9')
+        valid_key.assert_not_called()
+
+    def test_disabled_limiter_skips_buckets(self):
+        client = api.app.test_client()
+        with patch.object(rate_limit.settings, 'RATE_LIMIT_ENABLED', False), \
+            patch('rate_limit.take') as take, \
+            patch('api.db.DevicesDB.valid_private_key', return_value=None):
+            response = client.get('/relay-update', query_string={'key': '3prvX'})
+        self.assertEqual(404, response.status_code)
+        take.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import relay_commands
+
+
+class RelayCommandsUnitTest(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('relay_commands._ensure_listener')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_channel_name(self):
+        self.assertEqual('relay-action/3pubR', relay_commands.channel('3pubR'))
+
+    def test_pending_action_returns_without_waiting(self):
+        started = time.monotonic()
+        self.assertEqual(1, relay_commands.wait_for_action('3pubR', 10, lambda: 1))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertNotIn('3pubR', relay_commands._waiters)
+
+    def test_wakeup_delivers_posted_action(self):
+        actions = []
+
+        def post_action():
+            time.sleep(0.05)
+            actions.append(-1)
+            relay_commands._wake('3pubR')
+
+        threading.Thread(target=post_action).start()
+        started = time.monotonic()
+        action = relay_commands.wait_for_action('3pubR', 10, lambda: actions.pop() if actions else 0)
+        self.assertEqual(-1, action)
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_timeout_returns_zero(self):
+        checks = []
+
+        def take_action():
+            checks.append(1)
+            return 0
+
+        with patch.object(relay_commands, 'RECHECK_SECONDS', 0.05):
+            self.assertEqual(0, relay_commands.wait_for_action('3pubR', 0.2, take_action))
+        self.assertGreater(len(checks), 2)
+        self.assertNotIn('3pubR', relay_commands._waiters)
+
+
+    def test_issue_appends_to_capped_stream_and_wakes(self):
+        fake_redis = MagicMock()
+        pipe = fake_redis.pipeline.return_value
+        pipe.execute.return_value = ['1700000000000-0', True, 1]
+        with patch.object(relay_commands, 'redis_client', fake_redis), \
+            patch.object(relay_commands.settings, 'RELAY_COMMAND_QUEUE_MAX', 8):
+            self.assertEqual('1700000000000-0', relay_commands.issue('3pubR', -1, now_ms=1700000000000))
+        pipe.xadd.assert_called_once_with('relay-commands/3pubR', {'action': -1, 'issued_at': 1700000000000},
+                                          maxlen=8, approximate=True)
+        pipe.publish.assert_called_once_with('relay-action/3pubR', -1)
+
+    def test_issue_many_uses_one_pipeline(self):
+        fake_redis = MagicMock()
+        pipe = fake_redis.pipeline.return_value
+        pipe.execute.return_value = ['1-0', True, 1, '2-0', True, 0]
+        with patch.object(relay_commands, 'redis_client', fake_redis):
+            ids = relay_commands.issue_many({'3pubA': 1, '3pubB': -1}, now_ms=1700000000000)
+        self.assertEqual({'3pubA': '1-0', '3pubB': '2-0'}, ids)
+        fake_redis.pipeline.assert_called_once_with(transaction=False)
+        pipe.execute.assert_called_once_with()
+        self.assertEqual(['relay-action/3pubA', 'relay-action/3pubB'],
+                         [call.args[0] for call in pipe.publish.call_args_list])
+
+    def test_take_runs_one_script_call(self):
+        with patch.object(relay_commands, 'take_script', return_value=[1, 4200]) as script:
+            self.assertEqual((1, 4200), relay_commands.take('3pubR', 1, now_ms=1700000000000))
+        keys = script.call_args.kwargs['keys']
+        args = script.call_args.kwargs['args']
+        self.assertEqual(['relay-commands/3pubR', 'relay-command-state/3pubR', relay_commands.STATS_KEY], keys)
+        self.assertEqual([1700000000000, 1], args[:2])
+        self.assertEqual(list(relay_commands.LATENCY_BUCKETS_MS), args[5:])
+
+    def test_peek_prefers_outstanding_command(self):
+        fake_redis = MagicMock()
+        fake_redis.hgetall.return_value = {'cursor': '5-0', 'pending_action': '1'}
+        with patch.object(relay_commands, 'redis_client', fake_redis):
+            self.assertEqual(1, relay_commands.peek('3pubR'))
+            fake_redis.hgetall.return_value = {'cursor': '5-0'}
+            fake_redis.xrange.return_value = [('5-0', {'action': '1'}), ('6-0', {'action': '-1'})]
+            self.assertEqual(-1, relay_commands.peek('3pubR'))
+            fake_redis.xrange.return_value = [('5-0', {'action': '1'})]
+            self.assertEqual(0, relay_commands.peek('3pubR'))
+
+    def test_stats_reports_latency_percentiles(self):
+        fake_redis = MagicMock()
+        fake_redis.hgetall.return_value = {
+            'delivered': '10', 'acked': '10', 'expired': '1', 'latency_ms_sum': '50000',
+            'le_1000': '2', 'le_5000': '6', 'le_30000': '2',
+        }
+        with patch.object(relay_commands, 'redis_client', fake_redis):
+            data = relay_commands.stats()
+        self.assertEqual(10, data['acked'])
+        self.assertEqual(5000, data['latency_ms_avg'])
+        self.assertEqual(5000, data['latency_ms_p50'])
+        self.assertEqual(30000, data['latency_ms_p95'])
+        self.assertEqual(0, data['latency_ms_buckets']['inf'])
+
+if __name__ == '__main__':
+    unittest.main()
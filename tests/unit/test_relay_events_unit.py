@@ -0,0 +1,182 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+
+import relay_events
+
+
+def _id_key(entry_id):
+    ms, seq = entry_id.split('-')
+    return int(ms), int(seq)
+
+
+class FakeStreamRedis:
+    def __init__(self):
+        self.streams = {}
+        self.sets = {}
+        self.hashes = {}
+        self.clock_ms = 1700000000000
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        self.clock_ms += 1000
+        entry_id = f'{self.clock_ms}-0'
+        bucket = self.streams.setdefault(key, [])
+        bucket.append((entry_id, {name: str(value) for name, value in fields.items()}))
+        if maxlen is not None:
+            del bucket[:-maxlen]
+        return entry_id
+
+    def xrange(self, key, min='-', max='+', count=None):
+        exclusive = min.startswith('(')
+        bound = min.lstrip('(')
+        if bound == '-':
+            low = (0, -1)
+        elif '-' in bound:
+            low = _id_key(bound)
+        else:
+            low = (int(bound), -1)
+        entries = [(entry_id, fields) for entry_id, fields in self.streams.get(key, [])
+                   if _id_key(entry_id) > low or (not exclusive and _id_key(entry_id) == low)]
+        return entries[:count] if count else entries
+
+    def expire(self, key, seconds):
+        return True
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+        return len(members)
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+    def srem(self, key, *members):
+        self.sets.get(key, set()).difference_update(members)
+        return len(members)
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def hset(self, key, mapping=None):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def pipeline(self, transaction=True):
+        return FakeStreamPipeline(self)
+
+
+class FakeStreamPipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+
+class RelayEventsUnitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fake_redis = FakeStreamRedis()
+        patcher = patch.object(relay_events, 'redis_client', self.fake_redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Anything that slips past the mocks lands in a scratch file, never the repo's database.db.
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir.name, 'database.db')}")
+        self.addCleanup(engine.dispose)
+        engine_patcher = patch.object(relay_events.db, 'engine', engine)
+        engine_patcher.start()
+        self.addCleanup(engine_patcher.stop)
+
+    def test_viewers_read_from_their_own_cursor(self):
+        first_id = relay_events.append('3pubR', 20, '0,5,0,0,0', at=1700000001)
+        relay_events.append('3pubR', 20, '1,0,0,0,0', at=1700000002)
+
+        entries, cursor_a = relay_events.read('3pubR', now_ms=1700000003000)
+        self.assertEqual(['0,5,0,0,0', '1,0,0,0,0'], [fields['events'] for _, fields in entries])
+        # A second viewer still sees the first event: reads do not consume.
+        entries, cursor_b = relay_events.read('3pubR', since=first_id)
+        self.assertEqual(['1,0,0,0,0'], [fields['events'] for _, fields in entries])
+        self.assertEqual(cursor_a, cursor_b)
+
+        self.assertEqual(([], cursor_a), relay_events.read('3pubR', since=cursor_a))
+        relay_events.append('3pubR', 20, '0,0,7,0,0', at=1700000004)
+        entries, _ = relay_events.read('3pubR', since=cursor_a)
+        self.assertEqual(['0,0,7,0,0'], [fields['events'] for _, fields in entries])
+
+    def test_read_without_cursor_skips_old_entries(self):
+        relay_events.append('3pubR', 20, '0,5,0,0,0', at=1700000001)
+        entries, cursor = relay_events.read('3pubR', now_ms=1700000001000 + 10 * 60 * 1000)
+        self.assertEqual([], entries)
+        self.assertTrue(cursor)
+
+    def test_persist_bulk_inserts_new_entries_once(self):
+        relay_events.append('3pubA', 20, '0,5,0,0,0', at=1700000000)
+        relay_events.append('3pubA', 20, '0,5,0,0,0', at=1700000010)
+        relay_events.append('3pubB', 21, '1,0,0,0,0', at=1700000020)
+
+        with patch('relay_events.db.DevicesDB.get_relay_events', return_value=None), \
+            patch('relay_events.db.DevicesDB.apply_write_batch', return_value=True) as apply_batch:
+            self.assertEqual(2, relay_events.persist())
+            self.assertEqual(0, relay_events.persist())
+
+        rows = apply_batch.call_args.kwargs['relay_events']
+        self.assertEqual([(20, '0,5,0,0,0'), (21, '1,0,0,0,0')], [(row[0], row[1]) for row in rows])
+        apply_batch.assert_called_once()
+        self.assertEqual(set(), self.fake_redis.smembers(relay_events.DIRTY_KEY))
+
+    def test_persist_skips_repeat_of_last_stored_row_within_window(self):
+        stored = []
+
+        def last_stored(relay_id, total_limit):
+            return [{'events': stored[-1][1], 'created_at': stored[-1][2]}] if stored else None
+
+        def apply_batch(relay_events=None):
+            stored.extend(relay_events)
+            return True
+
+        with patch('relay_events.db.DevicesDB.get_relay_events', side_effect=last_stored), \
+            patch('relay_events.db.DevicesDB.apply_write_batch', side_effect=apply_batch):
+            relay_events.append('3pubA', 20, '0,5,0,0,0', at=1700000000)
+            self.assertEqual(1, relay_events.persist())
+            relay_events.append('3pubA', 20, '0,5,0,0,0', at=1700000010)
+            self.assertEqual(0, relay_events.persist())
+            relay_events.append('3pubA', 20, '0,5,0,0,0', at=1700000045)
+            self.assertEqual(1, relay_events.persist())
+
+        self.assertEqual(2, len(stored))
+
+    def test_persist_failure_keeps_entries_for_retry(self):
+        relay_events.append('3pubA', 20, '0,5,0,0,0', at=1700000000)
+        with patch('relay_events.db.DevicesDB.get_relay_events', return_value=None), \
+            patch('relay_events.db.DevicesDB.apply_write_batch', side_effect=RuntimeError('locked')):
+            self.assertEqual(0, relay_events.persist())
+        self.assertEqual({'3pubA'}, self.fake_redis.smembers(relay_events.DIRTY_KEY))
+
+        with patch('relay_events.db.DevicesDB.get_relay_events', return_value=None), \
+            patch('relay_events.db.DevicesDB.apply_write_batch', return_value=True) as apply_batch:
+            self.assertEqual(1, relay_events.persist())
+        self.assertEqual(20, apply_batch.call_args.kwargs['relay_events'][0][0])
+
+    def test_persist_keeps_relay_dirty_while_backlog_remains(self):
+        for at in (1700000000, 1700000100, 1700000200):
+            relay_events.append('3pubA', 20, f'0,{at % 7},0,0,0', at=at)
+        with patch('relay_events.db.DevicesDB.get_relay_events', return_value=None), \
+            patch('relay_events.db.DevicesDB.apply_write_batch', return_value=True):
+            self.assertEqual(2, relay_events.persist(max_entries=2))
+            self.assertEqual({'3pubA'}, self.fake_redis.smembers(relay_events.DIRTY_KEY))
+            self.assertEqual(1, relay_events.persist(max_entries=2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import datetime
+import unittest
+from unittest.mock import MagicMock, patch
+
+import redis
+from flask import Flask
+
+import relay_reports
+import write_behind
+
+
+RATES = (2.0, 500.0, 0.25, 'USD')
+# 2026-03-10 12:00 UTC: days up to 2026-03-09 are settled.
+NOW_TS = 1773144000
+
+
+class FakeReportRedis:
+    def __init__(self, hashes=None, generation=None):
+        self.hashes = hashes or {}
+        self.generation = generation
+
+    def get(self, key):
+        return self.generation
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def pipeline(self, transaction=True):
+        return FakeReportPipeline(self)
+
+
+class FakeReportPipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def hmget(self, key, fields):
+        self.calls.append((key, fields))
+
+    def execute(self):
+        return [self.redis_client.hmget(key, fields) for key, fields in self.calls]
+
+
+def _stats(relay_id, start_date=None, end_date=None):
+    start = datetime.date.fromisoformat(str(start_date))
+    end = datetime.date.fromisoformat(str(end_date))
+    return [{'day': (start + datetime.timedelta(days=offset)).isoformat(), 'on_minutes': 60, 'liters': 100.0}
+            for offset in range((end - start).days + 1)]
+
+
+class RelayReportsUnitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        relay_reports.db.cache.init_app(self.app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 300})
+        ctx = self.app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+
+    def test_resolve_rates_falls_back_to_defaults(self):
+        rates = relay_reports.resolve_rates({'WATER_COST_PER_M3': -1, 'RELAY_POWER_WATTS': 'x',
+                                             'ENERGY_COST_PER_KWH': 0.3, 'CURRENCY_CODE': 'eur'})
+        self.assertEqual((relay_reports.settings.DEFAULT_WATER_COST_PER_M3,
+                          relay_reports.settings.DEFAULT_RELAY_POWER_WATTS, 0.3, 'EUR'), rates)
+
+    def test_current_month_is_cached_prefix_plus_live_days(self):
+        today_ts = 1773100800  # 2026-03-10 00:00 UTC
+        fake_redis = FakeReportRedis({write_behind.RELAY_DAILY_KEY: {
+            f'7|{today_ts}|on_seconds': '1800',
+            f'7|{today_ts}|liters': '50',
+        }}, generation='3')
+        with patch('relay_reports.db.DevicesDB.get_relay_daily_stats', side_effect=_stats):
+            prefix = relay_reports.settled_month.uncached(7, '2026-03', '2026-03-09', RATES, 3)
+        with patch.object(relay_reports, 'redis_client', fake_redis), \
+            patch('relay_reports.settled_month', return_value=prefix) as settled_month, \
+            patch('relay_reports.db.DevicesDB.get_relay_daily_stats', side_effect=_stats) as get_stats:
+            data = relay_reports.report(7, datetime.date(2026, 3, 1), datetime.date(2026, 3, 10), RATES,
+                                        now_ts=NOW_TS)
+
+        settled_month.assert_called_once_with(7, '2026-03', '2026-03-09', RATES, 3)
+        self.assertEqual(datetime.date(2026, 3, 10), get_stats.call_args.kwargs['start_date'])
+        self.assertEqual(10, len(data['days']))
+        self.assertEqual({'day': '2026-03-10', 'on_minutes': 90, 'liters': 150.0, 'water_cost': 0.3,
+                          'energy_cost': 0.1875, 'energy_wh': 750.0}, data['days'][-1])
+        self.assertEqual(630, data['totals']['on_minutes'])
+        self.assertEqual(1050.0, data['totals']['liters'])
+
+    def test_closed_months_are_built_once_and_sliced(self):
+        fake_redis = FakeReportRedis()
+        with patch.object(relay_reports, 'redis_client', fake_redis), \
+            patch('relay_reports.db.DevicesDB.get_relay_daily_stats', side_effect=_stats) as get_stats:
+            data = relay_reports.report(7, datetime.date(2026, 1, 30), datetime.date(2026, 2, 2), RATES,
+                                        now_ts=NOW_TS)
+            again = relay_reports.report(7, datetime.date(2026, 1, 30), datetime.date(2026, 2, 2), RATES,
+                                         now_ts=NOW_TS)
+            relay_reports.report(7, datetime.date(2026, 1, 30), datetime.date(2026, 2, 2), (3.0,) + RATES[1:],
+                                 now_ts=NOW_TS)
+            fake_redis.generation = '1'
+            relay_reports.report(7, datetime.date(2026, 1, 30), datetime.date(2026, 2, 2), RATES, now_ts=NOW_TS)
+
+        self.assertEqual(data, again)
+        # Built again only for new settings or a new data generation.
+        self.assertEqual(6, get_stats.call_count)
+
+        self.assertEqual(['2026-01-30', '2026-01-31', '2026-02-01', '2026-02-02'], [day['day'] for day in data['days']])
+        self.assertEqual([('2026-01-01', '2026-01-31'), ('2026-02-01', '2026-02-28')],
+                         [(call.kwargs['start_date'], call.kwargs['end_date']) for call in get_stats.call_args_list[:2]])
+
+    def test_year_report_uses_monthly_summaries(self):
+        fake_redis = FakeReportRedis()
+        with patch.object(relay_reports, 'redis_client', fake_redis), \
+            patch('relay_reports.db.DevicesDB.get_relay_daily_stats', side_effect=_stats):
+            data = relay_reports.year_report(7, 2026, datetime.date(2026, 3, 10), RATES, now_ts=NOW_TS)
+
+        self.assertEqual(['2026-01', '2026-02', '2026-03'], [month['month'] for month in data['months']])
+        self.assertEqual(31 * 60, data['months'][0]['on_minutes'])
+        self.assertEqual(10 * 100.0, data['months'][2]['liters'])
+        self.assertEqual((31 + 28 + 10) * 60, data['totals']['on_minutes'])
+
+    def test_redis_down_builds_reports_without_cache(self):
+        broken = MagicMock()
+        broken.get.side_effect = redis.ConnectionError('down')
+        broken.pipeline.side_effect = redis.ConnectionError('down')
+        with patch.object(relay_reports, 'redis_client', broken), \
+            patch('relay_reports.db.DevicesDB.get_relay_daily_stats', side_effect=_stats), \
+            patch('relay_reports.settled_month.uncached', wraps=relay_reports.settled_month.uncached) as uncached:
+            data = relay_reports.report(7, datetime.date(2026, 3, 1), datetime.date(2026, 3, 10), RATES,
+                                        now_ts=NOW_TS)
+
+        uncached.assert_called_once()
+        self.assertEqual(600, data['totals']['on_minutes'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import datetime
+import unittest
+from unittest.mock import patch
+
+import relay_scheduler
+
+
+class FakeScheduleRedis:
+    def __init__(self):
+        self.counter = 0
+        self.sets = {}
+        self.hashes = {}
+        self.zsets = {}
+
+    def incr(self, key):
+        self.counter += 1
+        return self.counter
+
+    def scard(self, key):
+        return len(self.sets.get(key, set()))
+
+    def sismember(self, key, member):
+        return member in self.sets.get(key, set())
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def srem(self, key, *members):
+        self.sets.get(key, set()).difference_update(members)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.hashes.get(key, {}).pop(field, None)
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, *members):
+        for member in members:
+            self.zsets.get(key, {}).pop(member, None)
+
+    def zscore(self, key, member):
+        return self.zsets.get(key, {}).get(member)
+
+    def pipeline(self, transaction=True):
+        return FakeSchedulePipeline(self)
+
+    def add_schedule(self, keys, args, client=None):
+        relay_set, defs_key, due_key, _ = keys
+        limit, definition, due_ts = args
+        if self.scard(relay_set) >= int(limit):
+            return None
+        schedule_id = str(self.incr(keys[3]))
+        self.hset(defs_key, schedule_id, definition)
+        self.sadd(relay_set, schedule_id)
+        self.zadd(due_key, {f'{schedule_id}|on': due_ts})
+        return schedule_id
+
+    def pop_due(self, keys, args, client=None):
+        now, limit = args
+        due = sorted((score, member) for member, score in self.zsets.get(keys[0], {}).items() if score <= now)
+        popped = []
+        for score, member in due[:limit]:
+            del self.zsets[keys[0]][member]
+            popped.extend([member, str(score)])
+        return popped
+
+
+class FakeSchedulePipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+
+def _ts(hour, minute=0, day=7):
+    return int(datetime.datetime(2026, 3, day, hour, minute, tzinfo=datetime.timezone.utc).timestamp())
+
+
+class RelaySchedulerUnitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fake_redis = FakeScheduleRedis()
+        for patcher in (patch.object(relay_scheduler, 'redis_client', self.fake_redis),
+                        patch.object(relay_scheduler, 'pop_due_script', self.fake_redis.pop_due),
+                        patch.object(relay_scheduler, 'add_script', self.fake_redis.add_schedule)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_next_run_rolls_to_next_day(self):
+        self.assertEqual(_ts(6), relay_scheduler.next_run('06:00', _ts(5, 59)))
+        self.assertEqual(_ts(6, day=8), relay_scheduler.next_run('06:00', _ts(6)))
+        with self.assertRaises(ValueError):
+            relay_scheduler.next_run('25:00', _ts(6))
+
+    def test_time_of_day_is_in_the_schedule_timezone(self):
+        # 06:00 in Santo Domingo (UTC-4) is 10:00 UTC; Madrid switches to CEST on 2026-03-29.
+        self.assertEqual(_ts(10), relay_scheduler.next_run('06:00', _ts(5), 'America/Santo_Domingo'))
+        self.assertEqual(_ts(5, day=29), relay_scheduler.next_run('07:00', _ts(6, day=28), 'Europe/Madrid'))
+        with self.assertRaises(ValueError):
+            relay_scheduler.next_run('06:00', _ts(5), 'Mars/Olympus')
+
+        schedule_id = relay_scheduler.add('3pubR', '06:00', now_ts=_ts(5), tz='America/Santo_Domingo')
+        self.assertEqual([{'id': schedule_id, 'at': '06:00', 'duration_minutes': 0, 'action': 1,
+                           'timezone': 'America/Santo_Domingo', 'next_run': _ts(10)}],
+                         relay_scheduler.list_schedules('3pubR'))
+        with self.assertRaises(ValueError):
+            relay_scheduler.add('3pubR', '06:00', tz='Mars/Olympus')
+
+    def test_on_for_duration_then_off_and_repeat_daily(self):
+        schedule_id = relay_scheduler.add('3pubR', '6:00', duration_minutes=20, now_ts=_ts(5))
+        self.assertEqual([{'id': schedule_id, 'at': '06:00', 'duration_minutes': 20, 'action': 1,
+                           'timezone': 'UTC', 'next_run': _ts(6)}], relay_scheduler.list_schedules('3pubR'))
+
+        with patch('relay_scheduler.relay_commands.issue_many') as issue_many:
+            self.assertEqual(0, relay_scheduler.run_due(now_ts=_ts(5, 59)))
+            self.assertEqual(1, relay_scheduler.run_due(now_ts=_ts(6)))
+            self.assertEqual(1, relay_scheduler.run_due(now_ts=_ts(6, 20)))
+
+        self.assertEqual([{'3pubR': 1}, {'3pubR': -1}], [call.args[0] for call in issue_many.call_args_list])
+        self.assertEqual({f'{schedule_id}|on': _ts(6, day=8)}, self.fake_redis.zsets[relay_scheduler.DUE_KEY])
+
+    def test_same_relay_entries_due_together_send_the_latest(self):
+        first = relay_scheduler.add('3pubR', '06:00', duration_minutes=20, now_ts=_ts(5))
+        second = relay_scheduler.add('3pubR', '06:21', now_ts=_ts(5))
+        with patch('relay_scheduler.relay_commands.issue_many') as issue_many:
+            relay_scheduler.run_due(now_ts=_ts(6))
+            with self.assertLogs(level='WARNING') as logs:
+                self.assertEqual(2, relay_scheduler.run_due(now_ts=_ts(6, 21)))
+
+        # The 06:20 "off" of the first schedule is superseded by the 06:21 start of the second.
+        self.assertEqual({'3pubR': 1}, issue_many.call_args.args[0])
+        self.assertIn(f'{first}|off superseded by {second}|on', logs.output[0])
+
+    def test_stale_start_is_skipped_but_rescheduled(self):
+        schedule_id = relay_scheduler.add('3pubR', '06:00', duration_minutes=20, now_ts=_ts(5))
+        with patch('relay_scheduler.relay_commands.issue_many') as issue_many:
+            self.assertEqual(0, relay_scheduler.run_due(now_ts=_ts(9)))
+        issue_many.assert_not_called()
+        self.assertEqual({f'{schedule_id}|on': _ts(6, day=8)}, self.fake_redis.zsets[relay_scheduler.DUE_KEY])
+
+    def test_issue_failure_requeues_due_entries(self):
+        schedule_id = relay_scheduler.add('3pubR', '06:00', now_ts=_ts(5))
+        with patch('relay_scheduler.relay_commands.issue_many', side_effect=RuntimeError('down')):
+            self.assertEqual(0, relay_scheduler.run_due(now_ts=_ts(6)))
+        self.assertEqual({f'{schedule_id}|on': _ts(6)}, self.fake_redis.zsets[relay_scheduler.DUE_KEY])
+
+    def test_remove_drops_pending_actions_and_limits_apply(self):
+        schedule_id = relay_scheduler.add('3pubR', '06:00', now_ts=_ts(5))
+        self.assertFalse(relay_scheduler.remove('3pubOther', schedule_id))
+        self.assertTrue(relay_scheduler.remove('3pubR', schedule_id))
+        self.assertEqual({}, self.fake_redis.zsets[relay_scheduler.DUE_KEY])
+        self.assertEqual([], relay_scheduler.list_schedules('3pubR'))
+
+        with patch.object(relay_scheduler.settings, 'RELAY_SCHEDULES_MAX_PER_RELAY', 1):
+            relay_scheduler.add('3pubR', '07:00', now_ts=_ts(5))
+            with self.assertRaises(ValueError):
+                relay_scheduler.add('3pubR', '08:00', now_ts=_ts(5))
+        with self.assertRaises(ValueError):
+            relay_scheduler.add('3pubX', '08:00', action=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+
+import sensor_history
+
+
+class SensorHistoryUnitTestCase(unittest.TestCase):
+    def test_pack_roundtrip_and_record_size(self):
+        hour_ts = 1700000000 - (1700000000 % 3600)
+        record = sensor_history.pack_record(hour_ts + 3599, 57, 3.71)
+        self.assertEqual(5, len(record))
+        self.assertEqual([(hour_ts + 3599, 57, 3.71)], sensor_history.unpack_records(record, hour_ts))
+
+    def test_pack_clamps_out_of_range_values(self):
+        record = sensor_history.pack_record(0, 300, 900.0)
+        self.assertEqual([(0, 255, 655.35)], sensor_history.unpack_records(record, 0))
+        record = sensor_history.pack_record(0, -5, -1)
+        self.assertEqual([(0, 0, 0.0)], sensor_history.unpack_records(record, 0))
+
+    def test_unpack_ignores_partial_trailing_record(self):
+        blob = sensor_history.pack_record(10, 50, 3.7) + b'\x01\x02'
+        self.assertEqual([(10, 50, 3.7)], sensor_history.unpack_records(blob, 0))
+        self.assertEqual([], sensor_history.unpack_records(None, 0))
+
+    def test_parse_legacy_member_formats(self):
+        self.assertEqual((57.0, 3.71), sensor_history.parse_legacy_member("57|3.71|1729182312345678901"))
+        self.assertEqual((57.0, 3.71), sensor_history.parse_legacy_member("57|3.71"))
+        self.assertIsNone(sensor_history.parse_legacy_member("bad"))
+
+    def test_append_samples_groups_by_hour(self):
+        calls = []
+
+        class _Pipe:
+            def append(self, key, value):
+                calls.append(('append', key, value))
+
+            def expireat(self, key, when):
+                calls.append(('expireat', key, when))
+
+        written = sensor_history.append_samples(_Pipe(), '1pubA', [
+            (3600 + 5, 10, 3.5), (3600 + 10, 11, 3.5), (7200 + 1, 12, 3.6)
+        ], 100)
+        self.assertEqual([3600, 7200], written)
+        self.assertEqual(('append', 'tin-hist/1pubA/3600', sensor_history.pack_record(3605, 10, 3.5)
+                          + sensor_history.pack_record(3610, 11, 3.5)), calls[0])
+        self.assertEqual(('expireat', 'tin-hist/1pubA/3600', 3600 + 3600 + 100), calls[1])
+        self.assertEqual('tin-hist/1pubA/7200', calls[2][1])
+
+    def test_decode_rollup_and_summarize_agree(self):
+        samples = [(3600 + 5, 40, 3.6), (3600 + 10, 60, 3.8)]
+        raw = {b'n': b'2', b'p_sum': b'100', b'v_sum': b'740', b'p_min': b'40', b'p_max': b'60',
+               b'p_last': b'60', b'v_min': b'360', b'v_max': b'380', b'v_last': b'380', b'ts_last': b'3610'}
+        self.assertEqual(sensor_history.summarize(samples), sensor_history.decode_rollup(raw))
+        self.assertIsNone(sensor_history.decode_rollup({}))
+        self.assertIsNone(sensor_history.summarize([]))
+
+    def test_bucket_stats_matches_summarize_per_bucket(self):
+        samples = [(3600 + 5, 40, 3.6), (3600 + 299, 60, 3.8), (3600 + 900, 50, 3.7), (3600 + 7200, 99, 4.0)]
+        buckets = sensor_history.bucket_stats(samples, 3600, 300, 4)
+
+        expected = sensor_history.summarize(samples[:2])
+        del expected['last_ts']
+        self.assertEqual(expected, buckets[0])
+        self.assertIsNone(buckets[1])
+        self.assertEqual(1, buckets[3]['count'])
+        self.assertEqual({'percent_max': 50.0, 'voltage_max': 3.7, 'count': 1},
+                         sensor_history.bucket_stats(samples, 3600, 900, 2, ('max', 'count'))[1])
+        self.assertEqual([None, None], sensor_history.bucket_stats([], 0, 60, 2))
+
+    def test_read_summaries_falls_back_to_raw_hours(self):
+        class _Pipe:
+            def __init__(self, results):
+                self.results = results
+
+            def hgetall(self, key):
+                pass
+
+            def get(self, key):
+                pass
+
+            def execute(self):
+                return self.results.pop(0)
+
+        class _Client:
+            def __init__(self):
+                self.results = [
+                    [{b'n': b'1', b'p_sum': b'10', b'v_sum': b'350', b'p_min': b'10', b'p_max': b'10',
+                      b'p_last': b'10', b'v_min': b'350', b'v_max': b'350', b'v_last': b'350', b'ts_last': b'5'}, {}],
+                    [sensor_history.pack_record(3600 + 7, 20, 3.6)],
+                ]
+
+            def pipeline(self, transaction=True):
+                return _Pipe(self.results)
+
+        summaries = sensor_history.read_summaries(_Client(), '1pubA', [0, 3600])
+        self.assertEqual(1, summaries[0]['count'])
+        self.assertEqual(10.0, summaries[0]['percent_avg'])
+        self.assertEqual(20.0, summaries[3600]['percent_last'])
+        self.assertEqual(3607, summaries[3600]['last_ts'])
+
+    def test_pick_resolution(self):
+        day = 86400
+        now = 400 * day
+        self.assertEqual('hour', sensor_history.pick_resolution(now - 7 * day, now, 400, now - 90 * day))
+        self.assertEqual('day', sensor_history.pick_resolution(now - 30 * day, now, 400, now - 90 * day))
+        self.assertEqual('day', sensor_history.pick_resolution(now - 100 * day, now - 99 * day, 400, now - 90 * day))
+
+
+if __name__ == "__main__":
+    unittest.main()
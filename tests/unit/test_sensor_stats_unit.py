@@ -4,15 +4,38 @@ import unittest
 from unittest.mock import patch
 
 import app as app_module
+import sensor_history
 from app import app
 
 
 class FakeRedisSortedSet:
     def __init__(self):
         self._data = {}
+        self._strings = {}
+        self._hashes = {}
 
     def delete(self, key):
         self._data.pop(key, None)
+        self._strings.pop(key, None)
+        self._hashes.pop(key, None)
+
+    def hgetall(self, key):
+        return dict(self._hashes.get(key, {}))
+
+    def hset(self, key, mapping):
+        self._hashes.setdefault(key, {}).update(mapping)
+
+    def get(self, key):
+        return self._strings.get(key)
+
+    def append(self, key, value):
+        self._strings[key] = self._strings.get(key, b'') + value
+
+    def expireat(self, key, when):
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
 
     def zadd(self, key, mapping):
         bucket = self._data.setdefault(key, [])
@@ -28,11 +51,30 @@ class FakeRedisSortedSet:
         return matches
 
 
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+
 class SensorStatsUnitTest(unittest.TestCase):
     def setUp(self):
         self.fake_redis = FakeRedisSortedSet()
         self.redis_patcher = patch.object(app_module, 'redis_client', self.fake_redis)
         self.redis_patcher.start()
+        self.history_patcher = patch.object(app_module, 'history_redis_client', self.fake_redis)
+        self.history_patcher.start()
         self.app = app.test_client()
         self.pub = 'unittest_pubkey'
         self.history_key = f'tin-history/{self.pub}'
@@ -41,6 +83,7 @@ class SensorStatsUnitTest(unittest.TestCase):
     def tearDown(self):
         self.fake_redis.delete(self.history_key)
         self.redis_patcher.stop()
+        self.history_patcher.stop()
 
     def test_sensor_stats_empty(self):
         # No data -> all buckets offline
@@ -94,6 +137,54 @@ class SensorStatsUnitTest(unittest.TestCase):
         ts_list = [s['ts'] for s in d2['samples']]
         self.assertEqual(ts_list, sorted(ts_list))
 
+    def test_sensor_stats_reads_packed_history_and_dedupes(self):
+        now = int(time.time())
+        hour_start = now - (now % 3600)
+        samples = [
+            (hour_start + 10, 40, 3.6),
+            (hour_start + 40, 50, 3.7),
+        ]
+        pipe = self.fake_redis.pipeline()
+        sensor_history.append_samples(pipe, self.pub, samples, sensor_history.RETENTION_SECONDS)
+        # A retried batch upload appends identical records again
+        sensor_history.append_samples(pipe, self.pub, samples[1:], sensor_history.RETENTION_SECONDS)
+        pipe.execute()
+        # Not-yet-migrated legacy point in the same hour is merged in
+        self.fake_redis.zadd(self.history_key, {"60|3.8|1": hour_start + 70})
+        self.addCleanup(self.fake_redis.delete, sensor_history.hour_key(self.pub, hour_start))
+
+        rv = self.app.get('/sensor_stats', query_string={'public_key': self.pub})
+        bucket = [b for b in json.loads(rv.data)['buckets'] if b['hour_start'] == hour_start][0]
+        self.assertEqual(50, bucket['percent'])
+        self.assertAlmostEqual(3.7, bucket['voltage'])
+
+        rv2 = self.app.get('/sensor_stats_hour', query_string={'public_key': self.pub, 'hour_start': hour_start})
+        d2 = json.loads(rv2.data)
+        self.assertEqual([hour_start + 10, hour_start + 40, hour_start + 70], [s['ts'] for s in d2['samples']])
+        self.assertEqual(40.0, d2['samples'][0]['percent'])
+        self.assertEqual(3.6, d2['samples'][0]['voltage'])
+
+    def test_sensor_stats_prefers_hourly_rollup(self):
+        now = int(time.time())
+        hour_start = now - (now % 3600)
+        rollup = sensor_history.rollup_key(self.pub, hour_start)
+        self.fake_redis.hset(rollup, {
+            'n': 4, 'p_sum': 200, 'v_sum': 1480, 'p_min': 40, 'p_max': 60, 'p_last': 55,
+            'v_min': 360, 'v_max': 380, 'v_last': 372, 'ts_last': hour_start + 100,
+        })
+        self.addCleanup(self.fake_redis.delete, rollup)
+        # Raw samples disagree on purpose: the rollup must be used without scanning them
+        self.fake_redis.zadd(self.history_key, {"10|3.0": hour_start + 5})
+
+        rv = self.app.get('/sensor_stats', query_string={'public_key': self.pub})
+        bucket = [b for b in json.loads(rv.data)['buckets'] if b['hour_start'] == hour_start][0]
+        self.assertEqual(50, bucket['percent'])
+        self.assertEqual(3.7, bucket['voltage'])
+        self.assertEqual(4, bucket['samples'])
+        self.assertEqual(40, bucket['percent_min'])
+        self.assertEqual(55, bucket['percent_last'])
+        self.assertEqual(3.8, bucket['voltage_max'])
+
 
 if __name__ == '__main__':
     unittest.main()
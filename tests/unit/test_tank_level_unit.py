@@ -0,0 +1,110 @@
+import itertools
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+import tank_level
+
+
+class _Settings(SimpleNamespace):
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+
+def legacy_relay_percent(distance, empty_level, top_margin):
+    """Formula previously inlined in api.relay_update() and the alert crons."""
+    if empty_level == 0:
+        empty_level = 1
+    return min(100, 100 - min(100, int(((distance - top_margin) * 100.0) / ((empty_level - top_margin)))))
+
+
+def legacy_history_percent(distance, empty_level, top_margin):
+    """Formula previously used by api.history_percent()."""
+    empty_level = float(empty_level)
+    top_margin = float(top_margin)
+    dval = float(distance)
+    if empty_level > 0 and empty_level <= dval:
+        return 0
+    if empty_level == 0:
+        empty_level = 1.0
+    usable = (empty_level - top_margin) if (empty_level - top_margin) != 0 else 1.0
+    pct = 100.0 - ((dval - top_margin) * 100.0 / usable)
+    return int(max(0, min(100, pct)))
+
+
+def legacy_liters(distance, empty_level, top_margin, liters_per_cm):
+    """Formula previously inlined in app.get_device_data() and api.relay_update()."""
+    dist_val = float(distance)
+    if dist_val > empty_level:
+        dist_val = empty_level
+    if dist_val < top_margin:
+        dist_val = top_margin
+    water_height_cm = empty_level - dist_val
+    if water_height_cm < 0:
+        water_height_cm = 0
+    return water_height_cm * liters_per_cm
+
+
+GRID = list(itertools.product(
+    [0, 5, 19, 20, 21, 33, 57, 99, 120, 150, 151, 400],  # distance
+    [0, 1, 100, 150, 333],                                # EMPTY_LEVEL
+    [0, 10, 20],                                          # TOP_MARGIN
+))
+
+
+class TankLevelUnitTestCase(unittest.TestCase):
+    def test_percent_matches_legacy_relay_and_alert_formula(self):
+        for distance, empty_level, top_margin in GRID:
+            if top_margin >= max(1, empty_level):
+                continue  # invalid settings: legacy formula raised or inverted the scale
+            self.assertEqual(legacy_relay_percent(distance, empty_level, top_margin),
+                             tank_level.level_percent(distance, empty_level, top_margin),
+                             (distance, empty_level, top_margin))
+
+    def test_percent_within_one_point_of_legacy_history_formula(self):
+        # History truncated after subtracting from 100; the shared formula
+        # truncates the used depth first (as relays and alerts always did).
+        for distance, empty_level, top_margin in GRID:
+            legacy = legacy_history_percent(distance, empty_level, top_margin)
+            current = tank_level.level_percent(distance, empty_level, top_margin)
+            self.assertIn(current - legacy, (0, 1), (distance, empty_level, top_margin))
+
+    def test_zero_usable_depth_does_not_raise(self):
+        self.assertEqual(100, tank_level.level_percent(19, 20, 20))
+        self.assertEqual(0, tank_level.level_percent(20, 20, 20))
+        self.assertEqual(100, tank_level.level_percent(0, 0, 1))
+
+    def test_liters_match_legacy_formula(self):
+        for distance, empty_level, top_margin in GRID:
+            self.assertAlmostEqual(legacy_liters(distance, empty_level, top_margin, 12.5),
+                                   tank_level.liters(distance, empty_level, top_margin, 12.5))
+
+    def test_settings_levels(self):
+        sensor_settings = _Settings(EMPTY_LEVEL=120, TOP_MARGIN=20, liters_per_cm=2.0)
+        self.assertEqual((50, 50.0, 100.0), tank_level.settings_levels(sensor_settings, 70))
+        self.assertEqual((50, 50.0, 500.0), tank_level.settings_levels(
+            _Settings(EMPTY_LEVEL=120, TOP_MARGIN=20), 70))
+
+    def test_batch_matches_scalar_path(self):
+        distances, empty_levels, top_margins = (list(column) for column in zip(*GRID))
+        liters_per_cm = [1.0 + (index % 7) for index in range(len(GRID))]
+        result = tank_level.batch_levels(distances, empty_levels, top_margins, liters_per_cm)
+
+        self.assertEqual(np.dtype(int), result['percent'].dtype)
+        for index, (distance, empty_level, top_margin) in enumerate(GRID):
+            self.assertEqual(tank_level.level_percent(distance, empty_level, top_margin),
+                             result['percent'][index], GRID[index])
+            self.assertAlmostEqual(tank_level.water_height_cm(distance, empty_level, top_margin),
+                                   result['water_height_cm'][index])
+            self.assertAlmostEqual(tank_level.liters(distance, empty_level, top_margin, liters_per_cm[index]),
+                                   result['liters'][index])
+
+    def test_batch_broadcasts_scalar_settings(self):
+        result = tank_level.batch_levels([20, 70, 120, 200], 120, 20)
+        self.assertEqual([100, 50, 0, 0], result['percent'].tolist())
+        self.assertEqual([1000.0, 500.0, 0.0, 0.0], result['liters'].tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
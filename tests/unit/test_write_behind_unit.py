@@ -0,0 +1,301 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+import write_behind
+
+
+class FakeQueueRedis:
+    def __init__(self, items=None):
+        self.lists = {write_behind.QUEUE_KEY: list(items or [])}
+        self.hashes = {}
+        self.strings = {}
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, [])[start:end + 1 if end != -1 else None])
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lrange(key, start, end)
+        return True
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def incr(self, key):
+        self.hashes[key] = int(self.hashes.get(key, 0)) + 1
+        return self.hashes[key]
+
+    def hincrby(self, key, field, amount=1):
+        bucket = self.hashes.setdefault(key, {})
+        bucket[field] = str(int(bucket.get(field, 0)) + amount)
+        return int(bucket[field])
+
+    def hset(self, key, mapping=None):
+        self.hashes.setdefault(key, {}).update({field: str(value) for field, value in mapping.items()})
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hlen(self, key):
+        return len(self.hashes.get(key, {}))
+
+    def renamenx(self, src, dst):
+        if src not in self.hashes:
+            raise write_behind.redis.ResponseError('no such key')
+        if dst in self.hashes:
+            return False
+        self.hashes[dst] = self.hashes.pop(src)
+        return True
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.strings:
+            return None
+        self.strings[key] = str(value)
+        return True
+
+    def get(self, key):
+        return self.strings.get(key)
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+        self.strings.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return FakeQueuePipeline(self)
+
+
+class FakeQueuePipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+
+def _intent(op, at=1772877600, **fields):
+    return json.dumps(dict(fields, op=op, at=at))
+
+
+class WriteBehindUnitTestCase(unittest.TestCase):
+    def test_coalesce_sums_uptime_and_keeps_last_pool_time(self):
+        intents = [
+            {'op': 'uptime', 'device_id': 1, 'at': 1},
+            {'op': 'uptime', 'device_id': 1, 'at': 2},
+            {'op': 'uptime', 'device_id': 2, 'at': 3},
+            {'op': 'pool_time', 'device_id': 1, 'value': 120, 'at': 4},
+            {'op': 'pool_time', 'device_id': 1, 'value': 30, 'at': 5},
+        ]
+        batch = write_behind.coalesce(intents)
+        self.assertEqual({1: 2, 2: 1}, batch['uptime_hours'])
+        self.assertEqual({1: 30}, batch['pool_times'])
+        self.assertEqual([], batch['relay_events'])
+        self.assertEqual({}, batch['relay_daily'])
+
+    def test_coalesce_merges_relay_runtime_and_liters_per_day(self):
+        # 2026-03-07 10:00:00 UTC
+        at_ts = 1772877600
+        intents = [
+            {'op': 'relay_runtime', 'relay_id': 3, 'start_ts': at_ts, 'end_ts': at_ts + 60, 'at': at_ts + 60},
+            {'op': 'relay_runtime', 'relay_id': 3, 'start_ts': at_ts + 60, 'end_ts': at_ts + 90, 'at': at_ts + 90},
+            {'op': 'relay_liters', 'relay_id': 3, 'at_ts': at_ts + 90, 'liters': 2.5, 'at': at_ts + 90},
+            {'op': 'relay_liters', 'relay_id': 3, 'at_ts': at_ts + 90, 'liters': 0.0, 'at': at_ts + 90},
+        ]
+        batch = write_behind.coalesce(intents)
+        self.assertEqual({(3, '2026-03-07'): (90, 2.5)}, batch['relay_daily'])
+
+    def test_coalesce_dedupes_relay_events(self):
+        intents = [
+            {'op': 'relay_events', 'relay_id': 3, 'events': '5,6', 'at': 100},
+            {'op': 'relay_events', 'relay_id': 3, 'events': '5,6', 'at': 110},
+            {'op': 'relay_events', 'relay_id': 3, 'events': '5,6', 'at': 200},
+            {'op': 'relay_events', 'relay_id': 3, 'events': '1,5', 'at': 210},
+            {'op': 'relay_events', 'relay_id': 3, 'events': '1,5', 'at': 400},
+        ]
+        with patch('write_behind.db.DevicesDB.get_relay_events', return_value=[]):
+            batch = write_behind.coalesce(intents)
+        self.assertEqual(['5,6', '5,6', '1,5'], [row[1] for row in batch['relay_events']])
+
+    def test_coalesce_skips_event_matching_last_stored(self):
+        intents = [{'op': 'relay_events', 'relay_id': 3, 'events': '2', 'at': 100}]
+        with patch('write_behind.db.DevicesDB.get_relay_events', return_value=[{'events': '2'}]):
+            batch = write_behind.coalesce(intents)
+        self.assertEqual([], batch['relay_events'])
+
+    def test_coalesce_drops_malformed_intents(self):
+        batch = write_behind.coalesce([{'op': 'uptime'}, {'op': 'unknown'}])
+        self.assertEqual({}, batch['uptime_hours'])
+
+    def test_flush_once_applies_batch_and_updates_metrics(self):
+        fake_redis = FakeQueueRedis([
+            _intent('uptime', device_id=1, at=100),
+            _intent('uptime', device_id=1, at=110),
+            _intent('uptime', device_id=2, at=120),
+        ])
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', return_value=True) as apply_batch, \
+            patch('write_behind.time.time', return_value=130):
+            self.assertEqual(2, write_behind.flush_once(2))
+            self.assertEqual({1: 2}, apply_batch.call_args.kwargs['uptime_hours'])
+            self.assertEqual(1, write_behind.drain(2))
+
+            metrics = write_behind.metrics()
+        self.assertEqual(3, metrics['flushed'])
+        self.assertEqual(2, metrics['batches'])
+        self.assertEqual(10, metrics['last_lag_seconds'])
+        self.assertEqual(0, metrics['pending'])
+
+    def test_flush_once_keeps_batch_on_failure(self):
+        items = [_intent('uptime', device_id=1), _intent('pool_time', device_id=1, value=30)]
+        fake_redis = FakeQueueRedis(items + [_intent('uptime', device_id=9)])
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', side_effect=RuntimeError('locked')):
+            self.assertEqual(0, write_behind.flush_once(2))
+        self.assertEqual(items, fake_redis.lists[write_behind.QUEUE_KEY][:2])
+        self.assertEqual(3, len(fake_redis.lists[write_behind.QUEUE_KEY]))
+        self.assertEqual('2', fake_redis.hashes[write_behind.BATCH_KEY]['size'])
+        self.assertEqual('1', fake_redis.hashes[write_behind.METRICS_KEY]['failed_batches'])
+
+    def test_flush_once_retry_reuses_batch_token_and_size(self):
+        # The worker died after the commit: the batch is still at the head of the queue.
+        fake_redis = FakeQueueRedis([_intent('uptime', device_id=1), _intent('uptime', device_id=2),
+                                     _intent('uptime', device_id=3)])
+        fake_redis.hashes[write_behind.BATCH_KEY] = {'token': 'batch-1', 'size': '2'}
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', return_value=False) as apply_batch:
+            self.assertEqual(0, write_behind.flush_once(10))
+
+        self.assertEqual('batch-1', apply_batch.call_args.kwargs['batch_token'])
+        self.assertEqual({1: 1, 2: 1}, apply_batch.call_args.kwargs['uptime_hours'])
+        self.assertEqual([_intent('uptime', device_id=3)], fake_redis.lists[write_behind.QUEUE_KEY])
+        self.assertNotIn(write_behind.BATCH_KEY, fake_redis.hashes)
+
+    def test_flush_relay_daily_applies_counters_per_utc_day(self):
+        fake_redis = FakeQueueRedis()
+        fake_redis.hashes[write_behind.RELAY_DAILY_KEY] = {
+            '3|1772841600|on_seconds': '120',
+            '3|1772841600|liters': '12.5',
+            '3|1772928000|on_seconds': '30',
+            '4|1772928000|liters': '2.25',
+        }
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', return_value=True) as apply_batch:
+            self.assertEqual(3, write_behind.flush_relay_daily())
+            self.assertEqual(0, write_behind.flush_relay_daily())
+            metrics = write_behind.metrics()
+
+        self.assertEqual({
+            (3, '2026-03-07'): (120, 12.5),
+            (3, '2026-03-08'): (30, 0.0),
+            (4, '2026-03-08'): (0, 2.25),
+        }, apply_batch.call_args.kwargs['relay_daily'])
+        apply_batch.assert_called_once()
+        self.assertNotIn(write_behind.RELAY_DAILY_FLUSHING_KEY, fake_redis.hashes)
+        self.assertEqual(3, metrics['relay_daily_flushed'])
+        self.assertEqual(0, metrics['relay_daily_pending'])
+
+    def test_flush_relay_daily_keeps_failed_batch_for_retry(self):
+        fake_redis = FakeQueueRedis()
+        fake_redis.hashes[write_behind.RELAY_DAILY_KEY] = {'3|1772841600|on_seconds': '120'}
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', side_effect=RuntimeError('locked')):
+            self.assertEqual(0, write_behind.flush_relay_daily())
+        # New heartbeats keep counting while the failed batch waits.
+        fake_redis.hashes[write_behind.RELAY_DAILY_KEY] = {'3|1772841600|on_seconds': '60'}
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', return_value=True) as apply_batch:
+            self.assertEqual(1, write_behind.flush_relay_daily())
+        self.assertEqual({(3, '2026-03-07'): (120, 0.0)}, apply_batch.call_args.kwargs['relay_daily'])
+        self.assertEqual({'3|1772841600|on_seconds': '60'}, fake_redis.hashes[write_behind.RELAY_DAILY_KEY])
+
+    def test_flush_relay_daily_retry_reuses_batch_token(self):
+        fake_redis = FakeQueueRedis()
+        fake_redis.hashes[write_behind.RELAY_DAILY_KEY] = {'3|1772841600|on_seconds': '120'}
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', side_effect=RuntimeError('locked')) as failed:
+            self.assertEqual(0, write_behind.flush_relay_daily())
+        # The process died after the commit: the retry carries the same token and SQLite skips it.
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', return_value=False) as apply_batch:
+            self.assertEqual(0, write_behind.flush_relay_daily())
+
+        self.assertEqual(failed.call_args.kwargs['batch_token'], apply_batch.call_args.kwargs['batch_token'])
+        self.assertNotIn(write_behind.RELAY_DAILY_FLUSHING_KEY, fake_redis.hashes)
+        self.assertNotIn(write_behind.RELAY_DAILY_TOKEN_KEY, fake_redis.strings)
+
+    def test_relay_daily_counters_for_settled_days_bump_report_generation(self):
+        midnight = 1772928000  # 2026-03-08 00:00 UTC
+        self.assertEqual('2026-03-06', str(write_behind.relay_daily_settled_day(midnight + 60)))
+        self.assertEqual('2026-03-07', str(write_behind.relay_daily_settled_day(midnight + 3600)))
+
+        fake_redis = FakeQueueRedis()
+        fake_redis.hashes[write_behind.RELAY_DAILY_KEY] = {'3|1772841600|on_seconds': '120'}
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', return_value=True), \
+            patch('write_behind.time.time', return_value=midnight + 60):
+            write_behind.flush_relay_daily()
+        self.assertNotIn(write_behind.RELAY_REPORT_GENERATION_KEY, fake_redis.hashes)
+
+        fake_redis.hashes[write_behind.RELAY_DAILY_KEY] = {'3|1772841600|liters': '1.5'}
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.db.DevicesDB.apply_write_batch', return_value=True), \
+            patch('write_behind.time.time', return_value=midnight + 3600):
+            write_behind.flush_relay_daily()
+        self.assertEqual(1, fake_redis.hashes[write_behind.RELAY_REPORT_GENERATION_KEY])
+
+    def test_persist_relay_inline_runs_once_per_interval_without_flusher(self):
+        fake_redis = FakeQueueRedis()
+        with patch.object(write_behind, 'redis_client', fake_redis), \
+            patch('write_behind.settings.WRITE_BEHIND_ENABLED', False), \
+            patch('write_behind.relay_events.persist', return_value=0) as persist, \
+            patch('write_behind.flush_relay_daily', return_value=0) as flush_daily:
+            write_behind.persist_relay_inline()
+            write_behind.persist_relay_inline()
+        persist.assert_called_once()
+        flush_daily.assert_called_once_with()
+
+        with patch.object(write_behind, 'redis_client', FakeQueueRedis()), \
+            patch('write_behind.settings.WRITE_BEHIND_ENABLED', True), \
+            patch('write_behind.relay_events.persist') as persist, \
+            patch('write_behind.flush_relay_daily') as flush_daily:
+            write_behind.persist_relay_inline()
+        persist.assert_not_called()
+        flush_daily.assert_not_called()
+
+    def test_wrappers_write_synchronously_when_disabled(self):
+        with patch('write_behind.settings.WRITE_BEHIND_ENABLED', False), \
+            patch('write_behind.db.DevicesDB.record_uptime') as record_uptime, \
+            patch.object(write_behind, 'enqueue_script') as enqueue_script:
+            write_behind.record_uptime(5)
+        record_uptime.assert_called_once_with(5)
+        enqueue_script.assert_not_called()
+
+    def test_wrappers_enqueue_when_enabled(self):
+        enqueue_script = MagicMock(return_value=1)
+        with patch('write_behind.settings.WRITE_BEHIND_ENABLED', True), \
+            patch('write_behind.db.DevicesDB.update_sensor_pool_time') as update_pool_time, \
+            patch.object(write_behind, 'enqueue_script', enqueue_script):
+            write_behind.update_sensor_pool_time(3, 60)
+        update_pool_time.assert_not_called()
+        payload = json.loads(enqueue_script.call_args.kwargs['args'][1])
+        self.assertEqual('pool_time', payload['op'])
+        self.assertEqual(60, payload['value'])
+
+    def test_wrappers_fall_back_when_queue_full(self):
+        with patch('write_behind.settings.WRITE_BEHIND_ENABLED', True), \
+            patch('write_behind.db.DevicesDB.update_sensor_pool_time') as update_pool_time, \
+            patch.object(write_behind, 'enqueue_script', MagicMock(return_value=0)):
+            write_behind.update_sensor_pool_time(1, 30)
+        update_pool_time.assert_called_once_with(1, 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
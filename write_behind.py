@@ -0,0 +1,437 @@
+import argparse
+import datetime
+import json
+import logging
+import signal
+import time
+import uuid
+
+import redis
+
+import settings
+import redis_scripts
+import db
+import migrations
+import relay_events
+
+
+QUEUE_KEY = 'write-behind/queue'
+METRICS_KEY = 'write-behind/metrics'
+# Token and size of the batch at the head of the queue while it is applied.
+BATCH_KEY = 'write-behind/batch'
+# Relay daily ON seconds/liters counters incremented by `/relay-update` (RELAY_RUNTIME_ACCOUNT);
+# a flush renames the hash so increments arriving meanwhile start a fresh one.
+RELAY_DAILY_KEY = 'relay-daily/pending'
+RELAY_DAILY_FLUSHING_KEY = 'relay-daily/flushing'
+# Token of the batch under the flushing key, recorded in SQLite with its rows.
+RELAY_DAILY_TOKEN_KEY = 'relay-daily/flushing-token'
+# Bumped when counters land for a day relay reports already treat as final (flush backlog);
+# part of the cache key of the memoized reports.
+RELAY_REPORT_GENERATION_KEY = 'relay-daily/generation'
+# Held (with a TTL) by the API worker persisting relay state inline when no flusher runs.
+RELAY_EVENTS_INLINE_LOCK_KEY = 'write-behind/inline-relay-events'
+RELAY_DAILY_INLINE_LOCK_KEY = 'write-behind/inline-relay-daily'
+
+redis_client = redis.StrictRedis(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.API_REDIS_DB,
+    decode_responses=True
+)
+
+enqueue_script = redis_client.register_script(redis_scripts.WRITE_BEHIND_ENQUEUE)
+
+
+def enqueue(op, **fields):
+    """Queue a SQLite write intent for the background flusher.
+
+    Args:
+        op: Intent type (`uptime`, `pool_time`; `relay_events`, `relay_runtime` and
+            `relay_liters` are still applied when left in the queue by older API versions).
+        **fields: Intent payload fields.
+
+    Returns:
+        bool: True when queued; False when write-behind is disabled, the queue
+        is full or Redis fails, in which case the caller writes synchronously.
+    """
+    if not settings.WRITE_BEHIND_ENABLED:
+        return False
+    payload = json.dumps(dict(fields, op=op, at=int(time.time())), separators=(',', ':'))
+    try:
+        queued = enqueue_script(
+            keys=[QUEUE_KEY, METRICS_KEY],
+            args=[settings.WRITE_BEHIND_MAX_PENDING, payload],
+            client=redis_client,
+        )
+        return bool(int(queued))
+    except redis.RedisError:
+        logging.exception("write-behind enqueue failed, writing synchronously")
+        return False
+
+
+def record_uptime(device_id):
+    """Count one uptime hour for a device (queued or synchronous)."""
+    if not enqueue('uptime', device_id=device_id):
+        db.DevicesDB.record_uptime(device_id)
+
+
+def update_sensor_pool_time(device_id, WIFI_POOL_TIME):
+    """Persist a sensor WiFi pool time (queued or synchronous)."""
+    if not enqueue('pool_time', device_id=device_id, value=WIFI_POOL_TIME):
+        db.DevicesDB.update_sensor_pool_time(device_id, WIFI_POOL_TIME)
+
+
+def coalesce(intents):
+    """Fold queued intents into per-device aggregates for one transaction.
+
+    Args:
+        intents: Decoded intent dicts in queue order.
+
+    Returns:
+        dict: Keyword arguments for `DevicesDB.apply_write_batch`.
+    """
+    uptime_hours = {}
+    pool_times = {}
+    relay_daily = {}
+    events_by_relay = {}
+
+    for intent in intents:
+        op = intent.get('op')
+        try:
+            if op == 'uptime':
+                device_id = int(intent['device_id'])
+                uptime_hours[device_id] = uptime_hours.get(device_id, 0) + 1
+            elif op == 'pool_time':
+                pool_times[int(intent['device_id'])] = int(intent['value'])
+            elif op == 'relay_runtime':
+                relay_id = int(intent['relay_id'])
+                for day_key, seconds in db.DevicesDB.split_runtime_by_day(int(intent['start_ts']), int(intent['end_ts'])):
+                    on_seconds, liters = relay_daily.get((relay_id, day_key), (0, 0.0))
+                    relay_daily[(relay_id, day_key)] = (on_seconds + seconds, liters)
+            elif op == 'relay_liters':
+                relay_id = int(intent['relay_id'])
+                liters_added = float(intent['liters'])
+                if liters_added <= 0:
+                    continue
+                day_key = datetime.datetime.fromtimestamp(int(intent['at_ts']), datetime.timezone.utc).strftime("%Y-%m-%d")
+                on_seconds, liters = relay_daily.get((relay_id, day_key), (0, 0.0))
+                relay_daily[(relay_id, day_key)] = (on_seconds, liters + liters_added)
+            elif op == 'relay_events':
+                events_by_relay.setdefault(int(intent['relay_id']), []).append((int(intent['at']), intent['events']))
+            else:
+                logging.warning(f"write-behind: unknown intent op: {op}")
+        except (KeyError, TypeError, ValueError):
+            logging.warning(f"write-behind: dropping malformed intent: {intent}")
+
+    return {
+        "uptime_hours": uptime_hours,
+        "pool_times": pool_times,
+        "relay_events": relay_events.dedupe(events_by_relay),
+        "relay_daily": relay_daily,
+    }
+
+
+def relay_daily_settled_day(now_ts=None):
+    """Return the last UTC day whose relay counters are all in `relay_daily_stats`.
+
+    Counters are flushed every `RELAY_DAILY_FLUSH_SECONDS`, so a day is
+    final two flush intervals after it ends.
+
+    Args:
+        now_ts: Current epoch seconds (defaults to now).
+
+    Returns:
+        datetime.date: Last settled day.
+    """
+    now_ts = time.time() if now_ts is None else now_ts
+    settle_ts = now_ts - 2 * settings.RELAY_DAILY_FLUSH_SECONDS
+    return datetime.datetime.fromtimestamp(settle_ts, datetime.timezone.utc).date() - datetime.timedelta(days=1)
+
+
+def _note_late_relay_days(relay_daily):
+    settled = relay_daily_settled_day().strftime("%Y-%m-%d")
+    if any(day_key <= settled for _, day_key in relay_daily):
+        redis_client.incr(RELAY_REPORT_GENERATION_KEY)
+
+
+def flush_once(max_items=None):
+    """Apply up to `max_items` intents from the head of the queue in one SQLite transaction.
+
+    The intents are only read; they are trimmed from the queue after the
+    transaction commits, so a failure or a killed worker leaves them in place
+    for the next flush. The batch token (kept in `BATCH_KEY` until the trim)
+    is recorded in the same transaction, so a batch applied just before the
+    worker died is not applied twice.
+
+    Args:
+        max_items: Maximum intents per batch (defaults to settings).
+
+    Returns:
+        int: Number of intents applied.
+    """
+    max_items = max_items or settings.WRITE_BEHIND_BATCH_SIZE
+    pending = redis_client.hgetall(BATCH_KEY)
+    if pending:
+        # Retry of an unfinished batch: same token, same items.
+        token, size = pending['token'], int(pending['size'])
+    else:
+        token, size = uuid.uuid4().hex, max_items
+    raw_items = redis_client.lrange(QUEUE_KEY, 0, size - 1)
+    if not raw_items:
+        return 0
+    redis_client.hset(BATCH_KEY, mapping={'token': token, 'size': len(raw_items)})
+
+    intents = []
+    for raw in raw_items:
+        try:
+            intents.append(json.loads(raw))
+        except ValueError:
+            logging.warning(f"write-behind: dropping undecodable intent: {raw}")
+
+    now_ts = int(time.time())
+    try:
+        batch = coalesce(intents)
+        applied = db.DevicesDB.apply_write_batch(batch_token=token, **batch)
+    except Exception:
+        logging.exception("write-behind flush failed, keeping batch for retry")
+        redis_client.hincrby(METRICS_KEY, 'failed_batches', 1)
+        return 0
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.ltrim(QUEUE_KEY, len(raw_items), -1)
+    pipe.delete(BATCH_KEY)
+    pipe.execute()
+    if not applied:
+        logging.warning(f"write-behind: batch {token} was already applied, dropping it")
+        return 0
+    _note_late_relay_days(batch['relay_daily'])
+
+    oldest_ts = min((int(intent.get('at', now_ts)) for intent in intents), default=now_ts)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hincrby(METRICS_KEY, 'flushed', len(raw_items))
+    pipe.hincrby(METRICS_KEY, 'batches', 1)
+    pipe.hset(METRICS_KEY, mapping={
+        'last_flush_at': now_ts,
+        'last_batch_size': len(raw_items),
+        'last_lag_seconds': max(0, now_ts - oldest_ts),
+    })
+    pipe.execute()
+    return len(raw_items)
+
+
+def flush_relay_daily():
+    """Move accumulated relay daily counters to `relay_daily_stats`.
+
+    The pending hash is renamed before it is read, so heartbeats keep counting
+    into a new one. A batch that fails to apply stays under the flushing key
+    and is retried first by the next call. The batch carries a token stored
+    in the same SQLite transaction, so a batch applied by a process that
+    died before clearing the flushing key is not counted again. Counters for
+    days already settled (see `relay_daily_settled_day`) invalidate the
+    cached relay reports.
+
+    Returns:
+        int: Number of relay-day rows applied.
+    """
+    try:
+        redis_client.renamenx(RELAY_DAILY_KEY, RELAY_DAILY_FLUSHING_KEY)
+    except redis.ResponseError:
+        # No pending counters (a left-over flushing batch is still retried below).
+        pass
+    counters = redis_client.hgetall(RELAY_DAILY_FLUSHING_KEY)
+    if not counters:
+        return 0
+
+    relay_daily = {}
+    for field, value in counters.items():
+        try:
+            relay_id, day_ts, name = field.split('|')
+            day_key = datetime.datetime.fromtimestamp(int(day_ts), datetime.timezone.utc).strftime("%Y-%m-%d")
+            on_seconds, liters = relay_daily.get((int(relay_id), day_key), (0, 0.0))
+            if name == 'on_seconds':
+                on_seconds += int(value)
+            elif name == 'liters':
+                liters += float(value)
+            relay_daily[(int(relay_id), day_key)] = (on_seconds, liters)
+        except ValueError:
+            logging.warning(f"write-behind: dropping malformed relay counter: {field}={value}")
+
+    # Kept across retries of the same batch (set once, cleared together with the batch).
+    redis_client.set(RELAY_DAILY_TOKEN_KEY, uuid.uuid4().hex, nx=True)
+    token = redis_client.get(RELAY_DAILY_TOKEN_KEY)
+    try:
+        applied = db.DevicesDB.apply_write_batch(relay_daily=relay_daily, batch_token=token)
+    except Exception:
+        logging.exception("write-behind: relay daily flush failed, keeping counters for retry")
+        redis_client.hincrby(METRICS_KEY, 'failed_batches', 1)
+        return 0
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(RELAY_DAILY_FLUSHING_KEY)
+    pipe.delete(RELAY_DAILY_TOKEN_KEY)
+    pipe.execute()
+    if not applied:
+        logging.warning(f"write-behind: relay daily batch {token} was already applied, dropping it")
+        return 0
+    _note_late_relay_days(relay_daily)
+    redis_client.hincrby(METRICS_KEY, 'relay_daily_flushed', len(relay_daily))
+    return len(relay_daily)
+
+
+def persist_relay_inline():
+    """Persist relay event logs and daily counters from the API when no flusher runs.
+
+    With `WRITE_BEHIND_ENABLED` off the write_behind.py process is not
+    started, so `/relay-update` calls this after each heartbeat. Redis locks
+    with a TTL let one heartbeat per `WRITE_BEHIND_FLUSH_SECONDS` persist the
+    event logs and one per `RELAY_DAILY_FLUSH_SECONDS` flush the daily
+    counters, for the whole fleet, as a flusher pass would.
+
+    Returns:
+        None.
+    """
+    if settings.WRITE_BEHIND_ENABLED:
+        return
+    try:
+        if redis_client.set(RELAY_EVENTS_INLINE_LOCK_KEY, 1, nx=True, ex=settings.WRITE_BEHIND_FLUSH_SECONDS):
+            relay_events.persist(settings.WRITE_BEHIND_BATCH_SIZE)
+        if redis_client.set(RELAY_DAILY_INLINE_LOCK_KEY, 1, nx=True, ex=settings.RELAY_DAILY_FLUSH_SECONDS):
+            flush_relay_daily()
+    except Exception:
+        # Both keep their data in Redis on failure; the next holder of the lock retries it.
+        logging.exception("write-behind: inline relay persistence failed")
+
+
+def drain(max_items=None):
+    """Flush until the queue is empty or a flush fails.
+
+    Returns:
+        int: Total intents applied.
+    """
+    total = 0
+    while True:
+        flushed = flush_once(max_items)
+        if not flushed:
+            return total
+        total += flushed
+
+
+def metrics():
+    """Return write-behind counters plus current queue depth.
+
+    Returns:
+        dict: Integer metrics (`enqueued`, `rejected`, `flushed`, `batches`,
+        `failed_batches`, `last_flush_at`, `last_batch_size`,
+        `last_lag_seconds`, `relay_daily_flushed`, `pending`,
+        `relay_daily_pending`).
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(METRICS_KEY)
+    pipe.llen(QUEUE_KEY)
+    pipe.hlen(RELAY_DAILY_KEY)
+    raw_metrics, pending, relay_daily_pending = pipe.execute()
+    output = {name: int(value) for name, value in (raw_metrics or {}).items()}
+    output['pending'] = int(pending or 0)
+    output['relay_daily_pending'] = int(relay_daily_pending or 0)
+    return output
+
+
+class WriteBehindFlusher:
+    """Periodically apply queued SQLite writes and drain the queue on shutdown."""
+    def __init__(self, interval, batch_size, relay_daily_interval=None):
+        self.interval = max(1, int(interval))
+        self.batch_size = max(1, int(batch_size))
+        if relay_daily_interval is None:
+            relay_daily_interval = settings.RELAY_DAILY_FLUSH_SECONDS
+        self.relay_daily_interval = max(1, int(relay_daily_interval))
+        self.running = True
+
+    def _flush_relay_daily(self):
+        try:
+            rows = flush_relay_daily()
+        except redis.RedisError:
+            logging.exception("write-behind: redis unavailable")
+            rows = 0
+        if rows:
+            logging.warning(f"write-behind: flushed {rows} relay daily rows")
+
+    def _persist_relay_events(self):
+        try:
+            rows = relay_events.persist(self.batch_size)
+        except redis.RedisError:
+            logging.exception("write-behind: redis unavailable")
+            rows = 0
+        if rows:
+            logging.warning(f"write-behind: persisted {rows} relay events")
+
+    def run(self, once=False):
+        """Run the flush loop until stopped, then drain pending intents.
+
+        Relay event logs are persisted every pass and relay daily counters
+        every `relay_daily_interval` seconds; both once more on exit.
+
+        Args:
+            once: When True, drain once and exit.
+
+        Returns:
+            None.
+        """
+        next_relay_daily = time.time() + self.relay_daily_interval
+        while self.running and not once:
+            if time.time() >= next_relay_daily:
+                self._flush_relay_daily()
+                next_relay_daily = time.time() + self.relay_daily_interval
+            self._persist_relay_events()
+            try:
+                flushed = flush_once(self.batch_size)
+            except redis.RedisError:
+                logging.exception("write-behind: redis unavailable")
+                flushed = 0
+            if flushed:
+                logging.warning(f"write-behind: flushed {flushed} intents")
+            if flushed == self.batch_size:
+                # Backlog pending: keep flushing without sleeping to bound lag.
+                continue
+            deadline = time.time() + self.interval
+            while self.running and time.time() < deadline:
+                time.sleep(min(1.0, self.interval))
+
+        drained = drain(self.batch_size)
+        self._persist_relay_events()
+        self._flush_relay_daily()
+        logging.warning(f"write-behind: drained {drained} intents, metrics: {metrics()}")
+
+
+def main():
+    """Entrypoint for the write-behind flusher service.
+
+    Returns:
+        None.
+    """
+    parser = argparse.ArgumentParser(description="Apply queued device SQLite writes in batches")
+    parser.add_argument("--interval", type=int, default=settings.WRITE_BEHIND_FLUSH_SECONDS,
+                        help="Seconds between flushes")
+    parser.add_argument("--batch-size", type=int, default=settings.WRITE_BEHIND_BATCH_SIZE,
+                        help="Maximum intents applied per transaction")
+    parser.add_argument("--once", action="store_true", help="Drain the queue once and exit")
+    args = parser.parse_args()
+    migrations.ensure_current()
+
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.config.update(settings.API_CACHE_SETT)
+    db.cache.init_app(app)
+
+    flusher = WriteBehindFlusher(args.interval, args.batch_size)
+
+    def _stop(*_):
+        flusher.running = False
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    with app.app_context():
+        flusher.run(once=args.once)
+
+
+if __name__ == "__main__":
+    main()